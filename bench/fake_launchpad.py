@@ -0,0 +1,265 @@
+"""A local stand-in for Launchpad, for offline benchmarks.
+
+Serves both roots the proxy talks to from one port, so LP_WEB_URL and
+LP_API_URL can both point at it:
+
+  POST /+request-token, /+access-token   form-encoded OAuth 1.0a tokens
+  GET  /+authorize-token                 approves at once: 302 to
+                                         oauth_callback with oauth_token
+  GET  /devel/people/+me                 the authenticated person
+  GET  /devel/~<name>/memberships_details, /devel/~<name>/super_teams
+                                         membership collections
+  GET  /devel/bugs, /devel/<...>/<collection>
+                                         paginated collections (ws.start,
+                                         ws.size)
+  GET  /devel/<anything else>            a plain resource
+
+Every response waits latency +/- jitter first; error_rate of them are 503s
+with Retry-After, like an overloaded Launchpad.
+
+    python -m bench.fake_launchpad --port 8081 --latency-ms 50 --jitter-ms 20
+"""
+
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PERSON = "bench-user"
+COLLECTIONS = ("bugs", "bug_tasks", "specifications", "merge_proposals", "ppas")
+
+
+class FakeLaunchpad(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        teams=20,
+        collection_size=500,
+        page_size=75,
+    ):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.teams = teams
+        self.collection_size = collection_size
+        self.page_size = page_size
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="fake-launchpad", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    # --- Resources ---------------------------------------------------------
+
+    def person(self):
+        api = f"{self.url}/devel/~{PERSON}"
+        return {
+            "self_link": api,
+            "web_link": f"{self.url}/~{PERSON}",
+            "resource_type_link": f"{self.url}/devel/#person",
+            "name": PERSON,
+            "display_name": "Bench User",
+            "preferred_email_address_link": f"{api}/+email/{PERSON}%40example.com",
+            "memberships_details_collection_link": f"{api}/memberships_details",
+            "super_teams_collection_link": f"{api}/super_teams",
+        }
+
+    def team(self, index):
+        name = f"bench-team-{index}"
+        return {
+            "self_link": f"{self.url}/devel/~{name}",
+            "web_link": f"{self.url}/~{name}",
+            "name": name,
+            "display_name": f"Bench Team {index}",
+        }
+
+    def membership(self, index):
+        team = self.team(index)
+        return {
+            "self_link": f"{team['self_link']}/+member/{PERSON}",
+            "team_link": team["self_link"],
+            "member_link": f"{self.url}/devel/~{PERSON}",
+            "status": "Approved",
+            "team": team,
+        }
+
+    def collection(self, path, query, total, entry):
+        start = int(query.get("ws.start", 0))
+        size = int(query.get("ws.size", self.page_size))
+        end = min(start + size, total)
+        page = {
+            "start": start,
+            "total_size": total,
+            "entries": [entry(i) for i in range(start, end)],
+        }
+        link = f"{self.url}{path}?"
+        if end < total:
+            page["next_collection_link"] = link + urllib.parse.urlencode(
+                {"ws.start": end, "ws.size": size}
+            )
+        if start > 0:
+            page["prev_collection_link"] = link + urllib.parse.urlencode(
+                {"ws.start": max(start - size, 0), "ws.size": size}
+            )
+        return page
+
+    def resource(self, path):
+        return {
+            "self_link": f"{self.url}{path}",
+            "resource_type_link": f"{self.url}/devel/#{path.rsplit('/', 1)[-1]}",
+            "title": path,
+        }
+
+    def devel(self, path, query):
+        if path == "/devel/people/+me":
+            return self.person()
+        if path.endswith(("/memberships_details", "/super_teams")):
+            return self.collection(path, query, self.teams, self.membership)
+        if path.rsplit("/", 1)[-1] in COLLECTIONS:
+            return self.collection(
+                path,
+                query,
+                self.collection_size,
+                lambda i: self.resource(f"{path}/{i + 1}"),
+            )
+        return self.resource(path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeLaunchpad
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="application/json", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        self.server.count()
+        self.server.delay()
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self._send(503, b"Service Unavailable", "text/plain", [("Retry-After", "0")])
+            return False
+        return True
+
+    def _token(self):
+        body = urllib.parse.urlencode(
+            {
+                "oauth_token": secrets.token_urlsafe(15),
+                "oauth_token_secret": secrets.token_urlsafe(30),
+            }
+        ).encode()
+        self._send(200, body, "application/x-www-form-urlencoded")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        if not self._begin():
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        if path not in ("/+request-token", "/+access-token"):
+            self._send(404, b"Not found", "text/plain")
+        elif "oauth_consumer_key" not in form or "oauth_signature" not in form:
+            self._send(401, b"Unsigned request", "text/plain")
+        else:
+            self._token()
+
+    def do_GET(self):
+        if not self._begin():
+            return
+        parts = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        if parts.path == "/+authorize-token":
+            callback = query.get("oauth_callback")
+            if not callback:
+                self._send(200, b"Authorized", "text/plain")
+                return
+            joiner = "&" if "?" in callback else "?"
+            location = callback + joiner + urllib.parse.urlencode(
+                {"oauth_token": query.get("oauth_token", "")}
+            )
+            self._send(302, headers=[("Location", location)])
+        elif parts.path.startswith("/devel/"):
+            if "Authorization" not in self.headers and parts.path == "/devel/people/+me":
+                self._send(401, b"Unauthorized", "text/plain")
+                return
+            body = json.dumps(self.server.devel(parts.path, query)).encode()
+            self._send(200, body)
+        else:
+            self._send(404, b"Not found", "text/plain")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--teams", type=int, default=20)
+    parser.add_argument("--collection-size", type=int, default=500)
+    args = parser.parse_args(argv)
+    server = FakeLaunchpad(
+        (args.host, args.port),
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        teams=args.teams,
+        collection_size=args.collection_size,
+    )
+    print(f"Fake Launchpad on {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
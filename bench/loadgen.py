@@ -0,0 +1,331 @@
+"""Closed-loop load generator for a running proxy.
+
+Each worker thread has its own HTTP session and issues requests back to
+back. Two scenarios:
+
+  login   the full OIDC login: /oauth2/login (PKCE), Launchpad's
+          +authorize-token, /oauth2/callback, then /oauth2/token.
+  devel   GET /devel/<path> with a bearer token obtained by one login,
+          cycling through --path.
+
+The report gives RPS, latency percentiles and, from the proxy's own
+process_cpu_seconds_total, CPU seconds per request. With --baseline it is
+compared against an earlier --json report. With --unix-socket, requests to
+the proxy URL are sent over that UNIX domain socket instead of TCP.
+
+    python -m bench.loadgen http://127.0.0.1:3456 --scenario devel -c 16 -d 30
+    python -m bench.loadgen http://proxy.sock --unix-socket /run/lp-api-proxy.sock
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import math
+import secrets
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+
+import requests
+import urllib3
+
+REDIRECT_URI = "http://127.0.0.1/bench/callback"
+DEFAULT_PATHS = ("people/+me", "bugs?ws.size=75", "bugs/1")
+
+
+class _UnixConnection(urllib3.connection.HTTPConnection):
+    def __init__(self, path, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.unix_path = path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.unix_path)
+        return sock
+
+
+class _UnixConnectionPool(urllib3.HTTPConnectionPool):
+    def __init__(self, path, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.unix_path = path
+
+    def _new_conn(self):
+        return _UnixConnection(self.unix_path, timeout=self.timeout.connect_timeout)
+
+
+class UnixSocketAdapter(requests.adapters.HTTPAdapter):
+    """Send every request it is mounted for over the UNIX socket ``path``."""
+
+    def __init__(self, path):
+        super().__init__()
+        self._pool = _UnixConnectionPool(path)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self._pool
+
+    def close(self):
+        super().close()
+        self._pool.close()
+
+
+def new_session(proxy, unix_socket=None):
+    """A requests session; with ``unix_socket``, requests to the ``proxy``
+    URL go over that socket, others (e.g. to Launchpad) over TCP."""
+    result = requests.Session()
+    if unix_socket:
+        result.mount(proxy.rstrip("/") + "/", UnixSocketAdapter(unix_socket))
+    return result
+
+
+def login(session, proxy, client_id="concourse-ci"):
+    """Run one OIDC login through the proxy; return the token response."""
+    verifier = secrets.token_urlsafe(48)
+    challenge = (
+        base64.urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest())
+        .rstrip(b"=")
+        .decode()
+    )
+    response = session.get(
+        f"{proxy}/oauth2/login",
+        params={
+            "client_id": client_id,
+            "redirect_uri": REDIRECT_URI,
+            "state": secrets.token_urlsafe(8),
+            "code_challenge": challenge,
+            "code_challenge_method": "S256",
+        },
+        allow_redirects=False,
+    )
+    # proxy -> Launchpad +authorize-token -> proxy callback -> client
+    for _ in range(2):
+        if response.status_code not in (302, 303, 307):
+            raise RuntimeError(f"login stopped at {response.status_code}: {response.text}")
+        response = session.get(response.headers["Location"], allow_redirects=False)
+    location = response.headers.get("Location", "")
+    if not location.startswith(REDIRECT_URI):
+        raise RuntimeError(f"callback returned {response.status_code}: {response.text}")
+    code = urllib.parse.parse_qs(urllib.parse.urlsplit(location).query)["code"][0]
+    response = session.post(
+        f"{proxy}/oauth2/token",
+        data={
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": REDIRECT_URI,
+            "client_id": client_id,
+            "code_verifier": verifier,
+        },
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def process_cpu_seconds(session, proxy):
+    """process_cpu_seconds_total from the proxy's /metrics, or None."""
+    try:
+        response = session.get(f"{proxy}/metrics", timeout=10)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    for line in response.text.splitlines():
+        if line.startswith("process_cpu_seconds_total "):
+            return float(line.split()[1])
+    return None
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = max(math.ceil(fraction * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+def run(
+    proxy,
+    scenario,
+    concurrency=8,
+    duration=10.0,
+    requests_total=None,
+    paths=DEFAULT_PATHS,
+    unix_socket=None,
+):
+    """Drive one scenario and return its report as a dict.
+
+    Stops after ``duration`` seconds, or after ``requests_total`` requests
+    if that is given.
+    """
+    proxy = proxy.rstrip("/")
+    control = new_session(proxy, unix_socket)
+    if scenario == "devel":
+        token = login(control, proxy)["access_token"]
+
+        def request(session, n):
+            response = session.get(
+                f"{proxy}/devel/{paths[n % len(paths)]}",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            return response.status_code < 400
+
+    elif scenario == "login":
+
+        def request(session, n):
+            login(session, proxy)
+            return True
+
+    else:
+        raise ValueError(f"Unknown scenario: {scenario}")
+
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    issued = [0]
+    deadline = time.monotonic() + duration
+
+    def worker():
+        client = new_session(proxy, unix_socket)
+        while True:
+            with lock:
+                if requests_total is not None:
+                    if issued[0] >= requests_total:
+                        return
+                elif time.monotonic() >= deadline:
+                    return
+                n = issued[0]
+                issued[0] += 1
+            started = time.perf_counter()
+            try:
+                ok = request(client, n)
+            except (requests.RequestException, RuntimeError, KeyError):
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    cpu_before = process_cpu_seconds(control, proxy)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    cpu_after = process_cpu_seconds(control, proxy)
+
+    latencies.sort()
+    completed = len(latencies)
+    report = {
+        "scenario": scenario,
+        "transport": "unix" if unix_socket else "tcp",
+        "concurrency": concurrency,
+        "requests": completed,
+        "errors": errors[0],
+        "seconds": round(wall, 3),
+        "rps": round(completed / wall, 2) if wall else None,
+    }
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        value = percentile(latencies, fraction)
+        report[f"{name}_ms"] = round(value * 1000, 2) if value is not None else None
+    if cpu_before is not None and cpu_after is not None and completed:
+        report["cpu_ms_per_request"] = round((cpu_after - cpu_before) * 1000 / completed, 3)
+    else:
+        report["cpu_ms_per_request"] = None
+    return report
+
+
+COMPARED = {
+    "rps": 1,
+    "p50_ms": -1,
+    "p95_ms": -1,
+    "p99_ms": -1,
+    "cpu_ms_per_request": -1,
+}
+
+
+def compare(report, baseline):
+    """Per-metric change against a baseline report, in percent.
+
+    Positive is always better: more RPS, lower latency and CPU.
+    """
+    changes = {}
+    for key, direction in COMPARED.items():
+        old, new = baseline.get(key), report.get(key)
+        if old and new is not None:
+            changes[key] = round(direction * (new - old) * 100 / old, 1)
+    return changes
+
+
+def format_report(report, changes=None, against="baseline"):
+    line = (
+        f"{report['scenario']:<6} {report.get('transport', 'tcp'):<4} "
+        f"c={report['concurrency']:<3} "
+        f"{report['requests']} ok, {report['errors']} errors in {report['seconds']}s  "
+        f"rps={report['rps']}  p50={report['p50_ms']}ms  p95={report['p95_ms']}ms  "
+        f"p99={report['p99_ms']}ms  cpu/req={report['cpu_ms_per_request']}ms"
+    )
+    if changes:
+        line += f"\n       vs {against}: " + "  ".join(
+            f"{key} {value:+.1f}%" for key, value in changes.items()
+        )
+    return line
+
+
+def add_arguments(parser):
+    parser.add_argument("--scenario", action="append", choices=("login", "devel"))
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("-n", "--requests", type=int, help="Stop after N requests.")
+    parser.add_argument(
+        "--path", action="append", help="/devel path for the devel scenario (repeatable)."
+    )
+    parser.add_argument("--json", metavar="FILE", help="Also write the reports here.")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare with an earlier --json.")
+
+
+def run_all(proxy, args, out=sys.stdout, unix_socket=None):
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = {
+                (entry["scenario"], entry.get("transport", "tcp")): entry
+                for entry in json.load(fh)
+            }
+    reports = []
+    for scenario in args.scenario or ["login", "devel"]:
+        report = run(
+            proxy,
+            scenario,
+            concurrency=args.concurrency,
+            duration=args.duration,
+            requests_total=args.requests,
+            paths=tuple(args.path or DEFAULT_PATHS),
+            unix_socket=unix_socket,
+        )
+        reports.append(report)
+        key = (scenario, report["transport"])
+        changes = compare(report, baseline[key]) if key in baseline else None
+        print(format_report(report, changes), file=out, flush=True)
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(reports, fh, indent=2)
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("proxy", help="Base URL of the proxy under test.")
+    parser.add_argument("--unix-socket", help="Reach the proxy over this UNIX socket.")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    run_all(args.proxy, args, unix_socket=args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
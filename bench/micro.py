@@ -0,0 +1,313 @@
+"""Microbenchmarks of the per-request hot path, with a regression gate.
+
+Times the functions every proxied request or login goes through, using
+realistic inputs: an access token carrying hundreds of groups and a
+membership collection of hundreds of teams.
+
+    python -m bench.micro                 # print timings
+    python -m bench.micro --save          # record bench/baseline.json
+    python -m bench.micro --check         # exit 1 on a regression
+    python -m bench.micro --check --max-regression 0.1 -k jwt
+
+Timings depend on the machine and on its load at the time, so a fixed
+pure-Python calibration loop is timed right before every benchmark and
+--check scales the baseline by how much faster or slower that loop got. Re-record the baseline with --save when a change is
+meant to make something slower.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+import warnings
+
+from cryptography.fernet import Fernet
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_MAX_REGRESSION = 0.25
+GROUPS = 300
+MEMBERSHIPS = 500
+
+os.environ.setdefault("PROXY_JWT_SECRET", "bench-" + "0" * 58)
+os.environ.setdefault("PROXY_JWT_ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import main as proxy  # noqa: E402
+
+
+def _groups(count):
+    names = [f"team-{i:04d}" for i in range(count)]
+    return names, [f"{proxy.LAUNCHPAD_URL}/~{name}" for name in names]
+
+
+def _membership_entries(count):
+    entries = []
+    for i in range(count):
+        team = f"{proxy.LAUNCHPAD_API}/devel/~team-{i:04d}"
+        entries.append(
+            {
+                "self_link": f"{team}/+member/bench-user",
+                "team_link": team,
+                "member_link": f"{proxy.LAUNCHPAD_API}/devel/~bench-user",
+                "status": "Approved",
+                "team": {
+                    "self_link": team,
+                    "web_link": f"{proxy.LAUNCHPAD_URL}/~team-{i:04d}",
+                    "name": f"team-{i:04d}",
+                },
+            }
+        )
+    return entries
+
+
+def _access_claims():
+    groups, groups_full = _groups(GROUPS)
+    lp_cred = proxy._fernet().encrypt(
+        json.dumps(
+            {
+                "oauth_token": "t" * 20,
+                "oauth_token_secret": "s" * 50,
+                "oauth_consumer_key": "concourse-ci (https://ci.example.com)",
+            }
+        ).encode()
+    ).decode()
+    return {
+        "typ": "lp-access",
+        "aud": proxy.PROXY_JWT_AUDIENCE,
+        "sub": "bench-user",
+        "username": "bench-user",
+        "user_id": "bench-user",
+        "lp_oauth_consumer_key": "concourse-ci (https://ci.example.com)",
+        "name": "Bench User",
+        "profile": f"{proxy.LAUNCHPAD_URL}/~bench-user",
+        "groups": groups,
+        "groups_full": groups_full,
+        "lp_cred": lp_cred,
+        "email": "bench-user@example.com",
+        "email_verified": True,
+    }
+
+
+def _id_token_claims():
+    claims = dict(_access_claims())
+    for key in ("typ", "lp_oauth_consumer_key", "lp_cred"):
+        claims.pop(key)
+    claims.update({"iss": proxy.PROXY_JWT_ISSUER, "aud": "concourse-ci", "iat": 0, "exp": 2**31})
+    return claims
+
+
+# Each benchmark builds its inputs once and returns the callable to time.
+
+
+def bench_resolve_authorization_header():
+    token = proxy._sign_jwt(_access_claims(), 3600)
+    authorization = f"Bearer {token}"
+    return lambda: proxy._resolve_authorization_header(authorization)
+
+
+def bench_verify_jwt():
+    token = proxy._sign_jwt(_access_claims(), 3600)
+    audience = proxy.PROXY_JWT_AUDIENCE
+    return lambda: proxy._verify_jwt(token, audience=audience)
+
+
+def bench_fernet():
+    return proxy._fernet
+
+
+def bench_fernet_decrypt():
+    lp_cred = _access_claims()["lp_cred"].encode()
+    return lambda: proxy._fernet().decrypt(lp_cred)
+
+
+def bench_percent_encode():
+    value = "concourse-ci (https://ci.example.com)"
+    return lambda: proxy._percent_encode(value)
+
+
+def bench_oauth1_params_plaintext():
+    return lambda: proxy._oauth1_params(
+        "concourse-ci", "", token="t" * 20, token_secret="s" * 50,
+        signature_method="PLAINTEXT",
+    )
+
+
+def bench_oauth1_params_hmac_sha1():
+    url = f"{proxy.LAUNCHPAD_API}/devel/people/+me"
+    return lambda: proxy._oauth1_params(
+        "concourse-ci", "", token="t" * 20, token_secret="s" * 50,
+        signature_method="HMAC-SHA1", url=url,
+    )
+
+
+def bench_oauth1_hmac_sha1_signature():
+    params = proxy._oauth1_params(
+        "concourse-ci", "", token="t" * 20, token_secret="s" * 50,
+        signature_method="PLAINTEXT",
+    )
+    url = f"{proxy.LAUNCHPAD_API}/devel/bugs?ws.size=75"
+    return lambda: proxy._oauth1_hmac_sha1_signature("GET", url, params, "", "s" * 50)
+
+
+def bench_sign_jwt():
+    claims = _access_claims()
+    return lambda: proxy._sign_jwt(claims, 3600)
+
+
+def bench_sign_id_token():
+    claims = _id_token_claims()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        proxy._get_rsa_private_key()
+    return lambda: proxy._sign_id_token(claims)
+
+
+def bench_extract_groups():
+    entries = _membership_entries(MEMBERSHIPS)
+
+    def run():
+        for entry in entries:
+            proxy._extract_groups_from_membership_entry(entry)
+
+    return run
+
+
+def _render(media_type):
+    def setup():
+        text = json.dumps({"total_size": MEMBERSHIPS, "entries": _membership_entries(MEMBERSHIPS)})
+        return lambda: proxy._render_body(text, media_type)
+
+    return setup
+
+
+BENCHMARKS = {
+    "resolve_authorization_header": bench_resolve_authorization_header,
+    "verify_jwt": bench_verify_jwt,
+    "fernet": bench_fernet,
+    "fernet_decrypt": bench_fernet_decrypt,
+    "percent_encode": bench_percent_encode,
+    "oauth1_params_plaintext": bench_oauth1_params_plaintext,
+    "oauth1_params_hmac_sha1": bench_oauth1_params_hmac_sha1,
+    "oauth1_hmac_sha1_signature": bench_oauth1_hmac_sha1_signature,
+    "sign_jwt": bench_sign_jwt,
+    "sign_id_token": bench_sign_id_token,
+    f"extract_groups_x{MEMBERSHIPS}": bench_extract_groups,
+    f"render_json_x{MEMBERSHIPS}": _render(proxy.MEDIA_JSON),
+    f"render_msgpack_x{MEMBERSHIPS}": _render(proxy.MEDIA_MSGPACK),
+    f"render_cbor_x{MEMBERSHIPS}": _render(proxy.MEDIA_CBOR),
+}
+
+
+def _calibration():
+    data = [str(i) for i in range(200)]
+    return lambda: sorted(data, key=hash)
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Best time per call, in microseconds."""
+    gc.collect()
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    best = min([elapsed] + timer.repeat(repeat - 1, number))
+    return round(best * 1e6 / number, 3)
+
+
+def run(selected=None, repeat=5, min_time=0.2):
+    """Time each benchmark, and the calibration loop right before it."""
+    calibration = _calibration()
+    results = {"benchmarks": {}}
+    for name, setup in BENCHMARKS.items():
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        func = setup()
+        results["benchmarks"][name] = {
+            "calibration_us": measure(calibration, repeat, min_time),
+            "us": measure(func, repeat, min_time),
+        }
+    return results
+
+
+def _expected(current, old):
+    """The baseline time scaled to the current calibration speed."""
+    return old["us"] * current["calibration_us"] / old["calibration_us"]
+
+
+def check(results, baseline, max_regression=DEFAULT_MAX_REGRESSION):
+    """Return [(name, us, expected_us, change)] for every regression.
+
+    ``change`` is the relative slowdown against the calibrated baseline;
+    benchmarks missing from the baseline are not checked.
+    """
+    regressions = []
+    for name, current in results["benchmarks"].items():
+        old = baseline["benchmarks"].get(name)
+        if not old:
+            continue
+        expected = _expected(current, old)
+        change = current["us"] / expected - 1
+        if change > max_regression:
+            regressions.append((name, current["us"], expected, change))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    lines = [f"{'benchmark':<32} {'us/op':>10} {'baseline':>10} {'change':>8}"]
+    for name, current in results["benchmarks"].items():
+        line = f"{name:<32} {current['us']:>10.2f}"
+        old = (baseline or {}).get("benchmarks", {}).get(name)
+        if old:
+            expected = _expected(current, old)
+            line += f" {expected:>10.2f} {(current['us'] / expected - 1) * 100:>+7.1f}%"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("-k", action="append", metavar="SUBSTRING", help="Only matching benchmarks.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Seconds per repeat.")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="Record the results as the baseline.")
+    parser.add_argument("--check", action="store_true", help="Fail on regressions.")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=DEFAULT_MAX_REGRESSION,
+        help=f"Allowed slowdown as a fraction (default: {DEFAULT_MAX_REGRESSION}).",
+    )
+    args = parser.parse_args(argv)
+
+    results = run(args.k, args.repeat, args.min_time)
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    print(format_results(results, baseline))
+
+    if args.save:
+        with open(args.baseline, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+        print(f"Baseline written to {args.baseline}")
+    if args.check:
+        if baseline is None:
+            sys.exit(f"No baseline at {args.baseline}; record one with --save.")
+        regressions = check(results, baseline, args.max_regression)
+        for name, value, expected, change in regressions:
+            print(
+                f"REGRESSION {name}: {value:.2f}us vs {expected:.2f}us "
+                f"(+{change * 100:.1f}% > {args.max_regression * 100:.0f}%)"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
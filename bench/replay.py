@@ -0,0 +1,141 @@
+"""Replay the /devel traffic shape of a recorded cassette.
+
+A proxy run with PROXY_UPSTREAM_RECORD captures its Launchpad calls. This
+script reissues the recorded /devel GETs against a proxy, at their recorded
+offsets divided by --speed, so a real morning's arrival pattern can be
+replayed offline. The proxy under test normally runs with
+PROXY_UPSTREAM_REPLAY pointing at the same cassette (see bench/run.py
+--cassette), which answers with the recorded payloads and latencies.
+
+Logins are not replayed: they need a browser round-trip to Launchpad.
+Requests are sent without credentials, which replay mode does not check.
+
+    python -m bench.replay http://127.0.0.1:3456 'morning-*.jsonl.gz' --speed 4
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import gzip
+import json
+import sys
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from bench import loadgen
+
+
+def read_cassettes(pattern):
+    """Entries of every cassette matching ``pattern``, oldest first."""
+    entries = []
+    for path in sorted(glob.glob(pattern)) or [pattern]:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as fh:
+            entries.extend(json.loads(line) for line in fh if line.strip())
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries
+
+
+def devel_schedule(pattern):
+    """[(offset_seconds, "/devel/...")] of the recorded /devel GETs."""
+    schedule = []
+    start = None
+    for entry in read_cassettes(pattern):
+        path = urllib.parse.urlsplit(entry["url"])
+        if entry["method"] != "GET" or not path.path.startswith("/devel/"):
+            continue
+        if start is None:
+            start = entry["ts"]
+        target = path.path + (f"?{path.query}" if path.query else "")
+        schedule.append((entry["ts"] - start, target))
+    return schedule
+
+
+def replay(proxy_url, schedule, speed=1.0, max_in_flight=256):
+    """Issue ``schedule`` against ``proxy_url``; return a report dict."""
+    proxy_url = proxy_url.rstrip("/")
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    late = [0]
+
+    def send(target):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = session.get(proxy_url + target).status_code < 500
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors[0] += 1
+
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for offset, target in schedule:
+            delay = started + offset / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.05:
+                late[0] += 1
+            executor.submit(send, target)
+    wall = time.monotonic() - started
+
+    latencies.sort()
+    report = {
+        "scenario": "replay",
+        "speed": speed,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "late_starts": late[0],
+        "seconds": round(wall, 3),
+        "rps": round(len(latencies) / wall, 2) if wall else None,
+    }
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        value = loadgen.percentile(latencies, fraction)
+        report[f"{name}_ms"] = round(value * 1000, 2) if value is not None else None
+    return report
+
+
+def add_arguments(parser):
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression factor.")
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--json", metavar="FILE", help="Also write the report here.")
+
+
+def run_all(proxy_url, pattern, args, out=sys.stdout):
+    schedule = devel_schedule(pattern)
+    report = replay(proxy_url, schedule, args.speed, args.max_in_flight)
+    print(
+        f"replay x{report['speed']}: {report['requests']} ok, {report['errors']} errors, "
+        f"{report['late_starts']} late in {report['seconds']}s  rps={report['rps']}  "
+        f"p50={report['p50_ms']}ms  p95={report['p95_ms']}ms  p99={report['p99_ms']}ms",
+        file=out,
+        flush=True,
+    )
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("proxy", help="Base URL of the proxy under test.")
+    parser.add_argument("cassette", help="Cassette file or glob pattern.")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    run_all(args.proxy, args.cassette, args)
+
+
+if __name__ == "__main__":
+    main()
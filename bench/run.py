@@ -0,0 +1,165 @@
+"""Benchmark the proxy end to end, offline.
+
+Starts bench/fake_launchpad.py in-process, launches the proxy under
+uvicorn pointed at it (fresh JWT and Fernet keys, no other configuration
+from the environment is needed) and runs bench/loadgen.py scenarios.
+With --cassette the proxy instead replays a recorded cassette and
+bench/replay.py reissues its /devel traffic. --transport unix serves the
+proxy on a UNIX domain socket, and --transport both runs every scenario
+over TCP loopback and then over a UNIX socket, and compares the two.
+
+    python -m bench.run --latency-ms 30 --jitter-ms 10 -c 16 -d 20 --json out.json
+    python -m bench.run --baseline out.json     # after a change
+    python -m bench.run --cassette 'morning-*.jsonl.gz' --speed 4
+    python -m bench.run --latency-ms 0 --scenario devel --transport both
+"""
+
+import argparse
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from cryptography.fernet import Fernet
+
+from bench import loadgen, replay
+from bench.fake_launchpad import FakeLaunchpad
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Base URL of a proxy on a UNIX socket; loadgen routes it to the socket.
+UNIX_SOCKET_URL = "http://proxy.sock"
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def proxy_environment(launchpad_url, base_url, metrics_dir=None):
+    env = dict(os.environ)
+    env.update(
+        {
+            "PROXY_JWT_SECRET": secrets.token_hex(32),
+            "PROXY_JWT_ENCRYPTION_KEY": Fernet.generate_key().decode(),
+            "PROXY_BASE_URL": base_url,
+        }
+    )
+    if launchpad_url:
+        env["LP_WEB_URL"] = env["LP_API_URL"] = launchpad_url
+    env.pop("PROXY_ALLOWED_ORIGINS", None)
+    if metrics_dir:
+        env["PROXY_METRICS_DIR"] = metrics_dir
+        env["PROXY_METRICS_FLUSH_SECONDS"] = "1"
+    return env
+
+
+def start_proxy(env, port, workers=1, unix_socket=None):
+    """Start the proxy on 127.0.0.1:``port``, or on ``unix_socket`` at the
+    URL UNIX_SOCKET_URL; return ``(process, url)`` once it serves."""
+    command = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--workers", str(workers), "--no-access-log", "--log-level", "warning",
+    ]
+    if unix_socket:
+        command += ["--uds", unix_socket]
+        url = UNIX_SOCKET_URL
+    else:
+        command += ["--host", "127.0.0.1", "--port", str(port)]
+        url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    session = loadgen.new_session(url, unix_socket)
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError(f"proxy exited with {process.returncode}")
+        try:
+            if session.get(f"{url}/oauth2/jwks", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("proxy did not start")
+
+
+def replay_cassette(args):
+    port = _free_port()
+    env = proxy_environment(None, f"http://127.0.0.1:{port}")
+    env["PROXY_UPSTREAM_REPLAY"] = os.path.abspath(args.cassette)
+    env["PROXY_UPSTREAM_REPLAY_SPEED"] = str(args.speed)
+    env.pop("PROXY_UPSTREAM_RECORD", None)
+    process, url = start_proxy(env, port, args.workers)
+    try:
+        replay.run_all(url, args.cassette, args)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--teams", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--transport",
+        choices=("tcp", "unix", "both"),
+        default="tcp",
+        help="Serve the proxy over TCP loopback, a UNIX socket, or compare both.",
+    )
+    parser.add_argument("--cassette", help="Replay this cassette (file or glob) instead.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay time compression.")
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    loadgen.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.cassette:
+        replay_cassette(args)
+        return
+
+    fake = FakeLaunchpad(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        teams=args.teams,
+    ).start()
+    transports = ("tcp", "unix") if args.transport == "both" else (args.transport,)
+    json_path, args.json = args.json, None
+    reports = []
+    try:
+        for transport in transports:
+            with tempfile.TemporaryDirectory() as tmp:
+                port = _free_port()
+                unix_socket = os.path.join(tmp, "proxy.sock") if transport == "unix" else None
+                base_url = UNIX_SOCKET_URL if unix_socket else f"http://127.0.0.1:{port}"
+                env = proxy_environment(
+                    fake.url, base_url, os.path.join(tmp, "metrics") if args.workers > 1 else None
+                )
+                process, url = start_proxy(env, port, args.workers, unix_socket)
+                try:
+                    reports += loadgen.run_all(url, args, unix_socket=unix_socket)
+                finally:
+                    process.terminate()
+                    process.wait()
+    finally:
+        fake.stop()
+    if len(transports) > 1:
+        tcp = {report["scenario"]: report for report in reports if report["transport"] == "tcp"}
+        print("UNIX socket vs TCP loopback:", flush=True)
+        for report in reports:
+            if report["transport"] == "unix":
+                changes = loadgen.compare(report, tcp[report["scenario"]])
+                print(loadgen.format_report(report, changes, "tcp"), flush=True)
+    if json_path:
+        with open(json_path, "w") as fh:
+            json.dump(reports, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
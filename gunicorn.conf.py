@@ -0,0 +1,38 @@
+"""gunicorn settings for lp-api-proxy, read from the working directory:
+
+    gunicorn main:app -k uvicorn.workers.UvicornWorker -b 0.0.0.0:3456 -w 4
+"""
+
+import importlib
+import os
+import sys
+
+# Import main.py once in the master; workers are forked from it and start
+# serving without importing FastAPI and the crypto stack again.
+preload_app = True
+
+
+def on_starting(server):
+    """Load the RSA signing key before the workers are forked, so they all
+    sign with, and publish, the same key even when it is ephemeral."""
+    main = sys.modules.get("main")
+    if main is not None:
+        main._load_signing_key()
+
+
+def on_reload(server):
+    """SIGHUP to the master: re-import main.py with PROXY_ENV_FILE applied,
+    so the workers gunicorn starts to replace the current ones pick up every
+    changed setting, not only those a worker reloads in place. An ephemeral
+    signing key is carried over."""
+    main = sys.modules.get("main")
+    if main is None:
+        return
+    if main.PROXY_ENV_FILE:
+        os.environ.update(main._read_env_file(main.PROXY_ENV_FILE))
+    key = main._rsa_private_key, main._rsa_key_id
+    importlib.reload(main)
+    if not (main.PROXY_RSA_PRIVATE_KEY_PEM or main.PROXY_RSA_PRIVATE_KEY_FILE):
+        main._rsa_private_key, main._rsa_key_id = key
+    main._load_signing_key()
+    server.app.callable = main.app
@@ -6,8 +6,19 @@ APP_DIR="${CHARM_DIR}"
 VENV_DIR="/var/lib/lp-api-proxy/venv"
 STATE_DIR="/var/lib/lp-api-proxy"
 STATE_FILE="${STATE_DIR}/generated-secrets.env"
+RSA_KEY_FILE="${STATE_DIR}/rsa-private-key.pem"
+TLS_CERT_FILE="${STATE_DIR}/tls-certificate.pem"
+TLS_KEY_FILE="${STATE_DIR}/tls-private-key.pem"
+RUNTIME_DIR="/run/lp-api-proxy"
+# Settings a worker applies in place on SIGHUP; keep in sync with
+# RELOADABLE_SETTINGS in main.py (tests/test_config_reload.py checks it).
+RELOADABLE_ENV_KEYS="PROXY_JWT_TTL_SECONDS PROXY_CODE_TTL_SECONDS LOGIN_SESSION_TTL_SECONDS PROXY_ALLOWED_ORIGINS PROXY_CORS_MAX_AGE_SECONDS LP_ALLOW_PERMISSION PROXY_ACCESS_LOG_SAMPLE_RATE PROXY_ACCESS_LOG_SLOW_MS PROXY_USAGE_WINDOW_SECONDS PROXY_QUOTA_REQUESTS PROXY_QUOTA_BYTES PROXY_QUOTA_CONSUMER_REQUESTS PROXY_RESPONSE_CACHE_TTL_SECONDS PROXY_RESPONSE_CACHE_MAX_BYTES PROXY_WARMUP_PATHS PROXY_DELTA_VERSIONS PROXY_DELTA_MAX_BYTES PROXY_ADMISSION_TARGET_MS PROXY_ADMISSION_INTERVAL_MS PROXY_UPSTREAM_CONCURRENCY PROXY_UPSTREAM_IDENTITY_CONCURRENCY PROXY_UPSTREAM_LANE_WEIGHTS PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS"
+RSA_KEY_CHANGED=""
+TLS_CHANGED=""
+SOCKET_CHANGED=""
 ENV_FILE="/etc/lp-api-proxy.env"
 SERVICE_FILE="/etc/systemd/system/lp-api-proxy.service"
+SOCKET_FILE="/etc/systemd/system/lp-api-proxy.socket"
 
 config() {
   config-get "$1"
@@ -39,7 +50,7 @@ effective_base_url() {
   listen_port="$(to_int_string "$(config listen-port)")"
   if [[ -z "${base_url}" ]]; then
     private_addr="$(unit-get private-address)"
-    base_url="http://${private_addr}:${listen_port}"
+    base_url="$(listen_scheme)://${private_addr}:${listen_port}"
   fi
   echo "${base_url}"
 }
@@ -93,6 +104,73 @@ EOF
   chmod 600 "${STATE_FILE}"
 }
 
+write_rsa_key_file() {
+  # All workers sign with the key in RSA_KEY_FILE. When proxy-rsa-private-key
+  # is empty the first process to start generates it there, and it is kept
+  # across restarts and upgrades.
+  local rsa_key
+  rsa_key="$(config proxy-rsa-private-key)"
+  if [[ -n "${rsa_key}" ]]; then
+    ensure_state_dir
+    (umask 077 && printf '%s\n' "${rsa_key}" >"${RSA_KEY_FILE}.tmp")
+    if cmp -s "${RSA_KEY_FILE}.tmp" "${RSA_KEY_FILE}"; then
+      rm -f "${RSA_KEY_FILE}.tmp"
+    else
+      mv "${RSA_KEY_FILE}.tmp" "${RSA_KEY_FILE}"
+      RSA_KEY_CHANGED=1
+    fi
+  fi
+}
+
+tls_enabled() {
+  [[ -n "$(config tls-certificate)" && -n "$(config tls-private-key)" ]]
+}
+
+listen_scheme() {
+  if tls_enabled; then
+    echo https
+  else
+    echo http
+  fi
+}
+
+write_tls_files() {
+  # The server reads the certificate and key from TLS_CERT_FILE and
+  # TLS_KEY_FILE at startup; a changed pair needs a restart.
+  local name value file
+  if ! tls_enabled; then
+    if [[ -f "${TLS_CERT_FILE}" || -f "${TLS_KEY_FILE}" ]]; then
+      rm -f "${TLS_CERT_FILE}" "${TLS_KEY_FILE}"
+      TLS_CHANGED=1
+    fi
+    return
+  fi
+  ensure_state_dir
+  for name in tls-certificate tls-private-key; do
+    value="$(config "${name}")"
+    file="${STATE_DIR}/${name}.pem"
+    (umask 077 && printf '%s\n' "${value}" >"${file}.tmp")
+    if cmp -s "${file}.tmp" "${file}"; then
+      rm -f "${file}.tmp"
+    else
+      mv "${file}.tmp" "${file}"
+      TLS_CHANGED=1
+    fi
+  done
+}
+
+effective_workers() {
+  local workers
+  workers="$(to_int_string "$(config workers)")"
+  if (( workers <= 0 )); then
+    workers="$(nproc)"
+    if (( workers < 2 )); then
+      workers=2
+    fi
+  fi
+  echo "${workers}"
+}
+
 ensure_runtime() {
   apply_proxy_env
   apt-get update -y
@@ -114,6 +192,7 @@ ensure_runtime() {
 
 write_env_file() {
   generate_defaults_if_missing
+  write_rsa_key_file
   # shellcheck disable=SC1090
   source "${STATE_FILE}"
 
@@ -123,7 +202,7 @@ write_env_file() {
   base_url="$(effective_base_url)"
 
   local client_id client_secret jwt_secret jwt_key jwt_issuer jwt_aud jwt_ttl code_ttl session_ttl allowed_origins allow_permission
-  local http_proxy https_proxy no_proxy
+  local http_proxy https_proxy no_proxy access_log access_log_sample_rate cors_max_age
   client_id="$(config proxy-oidc-client-id)"
   client_secret="$(config proxy-oidc-client-secret)"
   jwt_secret="$(config proxy-jwt-secret)"
@@ -134,10 +213,16 @@ write_env_file() {
   code_ttl="$(to_int_string "$(config proxy-code-ttl-seconds)")"
   session_ttl="$(to_int_string "$(config login-session-ttl-seconds)")"
   allowed_origins="$(config allowed-origins)"
+  cors_max_age="$(to_int_string "$(config cors-max-age)")"
   allow_permission="$(config allow-permission)"
   http_proxy="$(config http-proxy)"
   https_proxy="$(config https-proxy)"
   no_proxy="$(config no-proxy)"
+  access_log=""
+  if [[ "$(config json-access-log)" == "True" ]]; then
+    access_log="-"
+  fi
+  access_log_sample_rate="$(config access-log-sample-rate)"
 
   if [[ -z "${jwt_secret}" ]]; then
     jwt_secret="${PROXY_JWT_SECRET}"
@@ -158,6 +243,7 @@ PROXY_JWT_TTL_SECONDS=${jwt_ttl}
 PROXY_CODE_TTL_SECONDS=${code_ttl}
 LOGIN_SESSION_TTL_SECONDS=${session_ttl}
 PROXY_ALLOWED_ORIGINS=${allowed_origins}
+PROXY_CORS_MAX_AGE_SECONDS=${cors_max_age}
 LP_ALLOW_PERMISSION=${allow_permission}
 HTTP_PROXY=${http_proxy}
 HTTPS_PROXY=${https_proxy}
@@ -168,41 +254,262 @@ no_proxy=${no_proxy}
 LP_CONSUMER_KEY=lp-api-proxy
 LP_CONSUMER_SECRET=
 LP_SIGNATURE_METHOD=PLAINTEXT
+PROXY_ACCESS_LOG=${access_log}
+PROXY_ACCESS_LOG_SAMPLE_RATE=${access_log_sample_rate}
+PROXY_RSA_PRIVATE_KEY_FILE=${RSA_KEY_FILE}
+PROXY_METRICS_DIR=${RUNTIME_DIR}/metrics
+PROXY_CACHE_DIR=${RUNTIME_DIR}/cache
+PROXY_PROFILE_DIR=${RUNTIME_DIR}/profiles
 EOF
   chmod 600 "${ENV_FILE}"
 }
 
-write_service_file() {
-  local listen_host listen_port
+listen_address() {
+  # The listen-socket path, or listen-host:listen-port.
+  local listen_socket listen_host listen_port
+  listen_socket="$(config listen-socket)"
+  if [[ -n "${listen_socket}" ]]; then
+    echo "${listen_socket}"
+    return
+  fi
   listen_host="$(config listen-host)"
   listen_port="$(to_int_string "$(config listen-port)")"
+  if [[ "${listen_host}" == *:* ]]; then
+    echo "[${listen_host}]:${listen_port}"
+  else
+    echo "${listen_host}:${listen_port}"
+  fi
+}
+
+socket_group_id() {
+  # The group owning listen-socket, created if missing: only its members
+  # (the reverse proxy in front) and root may connect.
+  local group
+  group="$(config listen-socket-group)"
+  if ! getent group "${group}" >/dev/null; then
+    groupadd --system "${group}"
+  fi
+  getent group "${group}" | cut -d: -f3
+}
+
+write_socket_file() {
+  # With socket-activation systemd owns the listening socket and hands it to
+  # gunicorn, so the socket and the connections queued in its backlog
+  # survive service restarts.
+  local backlog old_socket socket_access
+  old_socket="$(cat "${SOCKET_FILE}" 2>/dev/null || true)"
+  if [[ "$(config socket-activation)" != "True" ]]; then
+    if [[ -n "${old_socket}" ]]; then
+      systemctl disable --now lp-api-proxy.socket || true
+      rm -f "${SOCKET_FILE}"
+      SOCKET_CHANGED=1
+    fi
+    return
+  fi
+  backlog="$(to_int_string "$(config backlog)")"
+  socket_access=""
+  if [[ -n "$(config listen-socket)" ]]; then
+    socket_access=$'\n'"SocketMode=0660"$'\n'"SocketGroup=$(config listen-socket-group)"
+    socket_group_id >/dev/null
+  fi
+
+  cat >"${SOCKET_FILE}" <<EOF
+[Unit]
+Description=lp-api-proxy listening socket
+
+[Socket]
+ListenStream=$(listen_address)
+Backlog=${backlog}${socket_access}
+
+[Install]
+WantedBy=sockets.target
+EOF
+  if [[ "$(cat "${SOCKET_FILE}")" != "${old_socket}" ]]; then
+    SOCKET_CHANGED=1
+  fi
+}
+
+server_command() {
+  # The ExecStart command line of the configured server.
+  local bind workers worker_class max_requests max_requests_jitter keep_alive backlog access_log_flag forwarded_flag socket_flags tls_flags forwarded_allow_ips
+  bind="$(listen_address)"
+  socket_flags=""
+  if [[ -n "$(config listen-socket)" ]]; then
+    bind="unix:${bind}"
+    if [[ "$(config socket-activation)" != "True" ]]; then
+      # Created by the server itself: mode 0660, owned by listen-socket-group.
+      socket_flags=" --umask $((8#117)) --group $(socket_group_id)"
+    fi
+  fi
+  # X-Forwarded-* headers are only trusted from the configured front proxies.
+  forwarded_allow_ips="$(config forwarded-allow-ips)"
+  forwarded_flag=""
+  if [[ -n "${forwarded_allow_ips}" ]]; then
+    forwarded_flag=" --forwarded-allow-ips=${forwarded_allow_ips}"
+  fi
+  workers="$(effective_workers)"
+  keep_alive="$(to_int_string "$(config keep-alive)")"
+  backlog="$(to_int_string "$(config backlog)")"
+  # Neither server writes an access log unless asked to; the JSON access
+  # log replaces it.
+  access_log_flag=" --access-logfile -"
+  if [[ "$(config json-access-log)" == "True" ]]; then
+    access_log_flag=""
+  fi
+  tls_flags=""
+  if tls_enabled; then
+    tls_flags=" --certfile ${TLS_CERT_FILE} --keyfile ${TLS_KEY_FILE}"
+  fi
+
+  case "$(config server)" in
+    gunicorn)
+      worker_class="$(config worker-class)"
+      max_requests="$(to_int_string "$(config max-requests)")"
+      max_requests_jitter="$(to_int_string "$(config max-requests-jitter)")"
+      echo "${VENV_DIR}/bin/gunicorn main:app --config ${APP_DIR}/gunicorn.conf.py --worker-class ${worker_class} --workers ${workers} --bind ${bind} --max-requests ${max_requests} --max-requests-jitter ${max_requests_jitter} --keep-alive ${keep_alive} --backlog ${backlog}${socket_flags}${forwarded_flag}${access_log_flag}${tls_flags}"
+      ;;
+    hypercorn)
+      # HTTP/2: h2 over TLS, h2c in the clear. systemd passes an activated
+      # socket as file descriptor 3.
+      if [[ "$(config socket-activation)" == "True" ]]; then
+        bind="fd://3"
+      fi
+      if [[ -n "${socket_flags}" ]]; then
+        # hypercorn only changes the owner of a socket given both ids.
+        socket_flags=" --user 0${socket_flags}"
+      fi
+      echo "${VENV_DIR}/bin/hypercorn main:app --config file:${APP_DIR}/hypercorn.conf.py --workers ${workers} --bind ${bind} --keep-alive ${keep_alive} --backlog ${backlog}${socket_flags}${access_log_flag}${tls_flags}"
+      ;;
+    *)
+      return 1
+      ;;
+  esac
+}
+
+write_service_file() {
+  local exec_start exec_reload socket_deps
+  if ! exec_start="$(server_command)"; then
+    status-set blocked "unknown server '$(config server)', expected gunicorn or hypercorn"
+    exit 0
+  fi
+  # SIGHUP to the gunicorn master replaces its workers; hypercorn has no
+  # such reload and is restarted instead (see apply_config_changes).
+  exec_reload=""
+  if [[ "$(config server)" == "gunicorn" ]]; then
+    exec_reload=$'\n'"ExecReload=/bin/kill -HUP \$MAINPID"
+  fi
+  socket_deps=""
+  if [[ "$(config socket-activation)" == "True" ]]; then
+    socket_deps=$'\nRequires=lp-api-proxy.socket\nAfter=lp-api-proxy.socket'
+  fi
+  write_tls_files
 
   cat >"${SERVICE_FILE}" <<EOF
 [Unit]
 Description=lp-api-proxy service
 After=network-online.target
-Wants=network-online.target
+Wants=network-online.target${socket_deps}
 
 [Service]
 Type=simple
 WorkingDirectory=${APP_DIR}
 EnvironmentFile=${ENV_FILE}
-ExecStart=${VENV_DIR}/bin/uvicorn main:app --host ${listen_host} --port ${listen_port}
+Environment=PROXY_ENV_FILE=${ENV_FILE}
+RuntimeDirectory=lp-api-proxy
+RuntimeDirectoryMode=0700
+ExecStart=${exec_start}${exec_reload}
 Restart=always
 RestartSec=3
 
 [Install]
 WantedBy=multi-user.target
 EOF
+  write_socket_file
 }
 
 reload_and_restart_service() {
   local listen_port
   listen_port="$(to_int_string "$(config listen-port)")"
   systemctl daemon-reload
+  if [[ "$(config socket-activation)" == "True" ]]; then
+    systemctl enable lp-api-proxy.socket
+    if [[ -n "${SOCKET_CHANGED}" ]]; then
+      # The service holds the old socket; stop it before rebinding.
+      systemctl stop lp-api-proxy.service || true
+      systemctl restart lp-api-proxy.socket
+    else
+      systemctl start lp-api-proxy.socket
+    fi
+  fi
   systemctl enable lp-api-proxy.service
   systemctl restart lp-api-proxy.service
-  open-port "${listen_port}/tcp"
+  if [[ -n "$(config listen-socket)" ]]; then
+    close-port "${listen_port}/tcp" || true
+  else
+    open-port "${listen_port}/tcp"
+  fi
+}
+
+changed_env_keys() {
+  # Keys whose value differs between the env file contents $1 and ENV_FILE.
+  python3 - "$1" "${ENV_FILE}" <<'PY'
+import sys
+
+def parse(text):
+    return dict(line.split("=", 1) for line in text.splitlines() if "=" in line)
+
+old = parse(sys.argv[1])
+with open(sys.argv[2]) as fh:
+    new = parse(fh.read())
+print(" ".join(sorted(key for key in old.keys() | new.keys() if old.get(key) != new.get(key))))
+PY
+}
+
+reload_service() {
+  # Replace the workers so that they start with the new environment:
+  # gracefully under gunicorn, by a restart under hypercorn.
+  if [[ "$(config server)" == "gunicorn" ]]; then
+    systemctl reload lp-api-proxy.service
+  else
+    systemctl restart lp-api-proxy.service
+  fi
+}
+
+apply_config_changes() {
+  # Apply rewritten env and service files the cheapest way, given their
+  # previous contents $1 and $2:
+  # - only reloadable settings changed: SIGHUP the workers, which apply them
+  #   in place;
+  # - other settings or the signing key changed: reload the service, i.e.
+  #   SIGHUP the gunicorn master, which gracefully replaces the workers;
+  # - the service, its socket or the TLS certificate changed, or it is not
+  #   running: restart it.
+  local old_env="$1" old_service="$2" key main_pid
+  if [[ "$(cat "${SERVICE_FILE}")" != "${old_service}" || -n "${SOCKET_CHANGED}" || -n "${TLS_CHANGED}" ]] \
+    || ! systemctl is-active --quiet lp-api-proxy.service; then
+    reload_and_restart_service
+    return
+  fi
+  if [[ -n "${RSA_KEY_CHANGED}" ]]; then
+    reload_service
+    return
+  fi
+  for key in $(changed_env_keys "${old_env}"); do
+    if [[ " ${RELOADABLE_ENV_KEYS} " != *" ${key} "* ]]; then
+      reload_service
+      return
+    fi
+  done
+  if [[ "$(cat "${ENV_FILE}")" != "${old_env}" ]]; then
+    main_pid="$(systemctl show --property MainPID --value lp-api-proxy.service)"
+    if [[ "$(config server)" == "hypercorn" ]]; then
+      # Its workers are multiprocessing children; other helper processes
+      # must not get the signal.
+      pkill -HUP --parent "${main_pid}" --full spawn_main || true
+    else
+      pkill -HUP --parent "${main_pid}" || true
+    fi
+  fi
 }
 
 stop_service() {
@@ -210,5 +517,6 @@ stop_service() {
   listen_port="$(to_int_string "$(config listen-port)")"
   systemctl stop lp-api-proxy.service || true
   systemctl disable lp-api-proxy.service || true
+  systemctl disable --now lp-api-proxy.socket 2>/dev/null || true
   close-port "${listen_port}/tcp" || true
 }
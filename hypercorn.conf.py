@@ -0,0 +1,22 @@
+"""hypercorn settings for serving lp-api-proxy over HTTP/2, read with:
+
+    hypercorn main:app --config file:hypercorn.conf.py -b 0.0.0.0:3456 -w 4 \
+        --keep-alive 75 [--certfile cert.pem --keyfile key.pem]
+
+With a certificate, browsers negotiate h2 through TLS ALPN and fall back to
+HTTP/1.1. Without one, h2c is served to clients that speak it with prior
+knowledge or ask for it with "Upgrade: h2c", and HTTP/1.1 to the others.
+Command line options override the values below.
+"""
+
+alpn_protocols = ["h2", "http/1.1"]
+
+# Parallel /devel/* calls of one browser tab share a connection as streams.
+h2_max_concurrent_streams = 100
+
+# Seconds a worker waits for requests in flight on shutdown, as gunicorn's
+# default graceful timeout.
+graceful_timeout = 30
+
+# The JSON access log (PROXY_ACCESS_LOG) replaces hypercorn's.
+accesslog = None
@@ -1,22 +1,46 @@
-from fastapi import FastAPI, HTTPException, Form, Header, Request, Query
+from fastapi import FastAPI, HTTPException, Form, Header, Request, Query, Body
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import (
     FileResponse,
     PlainTextResponse,
     RedirectResponse,
     JSONResponse,
+    Response,
 )
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 # from starlette.middleware.base import BaseHTTPMiddleware
 from typing import Annotated, Optional, Union
+import asyncio
+import atexit
 import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import email.utils
+import functools
+import glob
+import gzip
 import hashlib
+import heapq
 import hmac
+import http.cookiejar
 import json
+import logging
+import math
 import os
+import queue
+import random
 import secrets
+import signal
+import sys
+import threading
 import time
+import traceback
 import urllib.parse
 import warnings
 import re
@@ -24,13 +48,1311 @@ import re
 import jwt
 import requests
 from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives.asymmetric import rsa as _rsa_gen
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
 
-LAUNCHPAD_URL = "https://launchpad.net"
-LAUNCHPAD_API = "https://api.launchpad.net"
+# Optional binary response formats (see "Response formats").
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Launchpad web and API roots. Point them at a Launchpad instance such as
+# qastaging, or at bench/fake_launchpad.py for offline benchmarks.
+#
+#   LP_WEB_URL   Web root serving the OAuth token endpoints
+#                 (default: "https://launchpad.net").
+#   LP_API_URL   API root serving /devel (default: "https://api.launchpad.net").
+
+LAUNCHPAD_URL = os.environ.get("LP_WEB_URL", "https://launchpad.net").rstrip("/")
+LAUNCHPAD_API = os.environ.get("LP_API_URL", "https://api.launchpad.net").rstrip("/")
 STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 
+_LOGGER = logging.getLogger("lp_api_proxy")
+
+
+# --- Metrics ---------------------------------------------------------------
+#
+# A small Prometheus registry (text exposition format 0.0.4) served on
+# /metrics. Recording is a lock plus a few dict operations, cheap enough to
+# leave on in production.
+#
+# Under gunicorn every worker has its own registry. With PROXY_METRICS_DIR
+# set, each worker periodically writes a snapshot to that directory and
+# /metrics merges all of them, whichever worker serves the scrape: counters
+# and histograms are summed (those of exited workers are folded into an
+# archive file so totals never go backwards), gauges are summed over live
+# workers only.
+#
+#   PROXY_METRICS_ENABLED        "0" removes /metrics (default: "1").
+#   PROXY_METRICS_DIR            Shared directory for multi-worker aggregation
+#                                 (default: unset, single process).
+#   PROXY_METRICS_FLUSH_SECONDS  Snapshot interval with PROXY_METRICS_DIR
+#                                 (default: 5).
+
+PROXY_METRICS_ENABLED = os.environ.get("PROXY_METRICS_ENABLED", "1") != "0"
+PROXY_METRICS_DIR = os.environ.get("PROXY_METRICS_DIR", "")
+PROXY_METRICS_FLUSH_SECONDS = float(os.environ.get("PROXY_METRICS_FLUSH_SECONDS", "5"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # callback() -> iterable of (labels, value), evaluated at collection.
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._values = {}
+        _METRICS.append(self)
+
+    def samples(self):
+        if self.callback is not None:
+            return [[list(labels), value] for labels, value in self.callback()]
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class _Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class _Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class _Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            return [
+                [list(labels), [list(counts), total, count]]
+                for labels, (counts, total, count) in self._values.items()
+            ]
+
+
+_METRICS = []
+
+PROCESS_CPU = _Counter(
+    "process_cpu_seconds_total",
+    "User and system CPU time of the worker process.",
+    callback=lambda: [((), round(time.process_time(), 6))],
+)
+HTTP_REQUESTS = _Counter(
+    "lp_proxy_http_requests_total", "HTTP requests served.", ("route", "method", "status")
+)
+HTTP_DURATION = _Histogram(
+    "lp_proxy_http_request_duration_seconds", "HTTP request latency.", ("route", "method")
+)
+HTTP_IN_FLIGHT = _Gauge("lp_proxy_http_requests_in_flight", "HTTP requests in progress.", ("route",))
+HTTP_RESPONSE_BYTES = _Counter(
+    "lp_proxy_http_response_bytes_total", "HTTP response body bytes sent.", ("route",)
+)
+UPSTREAM_RESPONSES = _Counter(
+    "lp_proxy_upstream_responses_total",
+    "Launchpad responses by status ('error' for timeouts and connection errors).",
+    ("host", "endpoint", "status"),
+)
+UPSTREAM_DURATION = _Histogram(
+    "lp_proxy_upstream_request_duration_seconds",
+    "Launchpad request latency per attempt.",
+    ("host", "endpoint"),
+)
+UPSTREAM_IN_FLIGHT = _Gauge(
+    "lp_proxy_upstream_requests_in_flight", "Launchpad requests in progress.", ("host",)
+)
+STAGE_DURATION = _Histogram(
+    "lp_proxy_stage_duration_seconds",
+    "CPU-bound stages: JWT verify/sign, credential encrypt/decrypt, RSA and OAuth signing, "
+    "response body processing.",
+    ("stage",),
+    buckets=STAGE_BUCKETS,
+)
+
+
+TRACE_SPANS = _Counter(
+    "lp_proxy_trace_spans_total",
+    "Trace spans by export result (exported, dropped, failed).",
+    ("result",),
+)
+
+
+class _stage:
+    """Time one internal stage of a request: ``with _stage("jwt_verify"):``.
+    Within a sampled trace the stage is also recorded as a child span."""
+
+    __slots__ = ("name", "started", "span", "token")
+
+    def __init__(self, name):
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        parent = _CURRENT_SPAN.get()
+        if parent is not None:
+            self.span = parent.child(self.name)
+            self.token = _CURRENT_SPAN.set(self.span)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        STAGE_DURATION.observe(elapsed, (self.name,))
+        _record_timing(_SERVER_TIMING_STAGES.get(self.name, self.name), elapsed)
+        if self.span is not None:
+            _CURRENT_SPAN.reset(self.token)
+            self.span.end(error=exc_type.__name__ if exc_type else None)
+        return False
+
+
+_METRIC_ROUTE_PREFIXES = (
+    ("/devel/", "/devel/*"),
+    ("/admin/", "/admin/*"),
+)
+
+# Every other route is its own label; any other path is "other", so that
+# requests to made-up paths do not create new series.
+_METRIC_ROUTES = frozenset({
+    "/",
+    "/docs",
+    "/docs/oauth2-redirect",
+    "/openapi.json",
+    "/example.html",
+    "/metrics",
+    "/healthz",
+    "/readyz",
+    "/+request-token",
+    "/+authorize-token",
+    "/+access-token",
+    "/.well-known/openid-configuration",
+    "/oauth2/jwks",
+    "/oauth2/login",
+    "/oauth2/callback",
+    "/oauth2/token",
+    "/oauth2/userinfo",
+})
+
+
+def _metrics_route(path):
+    """Bounded route label for a request path."""
+    for prefix, label in _METRIC_ROUTE_PREFIXES:
+        if path.startswith(prefix):
+            return label
+    if path in _METRIC_ROUTES:
+        return path
+    return "other"
+
+
+def _upstream_endpoint(url, params=None):
+    """Bounded endpoint class label for a Launchpad URL."""
+    path = urllib.parse.urlsplit(url).path
+    if path.startswith("/+"):
+        return path[1:]
+    if path.endswith("/people/+me"):
+        return "people/+me"
+    if path.endswith("_collection") or "/+" in path or "memberships" in path:
+        return "collection"
+    params = params or {}
+    if "ws.op" in params:
+        return "named-op"
+    if "ws.start" in params or "ws.size" in params:
+        return "collection"
+    return "resource"
+
+
+def _metrics_snapshot():
+    return {
+        metric.name: {
+            "kind": metric.kind,
+            "documentation": metric.documentation,
+            "labelnames": list(metric.labelnames),
+            "buckets": list(getattr(metric, "buckets", ())),
+            "samples": metric.samples(),
+        }
+        for metric in _METRICS
+    }
+
+
+def _merge_snapshots(snapshots, gauges=True):
+    merged = {}
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            if family["kind"] == "gauge" and not gauges:
+                continue
+            target = merged.setdefault(name, {**family, "samples": {}})
+            for labels, value in family["samples"]:
+                key = tuple(labels)
+                current = target["samples"].get(key)
+                if current is None:
+                    target["samples"][key] = value
+                elif family["kind"] == "histogram":
+                    target["samples"][key] = [
+                        [a + b for a, b in zip(current[0], value[0])],
+                        current[1] + value[1],
+                        current[2] + value[2],
+                    ]
+                else:
+                    target["samples"][key] = current + value
+    for family in merged.values():
+        family["samples"] = [[list(k), v] for k, v in family["samples"].items()]
+    return merged
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{v}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _render_metrics(snapshot):
+    lines = []
+    for name, family in snapshot.items():
+        lines.append(f"# HELP {name} {family['documentation']}")
+        lines.append(f"# TYPE {name} {family['kind']}")
+        names = family["labelnames"]
+        for labels, value in family["samples"]:
+            if family["kind"] != "histogram":
+                lines.append(f"{name}{_format_labels(names, labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(family["buckets"]) + ["+Inf"], counts):
+                cumulative += bucket_count
+                le = bound if bound == "+Inf" else repr(float(bound))
+                lines.append(
+                    f"{name}_bucket{_format_labels(names, labels, [('le', le)])} {cumulative}"
+                )
+            lines.append(f"{name}_sum{_format_labels(names, labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(names, labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write_json_atomically(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(data, fh)
+    os.replace(tmp, path)
+
+
+def _flush_metrics():
+    if PROXY_METRICS_DIR:
+        _write_json_atomically(
+            os.path.join(PROXY_METRICS_DIR, f"metrics-{os.getpid()}.json"), _metrics_snapshot()
+        )
+
+
+def _collect_metrics():
+    """Snapshot of this worker, or of all workers with PROXY_METRICS_DIR."""
+    if not PROXY_METRICS_DIR:
+        return _metrics_snapshot()
+    import fcntl
+
+    _flush_metrics()
+    archive_path = os.path.join(PROXY_METRICS_DIR, "metrics-archive.json")
+    with open(os.path.join(PROXY_METRICS_DIR, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(archive_path) as fh:
+                archive = json.load(fh)
+        except (OSError, ValueError):
+            archive = {}
+        live, dead = [], []
+        for path in glob.glob(os.path.join(PROXY_METRICS_DIR, "metrics-[0-9]*.json")):
+            pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+            try:
+                with open(path) as fh:
+                    snapshot = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            (live if _pid_alive(pid) else dead).append((path, snapshot))
+        if dead:
+            archive = _merge_snapshots([archive] + [snap for _, snap in dead], gauges=False)
+            _write_json_atomically(archive_path, archive)
+            for path, _ in dead:
+                os.unlink(path)
+    counters = _merge_snapshots([archive] + [snap for _, snap in live], gauges=False)
+    gauges = _merge_snapshots([snap for _, snap in live])
+    return {**counters, **{n: f for n, f in gauges.items() if f["kind"] == "gauge"}}
+
+
+_metrics_flusher = None
+
+
+def _ensure_metrics_flusher():
+    global _metrics_flusher
+    if not PROXY_METRICS_DIR or _metrics_flusher is not None:
+        return
+
+    def _loop():
+        while True:
+            time.sleep(PROXY_METRICS_FLUSH_SECONDS)
+            try:
+                _flush_metrics()
+            except OSError:
+                pass
+
+    os.makedirs(PROXY_METRICS_DIR, exist_ok=True)
+    _metrics_flusher = threading.Thread(target=_loop, name="lp-metrics-flush", daemon=True)
+    _metrics_flusher.start()
+
+
+# --- Tracing ---------------------------------------------------------------
+#
+# Optional OpenTelemetry tracing, exported as OTLP/HTTP JSON to a collector.
+# A sampled request gets a server span (continuing an incoming W3C
+# traceparent), a child span for every stage timed with _stage() and a
+# client span for every attempt sent to Launchpad. Finished spans are queued
+# in memory and posted in batches by a background thread; when the queue is
+# full, spans are dropped and counted. An unsampled request costs one
+# context variable lookup per stage.
+#
+#   PROXY_OTLP_ENDPOINT            Collector base URL, e.g.
+#                                   "http://localhost:4318"; enables tracing
+#                                   (default: OTEL_EXPORTER_OTLP_ENDPOINT).
+#   PROXY_OTLP_HEADERS             Extra export headers, "key=value,...".
+#   PROXY_TRACE_SAMPLE_RATIO       Fraction of new traces sampled (default:
+#                                   1.0). The sampled flag of an incoming
+#                                   traceparent always wins.
+#   PROXY_OTLP_EXPORT_INTERVAL_SECONDS  Max delay before export (default: 5).
+#   OTEL_SERVICE_NAME              service.name (default: "lp-api-proxy").
+
+PROXY_OTLP_ENDPOINT = os.environ.get(
+    "PROXY_OTLP_ENDPOINT", os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+).rstrip("/")
+PROXY_OTLP_HEADERS = dict(
+    item.strip().split("=", 1)
+    for item in os.environ.get("PROXY_OTLP_HEADERS", "").split(",")
+    if "=" in item
+)
+PROXY_TRACE_SAMPLE_RATIO = float(os.environ.get("PROXY_TRACE_SAMPLE_RATIO", "1.0"))
+PROXY_OTLP_EXPORT_INTERVAL_SECONDS = float(
+    os.environ.get("PROXY_OTLP_EXPORT_INTERVAL_SECONDS", "5")
+)
+OTEL_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "lp-api-proxy")
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+_TRACEPARENT_RE = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+
+def _parse_traceparent(value):
+    """Return ``(trace_id, parent_span_id, sampled)`` or None if invalid."""
+    match = _TRACEPARENT_RE.match(value.strip().lower())
+    if not match:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class _Span:
+    __slots__ = (
+        "trace_id", "span_id", "parent_id", "name", "kind", "attributes", "start", "error"
+    )
+
+    def __init__(self, name, trace_id, parent_id=None, kind=SPAN_KIND_INTERNAL, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time.time_ns()
+
+    def child(self, name, kind=SPAN_KIND_INTERNAL, attributes=None):
+        return _Span(name, self.trace_id, self.span_id, kind, attributes)
+
+    def end(self, error=None):
+        if error:
+            self.error = error
+        _TRACE_EXPORTER.enqueue(self, time.time_ns())
+
+    def to_otlp(self, end):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(end),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error:
+            span["status"] = {"code": 2, "message": self.error}
+        return span
+
+
+_CURRENT_SPAN = contextvars.ContextVar("lp_api_proxy_span", default=None)
+
+
+def _start_server_span(name, headers, attributes):
+    """Root span of a request, or None if the request is not sampled."""
+    if not PROXY_OTLP_ENDPOINT:
+        return None
+    parent = None
+    for header, value in headers:
+        if header == b"traceparent":
+            parent = _parse_traceparent(value.decode("latin-1"))
+            break
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id = secrets.token_hex(16), None
+        sampled = random.random() < PROXY_TRACE_SAMPLE_RATIO
+    if not sampled:
+        return None
+    return _Span(name, trace_id, parent_id, SPAN_KIND_SERVER, attributes)
+
+
+def _start_span(name, kind=SPAN_KIND_INTERNAL, attributes=None):
+    """Child of the current span, or None outside a sampled trace."""
+    parent = _CURRENT_SPAN.get()
+    if parent is None:
+        return None
+    return parent.child(name, kind, attributes)
+
+
+@contextlib.contextmanager
+def _span(name, attributes=None):
+    """``with _span("lp_fetch_groups"):`` -- a span enclosing nested spans."""
+    span = _start_span(name, attributes=attributes)
+    if span is None:
+        yield None
+        return
+    token = _CURRENT_SPAN.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.error = type(exc).__name__
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        span.end()
+
+
+class _SpanExporter:
+    """Batches finished spans and posts them to {endpoint}/v1/traces."""
+
+    MAX_QUEUE = 2048
+    BATCH_SIZE = 512
+
+    def __init__(self, endpoint, headers, interval):
+        self.url = f"{endpoint}/v1/traces"
+        self.headers = headers
+        self.interval = interval
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def enqueue(self, span, end):
+        with self._lock:
+            if len(self._queue) >= self.MAX_QUEUE:
+                TRACE_SPANS.inc(("dropped",))
+                return
+            self._queue.append((span, end))
+            full = len(self._queue) >= self.BATCH_SIZE
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="lp-trace-export", daemon=True
+                )
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        while True:
+            with self._lock:
+                count = min(len(self._queue), self.BATCH_SIZE)
+                batch = [self._queue.popleft() for _ in range(count)]
+            if not batch:
+                return
+            self._export(batch)
+
+    def _export(self, batch):
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": OTEL_SERVICE_NAME}},
+                            {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "lp-api-proxy"},
+                            "spans": [span.to_otlp(end) for span, end in batch],
+                        }
+                    ],
+                }
+            ]
+        }
+        try:
+            response = requests.post(self.url, json=body, headers=self.headers, timeout=10)
+            ok = response.status_code < 300
+        except requests.RequestException:
+            ok = False
+        TRACE_SPANS.inc(("exported" if ok else "failed",), len(batch))
+
+
+_TRACE_EXPORTER = _SpanExporter(
+    PROXY_OTLP_ENDPOINT, PROXY_OTLP_HEADERS, PROXY_OTLP_EXPORT_INTERVAL_SECONDS
+)
+if PROXY_OTLP_ENDPOINT:
+    atexit.register(_TRACE_EXPORTER.flush)
+
+
+# --- Server-Timing ---------------------------------------------------------
+#
+# Every response carries a Server-Timing header with the time this request
+# spent in each stage, so clients can tell where their latency goes:
+#
+#   auth      Bearer JWT verification and OAuth 1.0a signing
+#   decrypt   Launchpad credential decryption
+#   encrypt   Launchpad credential encryption (login callback)
+#   sign      JWT and id_token signing
+#   queue     Waiting for an upstream scheduler slot
+#   upstream  Launchpad calls, retries included
+#   body      Decoding and re-encoding the Launchpad response
+#   cache     Response cache hit or miss, when a cache was consulted
+#   total     Everything up to the first response byte
+#
+#   PROXY_SERVER_TIMING   "0" disables the header (default: "1").
+
+PROXY_SERVER_TIMING = os.environ.get("PROXY_SERVER_TIMING", "1") != "0"
+
+_SERVER_TIMING_STAGES = {
+    "jwt_verify": "auth",
+    "oauth1_sign": "auth",
+    "credential_decrypt": "decrypt",
+    "credential_encrypt": "encrypt",
+    "jwt_sign": "sign",
+    "rsa_sign": "sign",
+    "body": "body",
+}
+
+
+def _record_timing(name, seconds):
+    context = _REQUEST_CONTEXT.get()
+    if context is not None and context.timings is not None:
+        context.timings[name] = context.timings.get(name, 0.0) + seconds
+
+
+def _server_timing_header(context, total):
+    parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in context.timings.items()]
+    if context.cache:
+        parts.append(f'cache;desc="{context.cache}"')
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+# --- Sampling profiler -----------------------------------------------------
+#
+# An admin can profile one worker for T seconds, or its next N requests
+# (POST /admin/profile), or a single request by sending the admin token in
+# X-LP-Proxy-Profile. While a profile is collecting, a background thread
+# samples the Python stacks of all threads every PROXY_PROFILE_INTERVAL_MS;
+# idle threads (event loop select, threadpool workers waiting for work) are
+# left out unless asked for. Samples of concurrent requests served by the
+# same worker end up in a request profile too. No thread runs and nothing is
+# sampled while no profile is collecting.
+#
+# Finished profiles are downloaded from GET /admin/profile/<id> as collapsed
+# stacks (flamegraph.pl, speedscope, Grafana) or speedscope JSON. With
+# PROXY_PROFILE_DIR set they are also written there, so that any worker
+# sharing the directory can serve them.
+#
+#   PROXY_PROFILE_INTERVAL_MS   Sampling interval (default: 5).
+#   PROXY_PROFILE_DIR           Directory for finished profiles (default:
+#                                unset, kept in the worker's memory only).
+
+PROXY_PROFILE_INTERVAL_MS = float(os.environ.get("PROXY_PROFILE_INTERVAL_MS", "5"))
+PROXY_PROFILE_DIR = os.environ.get("PROXY_PROFILE_DIR", "")
+MAX_PROFILE_SECONDS = 300
+MAX_PROFILE_REQUESTS = 1000
+MAX_STACK_DEPTH = 128
+
+# Leaf frames of threads that are waiting for work rather than running.
+_IDLE_LEAVES = frozenset(
+    {
+        ("selectors.py", "select"),
+        ("threading.py", "wait"),
+        ("queue.py", "get"),
+        ("thread.py", "_worker"),
+    }
+)
+
+
+def _frame_label(frame):
+    name, filename, line = frame
+    short = "/".join(filename.replace("\\", "/").split("/")[-2:])
+    return f"{name} ({short}:{line})"
+
+
+class _Profile:
+    def __init__(self, profile_id, interval, *, seconds=None, requests=None, idle=False):
+        self.id = profile_id
+        self.interval = interval
+        self.idle = idle
+        self.started = time.time()
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.remaining = requests or 0
+        self.in_flight = 0
+        self.finished = None
+        self.samples = 0
+        self.stacks = collections.Counter()
+
+    def collecting(self):
+        return self.deadline is not None or self.in_flight > 0
+
+    def add(self, stacks):
+        for thread, frames, idle in stacks:
+            if idle and not self.idle:
+                continue
+            self.stacks[(thread, frames)] += 1
+            self.samples += 1
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "status": "finished" if self.finished else "running",
+            "started": self.started,
+            "finished": self.finished,
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "requests_remaining": self.remaining,
+        }
+
+    def to_dict(self):
+        return {
+            **self.summary(),
+            "stacks": [[thread, list(frames), count] for (thread, frames), count in self.stacks.items()],
+        }
+
+    def collapsed(self):
+        return "".join(
+            f"{';'.join([thread] + [_frame_label(f) for f in frames])} {count}\n"
+            for (thread, frames), count in sorted(self.stacks.items())
+        )
+
+    def speedscope(self):
+        frame_index = {}
+        profiles = {}
+        for (thread, frames), count in self.stacks.items():
+            indexes = [frame_index.setdefault(tuple(f), len(frame_index)) for f in frames]
+            profile = profiles.setdefault(thread, {"samples": [], "weights": []})
+            profile["samples"].append(indexes)
+            profile["weights"].append(count * self.interval * 1000)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"lp-api-proxy profile {self.id}",
+            "exporter": "lp-api-proxy",
+            "activeProfileIndex": 0,
+            "shared": {
+                "frames": [
+                    {"name": name, "file": filename, "line": line}
+                    for name, filename, line in frame_index
+                ]
+            },
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": thread,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": sum(profile["weights"]),
+                    **profile,
+                }
+                for thread, profile in sorted(profiles.items())
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        profile = cls(data["id"], data["interval_ms"] / 1000)
+        profile.started = data["started"]
+        profile.finished = data["finished"]
+        profile.samples = data["samples"]
+        for thread, frames, count in data["stacks"]:
+            profile.stacks[(thread, tuple(tuple(f) for f in frames))] = count
+        return profile
+
+
+class _Profiler:
+    KEEP = 8
+
+    def __init__(self, interval):
+        self.interval = interval
+        # The profile claiming the next requests; read without the lock by
+        # the middleware on every request.
+        self.armed = None
+        self._lock = threading.Lock()
+        self._active = []
+        self._profiles = collections.OrderedDict()
+        self._thread = None
+        self._counter = 0
+
+    def _create(self, **kwargs):
+        self._counter += 1
+        profile = _Profile(f"{os.getpid()}-{self._counter}", self.interval, **kwargs)
+        self._profiles[profile.id] = profile
+        while len(self._profiles) > self.KEEP:
+            self._profiles.popitem(last=False)
+        self._active.append(profile)
+        return profile
+
+    def start(self, *, seconds=None, requests=None, idle=False):
+        with self._lock:
+            profile = self._create(seconds=seconds, requests=requests, idle=idle)
+            if requests:
+                if self.armed is not None:
+                    self._finish(self.armed)
+                self.armed = profile
+            self._ensure_thread()
+        return profile
+
+    def claim(self, headers):
+        """The profile a new request is recorded in, if any."""
+        profile = self.armed
+        if profile is None and PROXY_ADMIN_TOKEN:
+            for name, value in headers:
+                if name == b"x-lp-proxy-profile":
+                    if hmac.compare_digest(value, PROXY_ADMIN_TOKEN.encode()):
+                        with self._lock:
+                            return self._create()
+                    break
+        if profile is None:
+            return None
+        with self._lock:
+            if self.armed is not profile:
+                return None
+            profile.remaining -= 1
+            if profile.remaining <= 0:
+                self.armed = None
+            return profile
+
+    def attach(self, profile):
+        with self._lock:
+            profile.in_flight += 1
+            self._ensure_thread()
+
+    def detach(self, profile):
+        with self._lock:
+            profile.in_flight -= 1
+            if profile.in_flight == 0 and profile.remaining <= 0:
+                self._finish(profile)
+
+    def get(self, profile_id):
+        profile = self._profiles.get(profile_id)
+        if profile is None and PROXY_PROFILE_DIR and re.fullmatch(r"[0-9]+-[0-9]+", profile_id):
+            try:
+                with open(os.path.join(PROXY_PROFILE_DIR, f"profile-{profile_id}.json")) as fh:
+                    profile = _Profile.from_dict(json.load(fh))
+            except (OSError, ValueError):
+                return None
+        return profile
+
+    def summaries(self):
+        return [profile.summary() for profile in reversed(self._profiles.values())]
+
+    def _finish(self, profile):
+        if profile.finished:
+            return
+        profile.finished = time.time()
+        if profile in self._active:
+            self._active.remove(profile)
+        if self.armed is profile:
+            self.armed = None
+        if PROXY_PROFILE_DIR:
+            try:
+                os.makedirs(PROXY_PROFILE_DIR, exist_ok=True)
+                _write_json_atomically(
+                    os.path.join(PROXY_PROFILE_DIR, f"profile-{profile.id}.json"),
+                    profile.to_dict(),
+                )
+            except OSError:
+                pass
+
+    def _ensure_thread(self):
+        if self._thread is None and any(p.collecting() for p in self._active):
+            self._thread = threading.Thread(target=self._run, name="lp-profiler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for profile in list(self._active):
+                    if profile.deadline is not None and now >= profile.deadline:
+                        self._finish(profile)
+                targets = [p for p in self._active if p.collecting()]
+                if not targets:
+                    self._thread = None
+                    return
+            stacks = self._sample(me)
+            with self._lock:
+                for profile in targets:
+                    profile.add(stacks)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _sample(skip):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            frames = []
+            while frame is not None and len(frames) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                frames.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if not frames:
+                continue
+            leaf = (os.path.basename(frames[0][1]), frames[0][0])
+            frames.reverse()
+            stacks.append((names.get(ident, str(ident)), tuple(frames), leaf in _IDLE_LEAVES))
+        return stacks
+
+
+_PROFILER = _Profiler(PROXY_PROFILE_INTERVAL_MS / 1000.0)
+
+
+# --- Memory introspection --------------------------------------------------
+#
+# Admin views of where a worker's memory goes: RSS, garbage collector
+# counts, the sizes of the proxy's internal caches and pools, and
+# tracemalloc snapshots diffed by file, line or traceback. tracemalloc slows
+# every allocation down, so it only runs between
+# POST /admin/memory/tracemalloc?action=start and ...?action=stop.
+
+MAX_MEMORY_SNAPSHOTS = 4
+MEMORY_GROUPINGS = ("filename", "lineno", "traceback")
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _internal_sizes():
+    """Entry counts of the proxy's own caches, queues and pools."""
+    scheduler = _UPSTREAM_SCHEDULER.stats()
+    hedge_threads = len(_hedge_executor._threads) if _hedge_executor is not None else 0
+    return {
+        "upstream_queue_depth": sum(lane["queue_depth"] for lane in scheduler["lanes"].values()),
+        "upstream_in_flight": scheduler["in_flight"],
+        "usage_windows": _UPSTREAM_USAGE.tracked(),
+        "circuit_breakers": len(_BREAKERS),
+        "hedge_threads": hedge_threads,
+        "metric_series": sum(len(metric._values) for metric in _METRICS),
+        "trace_queue": len(_TRACE_EXPORTER._queue),
+        "profiles": len(_PROFILER.summaries()),
+        "memory_snapshots": len(_MEMORY_SNAPSHOTS),
+        "response_cache_entries": len(_RESPONSE_CACHE),
+        "warmup_pending": _WARMUP.pending(),
+    }
+
+
+class _MemorySnapshots:
+    """The last few tracemalloc snapshots of this worker, by id."""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._snapshots = collections.OrderedDict()
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def take(self):
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            raise HTTPException(status_code=409, detail="tracemalloc is not running")
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            )
+        )
+        with self._lock:
+            self._counter += 1
+            snapshot_id = str(self._counter)
+            self._snapshots[snapshot_id] = snapshot
+            while len(self._snapshots) > self.keep:
+                self._snapshots.popitem(last=False)
+        return snapshot_id, snapshot
+
+    def get(self, snapshot_id):
+        with self._lock:
+            snapshot = self._snapshots.get(snapshot_id)
+        if snapshot is None:
+            raise HTTPException(status_code=404, detail=f"Unknown snapshot {snapshot_id}")
+        return snapshot
+
+    def ids(self):
+        with self._lock:
+            return list(self._snapshots)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+
+def _format_memory_stat(stat, group_by):
+    frames = [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+    row = {
+        "where": frames[0] if group_by != "traceback" else frames,
+        "size_bytes": stat.size,
+        "count": stat.count,
+    }
+    if hasattr(stat, "size_diff"):
+        row["size_diff_bytes"] = stat.size_diff
+        row["count_diff"] = stat.count_diff
+    return row
+
+
+_MEMORY_SNAPSHOTS = _MemorySnapshots(MAX_MEMORY_SNAPSHOTS)
+
+
+# --- Event-loop lag watchdog -----------------------------------------------
+#
+# Anything blocking the event loop (a synchronous Launchpad call in an async
+# handler, a huge json.loads) stalls every request of the worker. A
+# heartbeat task on the loop measures how late it wakes up and exports that
+# as lp_proxy_event_loop_lag_seconds. A watchdog thread notices when the
+# heartbeat stops for longer than the threshold, grabs the stack of the loop
+# thread while it is still blocked, counts the stall and logs the stack as a
+# warning, at most once per log interval.
+#
+#   PROXY_LOOP_WATCHDOG                 "0" disables it (default: "1").
+#   PROXY_LOOP_LAG_INTERVAL_MS          Heartbeat interval (default: 50).
+#   PROXY_LOOP_LAG_THRESHOLD_MS         Blocking time reported as a stall
+#                                        (default: 250).
+#   PROXY_LOOP_LAG_LOG_INTERVAL_SECONDS Min time between logged stacks
+#                                        (default: 60).
+
+PROXY_LOOP_WATCHDOG = os.environ.get("PROXY_LOOP_WATCHDOG", "1") != "0"
+PROXY_LOOP_LAG_INTERVAL_MS = float(os.environ.get("PROXY_LOOP_LAG_INTERVAL_MS", "50"))
+PROXY_LOOP_LAG_THRESHOLD_MS = float(os.environ.get("PROXY_LOOP_LAG_THRESHOLD_MS", "250"))
+PROXY_LOOP_LAG_LOG_INTERVAL_SECONDS = float(
+    os.environ.get("PROXY_LOOP_LAG_LOG_INTERVAL_SECONDS", "60")
+)
+
+LOOP_LAG = _Histogram(
+    "lp_proxy_event_loop_lag_seconds",
+    "How late the event loop heartbeat woke up.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_STALLS = _Counter(
+    "lp_proxy_event_loop_stalls_total", "Times the event loop was blocked past the threshold."
+)
+
+
+class _LoopWatchdog:
+    def __init__(self, interval, threshold, log_interval):
+        self.interval = interval
+        self.threshold = threshold
+        self.log_interval = log_interval
+        self.loop = None
+        self.loop_thread = None
+        self.last_tick = 0.0
+        self.stalls = 0
+        self.suppressed = 0
+        self._last_logged = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        """Watch the running loop; a no-op once it is watched."""
+        loop = asyncio.get_running_loop()
+        if loop is self.loop:
+            return
+        with self._lock:
+            if loop is self.loop:
+                return
+            self.loop = loop
+            self.loop_thread = threading.get_ident()
+            self.last_tick = time.monotonic()
+            loop.create_task(self._heartbeat(loop))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._watch, name="lp-loop-watchdog", daemon=True
+                )
+                self._thread.start()
+
+    async def _heartbeat(self, loop):
+        while self.loop is loop:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            LOOP_LAG.observe(max(0.0, now - expected))
+            self.last_tick = now
+
+    def _watch(self):
+        stalled = False
+        while True:
+            time.sleep(self.interval)
+            loop = self.loop
+            if loop.is_closed():
+                with self._lock:
+                    if self.loop is loop:
+                        self._thread = None
+                        return
+                continue
+            blocked = time.monotonic() - self.last_tick - self.interval
+            if not loop.is_running() or blocked < self.threshold:
+                stalled = False
+                continue
+            if not stalled:
+                # One report per stall, taken while the loop is still blocked.
+                stalled = True
+                self._report(blocked)
+
+    def _report(self, blocked):
+        self.stalls += 1
+        LOOP_STALLS.inc()
+        now = time.monotonic()
+        if self._last_logged is not None and now - self._last_logged < self.log_interval:
+            self.suppressed += 1
+            return
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        _LOGGER.warning(
+            "Event loop blocked for at least %.0f ms (%d stalls not logged since the "
+            "last report); loop thread stack:\n%s",
+            blocked * 1000,
+            self.suppressed,
+            stack,
+        )
+        self._last_logged = now
+        self.suppressed = 0
+
+
+_LOOP_WATCHDOG = _LoopWatchdog(
+    PROXY_LOOP_LAG_INTERVAL_MS / 1000.0,
+    PROXY_LOOP_LAG_THRESHOLD_MS / 1000.0,
+    PROXY_LOOP_LAG_LOG_INTERVAL_SECONDS,
+)
+
+
+# --- Structured access log -------------------------------------------------
+#
+# One JSON line per request with the identity, route, status, upstream
+# status, per-stage latency breakdown and cache status. Records are handed
+# to a bounded queue and written by a background thread, so a slow disk or
+# pipe never holds up a request; when the queue is full records are dropped
+# and counted. Successful requests can be sampled; errors (status >= 400)
+# and slow requests are always logged. Run uvicorn with --no-access-log to
+# replace its own access log.
+#
+#   PROXY_ACCESS_LOG              "-" for stdout or a file path; empty
+#                                  disables it (default: empty).
+#   PROXY_ACCESS_LOG_SAMPLE_RATE  Fraction of successful requests logged
+#                                  (default: 1.0).
+#   PROXY_ACCESS_LOG_SLOW_MS      Requests at least this slow are always
+#                                  logged (default: 1000).
+#   PROXY_ACCESS_LOG_QUEUE_SIZE   Records waiting to be written before new
+#                                  ones are dropped (default: 10000).
+
+PROXY_ACCESS_LOG = os.environ.get("PROXY_ACCESS_LOG", "")
+PROXY_ACCESS_LOG_SAMPLE_RATE = float(os.environ.get("PROXY_ACCESS_LOG_SAMPLE_RATE", "1.0"))
+PROXY_ACCESS_LOG_SLOW_MS = float(os.environ.get("PROXY_ACCESS_LOG_SLOW_MS", "1000"))
+PROXY_ACCESS_LOG_QUEUE_SIZE = int(os.environ.get("PROXY_ACCESS_LOG_QUEUE_SIZE", "10000"))
+
+ACCESS_LOG_DROPPED = _Counter(
+    "lp_proxy_access_log_dropped_total", "Access log records dropped because the queue was full."
+)
+
+
+class _AccessLog:
+    def __init__(self, target, queue_size, sample_rate, slow_seconds):
+        self.target = target
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._write_lock = threading.Lock()
+        self._stream = None
+        self._thread = None
+
+    def wanted(self, status, duration):
+        return (
+            status >= 400
+            or duration >= self.slow_seconds
+            or random.random() < self.sample_rate
+        )
+
+    def log(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            ACCESS_LOG_DROPPED.inc()
+            return
+        if self._thread is None:
+            with self._write_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="lp-access-log", daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            with self._write_lock:
+                self._write(record)
+                if self._queue.empty():
+                    self._stream.flush()
+
+    def _write(self, record):
+        if self._stream is None:
+            if self.target == "-":
+                self._stream = sys.stdout
+            else:
+                self._stream = open(self.target, "a", buffering=65536)
+        self._stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def drain(self):
+        """Write whatever is queued from the calling thread (tests, exit)."""
+        with self._write_lock:
+            while True:
+                try:
+                    self._write(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if self._stream is not None:
+                self._stream.flush()
+
+
+def _access_log_record(scope, route, context, status, duration, sent, span):
+    client = scope.get("client")
+    user_agent = None
+    for name, value in scope["headers"]:
+        if name == b"user-agent":
+            user_agent = value.decode("latin-1")[:200]
+            break
+    record = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()) + "Z",
+        "method": scope["method"],
+        "path": scope["path"],
+        "route": route,
+        "status": status,
+        "duration_ms": round(duration * 1000, 2),
+        "bytes": sent,
+        "client": client[0] if client else None,
+        "identity": context.identity,
+        "consumer_key": context.consumer_key,
+        "upstream_status": context.upstream_status,
+        "upstream_calls": context.upstream_calls,
+        "timings_ms": {
+            name: round(seconds * 1000, 2) for name, seconds in (context.timings or {}).items()
+        },
+        "cache": context.cache,
+        "user_agent": user_agent,
+        "pid": os.getpid(),
+    }
+    if span is not None:
+        record["trace_id"] = span.trace_id
+    return record
+
+
+_ACCESS_LOG = (
+    _AccessLog(
+        PROXY_ACCESS_LOG,
+        PROXY_ACCESS_LOG_QUEUE_SIZE,
+        PROXY_ACCESS_LOG_SAMPLE_RATE,
+        PROXY_ACCESS_LOG_SLOW_MS / 1000.0,
+    )
+    if PROXY_ACCESS_LOG
+    else None
+)
+if _ACCESS_LOG is not None:
+    atexit.register(_ACCESS_LOG.drain)
+
 
 # --- Launchpad OAuth 1.0a signing (used by the token exchange adapter) ----
 #
@@ -49,19 +1371,22 @@ STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 LP_CONSUMER_KEY = os.environ.get("LP_CONSUMER_KEY", "lp-api-proxy")
 LP_CONSUMER_SECRET = os.environ.get("LP_CONSUMER_SECRET", "")
 LP_SIGNATURE_METHOD = os.environ.get("LP_SIGNATURE_METHOD", "PLAINTEXT")
-LP_ALLOW_PERMISSION = [
-    item.strip()
-    for item in os.environ.get("LP_ALLOW_PERMISSION", "").split(",")
-    if item.strip()
-]
-PROXY_ALLOWED_ORIGINS = [
-    item.strip().lower().rstrip("/")
-    for item in os.environ.get("PROXY_ALLOWED_ORIGINS", "").split(",")
-    if item.strip()
-]
 MAX_CONSUMER_KEY_LENGTH = 255
 
 
+def _parse_csv(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _parse_origins(value):
+    return [item.lower().rstrip("/") for item in _parse_csv(value)]
+
+
+LP_ALLOW_PERMISSION = _parse_csv(os.environ.get("LP_ALLOW_PERMISSION", ""))
+PROXY_ALLOWED_ORIGINS = _parse_origins(os.environ.get("PROXY_ALLOWED_ORIGINS", ""))
+PROXY_CORS_MAX_AGE_SECONDS = int(os.environ.get("PROXY_CORS_MAX_AGE_SECONDS", "600"))
+
+
 def _percent_encode(value):
     return urllib.parse.quote(str(value), safe="~")
 
@@ -232,9 +1557,15 @@ def _oauth1_authorization_header(
 #   PROXY_ALLOWED_ORIGINS     Comma-separated redirect_uri origins allowed for:
 #                              1) CORS allow_origins
 #                              2) dynamic Launchpad oauth_consumer_key naming
+#   PROXY_CORS_MAX_AGE_SECONDS  How long browsers may cache the answer to a
+#                              CORS preflight (default: 600). Browsers cap it:
+#                              Chromium at 7200, Firefox at 86400.
 #   PROXY_RSA_PRIVATE_KEY     PEM RSA private key for RS256 id_tokens.
 #                              Generate: openssl genrsa 2048
 #                              Omitting generates an ephemeral key (not for production).
+#   PROXY_RSA_PRIVATE_KEY_FILE  File holding that PEM key instead. A new key is
+#                              written to it if it does not exist, so all workers
+#                              and restarts share one key.
 #   PROXY_OIDC_CLIENT_ID      client_id Concourse uses (default: "concourse-ci").
 #   PROXY_OIDC_CLIENT_SECRET  client_secret for token endpoint (confidential clients).
 #   PROXY_JWT_ISSUER          iss claim override (default: PROXY_BASE_URL).
@@ -255,6 +1586,7 @@ def effective_base_url(request: Request = None) -> str:
     return "http://localhost:3456"
 
 PROXY_RSA_PRIVATE_KEY_PEM = os.environ.get("PROXY_RSA_PRIVATE_KEY")
+PROXY_RSA_PRIVATE_KEY_FILE = os.environ.get("PROXY_RSA_PRIVATE_KEY_FILE", "")
 PROXY_OIDC_CLIENT_ID = os.environ.get("PROXY_OIDC_CLIENT_ID", "concourse-ci")
 PROXY_OIDC_CLIENT_SECRET = os.environ.get("PROXY_OIDC_CLIENT_SECRET")
 PROXY_JWT_SECRET = os.environ.get("PROXY_JWT_SECRET")
@@ -271,23 +1603,69 @@ _rsa_private_key = None
 _rsa_key_id = None
 
 
+def _generate_rsa_key():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _load_rsa_key_file(path):
+    """Read the PEM key at ``path``, writing a new one first if it is
+    missing. Workers starting together race on an exclusive link(), so they
+    all end up with the key that won."""
+    if not os.path.exists(path):
+        from cryptography.hazmat.primitives import serialization
+
+        pem = _generate_rsa_key().private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as fh:
+            fh.write(pem)
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    with open(path, "rb") as fh:
+        return load_pem_private_key(fh.read(), password=None)
+
+
+def _jwk_thumbprint(public_numbers):
+    """RFC 7638 thumbprint of an RSA public key. Used as the kid, so every
+    worker and restart holding the same key publishes the same kid."""
+    members = json.dumps(
+        {
+            "e": _int_to_base64url(public_numbers.e),
+            "kty": "RSA",
+            "n": _int_to_base64url(public_numbers.n),
+        },
+        separators=(",", ":"),
+        sort_keys=True,
+    )
+    digest = hashlib.sha256(members.encode()).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
 def _get_rsa_private_key():
     global _rsa_private_key, _rsa_key_id
     if _rsa_private_key is None:
         if PROXY_RSA_PRIVATE_KEY_PEM:
-            _rsa_private_key = load_pem_private_key(
-                PROXY_RSA_PRIVATE_KEY_PEM.encode(), password=None
-            )
+            key = load_pem_private_key(PROXY_RSA_PRIVATE_KEY_PEM.encode(), password=None)
+        elif PROXY_RSA_PRIVATE_KEY_FILE:
+            key = _load_rsa_key_file(PROXY_RSA_PRIVATE_KEY_FILE)
         else:
             warnings.warn(
                 "PROXY_RSA_PRIVATE_KEY is not set — generating an ephemeral RSA key. "
                 "Concourse will reject id_tokens after a proxy restart. "
                 "Run: openssl genrsa 2048 and set PROXY_RSA_PRIVATE_KEY."
             )
-            _rsa_private_key = _rsa_gen.generate_private_key(
-                public_exponent=65537, key_size=2048
-            )
-        _rsa_key_id = secrets.token_hex(8)
+            key = _generate_rsa_key()
+        _rsa_key_id = _jwk_thumbprint(key.public_key().public_numbers())
+        _rsa_private_key = key
     return _rsa_private_key, _rsa_key_id
 
 
@@ -296,6 +1674,17 @@ def _int_to_base64url(n):
     return base64.urlsafe_b64encode(n.to_bytes(length, "big")).rstrip(b"=").decode()
 
 
+_jwks_body = None
+
+
+def _jwks_response_body():
+    """The JWKS document, serialized once per process."""
+    global _jwks_body
+    if _jwks_body is None:
+        _jwks_body = json.dumps(_jwks_document(), separators=(",", ":")).encode()
+    return _jwks_body
+
+
 def _jwks_document():
     priv, kid = _get_rsa_private_key()
     pub = priv.public_key().public_numbers()
@@ -315,7 +1704,8 @@ def _jwks_document():
 
 def _sign_id_token(payload):
     priv, kid = _get_rsa_private_key()
-    return jwt.encode(payload, priv, algorithm="RS256", headers={"kid": kid})
+    with _stage("rsa_sign"):
+        return jwt.encode(payload, priv, algorithm="RS256", headers={"kid": kid})
 
 
 # HS256 helpers (internal sessions + access tokens)
@@ -347,18 +1737,20 @@ def _fernet():
 def _sign_jwt(payload, ttl_seconds):
     now = int(time.time())
     claims = {**payload, "iss": PROXY_JWT_ISSUER, "iat": now, "exp": now + ttl_seconds}
-    return jwt.encode(claims, _require_jwt_secret(), algorithm="HS256")
+    with _stage("jwt_sign"):
+        return jwt.encode(claims, _require_jwt_secret(), algorithm="HS256")
 
 
 def _verify_jwt(token, audience=None):
     try:
-        return jwt.decode(
-            token,
-            _require_jwt_secret(),
-            algorithms=["HS256"],
-            audience=audience,
-            options={"verify_aud": audience is not None},
-        )
+        with _stage("jwt_verify"):
+            return jwt.decode(
+                token,
+                _require_jwt_secret(),
+                algorithms=["HS256"],
+                audience=audience,
+                options={"verify_aud": audience is not None},
+            )
     except jwt.PyJWTError as exc:
         raise HTTPException(status_code=401, detail=f"Invalid or expired token: {exc}")
 
@@ -380,7 +1772,7 @@ def _group_name_from_link(value):
 def _group_full_url(name):
     if not name:
         return None
-    return f"https://launchpad.net/~{name}"
+    return f"{LAUNCHPAD_URL}/~{name}"
 
 
 def _extract_groups_from_membership_entry(entry):
@@ -399,145 +1791,2768 @@ def _extract_groups_from_membership_entry(entry):
                 if full:
                     urls.add(full)
 
-    team = entry.get("team")
-    if isinstance(team, dict):
-        team_name = team.get("name")
-        if team_name:
-            names.add(str(team_name))
-        for key in ("web_link", "self_link"):
-            value = team.get(key)
-            if isinstance(value, str):
-                name = _group_name_from_link(value)
-                if name:
-                    names.add(name)
-                    full = _group_full_url(name)
-                    if full:
-                        urls.add(full)
+    team = entry.get("team")
+    if isinstance(team, dict):
+        team_name = team.get("name")
+        if team_name:
+            names.add(str(team_name))
+        for key in ("web_link", "self_link"):
+            value = team.get(key)
+            if isinstance(value, str):
+                name = _group_name_from_link(value)
+                if name:
+                    names.add(name)
+                    full = _group_full_url(name)
+                    if full:
+                        urls.add(full)
+
+    name = entry.get("name")
+    if isinstance(name, str) and name and " " not in name:
+        names.add(name)
+        full = _group_full_url(name)
+        if full:
+            urls.add(full)
+
+    return names, urls
+
+
+def _lp_fetch_groups(oauth_authorization_header, me_data, identity=None):
+    links = []
+    for key in (
+        "memberships_details_collection_link",
+        "memberships_collection_link",
+        "super_teams_collection_link",
+        "team_memberships_collection_link",
+    ):
+        link = me_data.get(key)
+        if isinstance(link, str) and link:
+            links.append(link)
+
+    links = list(dict.fromkeys(links))
+    group_names = set()
+    group_urls = set()
+    with _span("lp_fetch_groups", {"lp.collections": len(links)}):
+        for link in links:
+            resp = _upstream_request(
+                "GET",
+                link,
+                lane=LANE_LOGIN,
+                identity=identity,
+                headers={"Authorization": oauth_authorization_header},
+            )
+            if resp.status_code != requests.codes.ok:
+                continue
+            payload = resp.json()
+            for entry in payload.get("entries", []):
+                names, urls = _extract_groups_from_membership_entry(entry)
+                group_names.update(names)
+                group_urls.update(urls)
+
+    return sorted(group_names), sorted(group_urls)
+
+
+def _lp_fetch_me(oauth_token, oauth_token_secret, oauth_consumer_key):
+    auth = _oauth1_authorization_header(
+        oauth_consumer_key,
+        LP_CONSUMER_SECRET,
+        token=oauth_token,
+        token_secret=oauth_token_secret,
+        signature_method=LP_SIGNATURE_METHOD,
+    )
+    identity = _oauth1_header_identity(auth)
+    resp = _upstream_request(
+        "GET",
+        f"{LAUNCHPAD_API}/devel/people/+me",
+        lane=LANE_LOGIN,
+        identity=identity,
+        headers={"Authorization": auth},
+    )
+    if resp.status_code != requests.codes.ok:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Failed to fetch Launchpad user info: {resp.text}",
+        )
+    data = resp.json()
+    groups, groups_full = _lp_fetch_groups(auth, data, identity)
+    username = data.get("name", oauth_token)
+    email = _lp_extract_preferred_email(data)
+    user = {
+        "sub": username,
+        "username": username,
+        "user_id": username,
+        "name": data.get("display_name", data.get("name", "")),
+        "profile": data.get(
+            "web_link", f"{LAUNCHPAD_URL}/~{data.get('name', '')}"
+        ),
+        "groups": groups,
+        "groups_full": groups_full,
+    }
+    if email:
+        user["email"] = email
+        user["email_verified"] = True
+    return user
+
+
+def _lp_extract_preferred_email(me_data):
+    """Best-effort extraction of the user's preferred email address.
+
+    Launchpad's people/+me resource exposes ``preferred_email_address_link``,
+    a URL of the form ``.../~user/+email/<address>``. The email address is
+    URL-encoded as the final path segment, so we can read it directly without
+    an extra authenticated round-trip to Launchpad. Returns None when the
+    field is absent (e.g. hide_email_addresses is set, or the OAuth scope
+    doesn't grant access to it).
+    """
+    link = me_data.get("preferred_email_address_link")
+    if not isinstance(link, str) or "+email/" not in link:
+        return None
+    candidate = link.rsplit("+email/", 1)[-1]
+    candidate = urllib.parse.unquote(candidate)
+    # Basic sanity check — don't propagate garbage as an email claim.
+    if "@" not in candidate or " " in candidate:
+        return None
+    return candidate
+
+
+# Authorization header resolver (Bearer JWT -> OAuth 1.0a)
+
+
+_OAUTH1_TOKEN_RE = re.compile(r'oauth_token="([^"]*)"')
+_OAUTH1_PARAM_RE = re.compile(r'(oauth_\w+)="([^"]*)"')
+
+
+def _oauth1_header_identity(authorization):
+    """Identity for a raw OAuth 1.0a header: a digest of its oauth_token, so
+    the token itself never ends up in stats or logs."""
+    match = _OAUTH1_TOKEN_RE.search(authorization)
+    if not match or not match.group(1):
+        return None
+    token = urllib.parse.unquote(match.group(1))
+    return "oauth:" + hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def _credential_scope(authorization):
+    """Response cache scope of an OAuth 1.0a header: a digest of its
+    consumer key, token and PLAINTEXT signature, which carries the secrets.
+    The proxy does not check signatures, so a header reusing someone else's
+    oauth_token with a wrong signature must not share their entries. Other
+    signature methods sign every request differently: None, not cached."""
+    params = {
+        name: urllib.parse.unquote(value)
+        for name, value in _OAUTH1_PARAM_RE.findall(authorization)
+    }
+    if params.get("oauth_signature_method") != "PLAINTEXT" or not params.get("oauth_token"):
+        return None
+    credential = "&".join(
+        _percent_encode(params.get(name, ""))
+        for name in ("oauth_consumer_key", "oauth_token", "oauth_signature")
+    )
+    return "cred:" + hashlib.sha256(credential.encode()).hexdigest()[:16]
+
+
+def _resolve_authorization(authorization):
+    """Return ``(authorization_header, identity)`` for an upstream call.
+
+    Raw OAuth 1.0a headers are passed through; a Bearer JWT issued by
+    /oauth2/token is translated into a fresh OAuth 1.0a signed header. The
+    identity is the Launchpad user (or a digest of the raw OAuth token) the
+    call is accounted to, or None when the caller is anonymous."""
+    if not authorization:
+        return authorization, None
+    if not authorization.startswith("Bearer "):
+        return authorization, _oauth1_header_identity(authorization)
+
+    token = authorization[len("Bearer "):]
+    if not PROXY_JWT_SECRET or token.count(".") != 2:
+        return authorization, None
+
+    claims = _verify_jwt(token, audience=PROXY_JWT_AUDIENCE)
+    if claims.get("typ") != "lp-access" or "lp_cred" not in claims:
+        raise HTTPException(status_code=401, detail="Not a valid Launchpad access token")
+
+    fernet = _fernet()
+    with _stage("credential_decrypt"):
+        cred = json.loads(fernet.decrypt(claims["lp_cred"].encode()).decode())
+    with _stage("oauth1_sign"):
+        header = _oauth1_authorization_header(
+            cred.get("oauth_consumer_key", LP_CONSUMER_KEY),
+            LP_CONSUMER_SECRET,
+            token=cred["oauth_token"],
+            token_secret=cred["oauth_token_secret"],
+            signature_method=LP_SIGNATURE_METHOD,
+        )
+    return header, f"user:{claims.get('sub')}"
+
+
+def _resolve_authorization_header(authorization):
+    """Pass-through for raw OAuth 1.0a headers; translate Bearer JWT issued
+    by /oauth2/token into a fresh OAuth 1.0a signed header."""
+    return _resolve_authorization(authorization)[0]
+
+
+# --- Upstream scheduler ----------------------------------------------------
+#
+# Every call to Launchpad goes through one scheduler per worker process, so
+# interactive logins are not starved by bulk CI traffic on /devel/*. Calls
+# are queued in priority lanes:
+#
+#   login        /oauth2/login, /oauth2/callback and the +*-token passthroughs
+#   interactive  single-resource /devel/* reads and all writes
+#   bulk         /devel/* collection reads (ws.op, ws.start, ws.size)
+#
+# A client can demote (or promote) its own /devel/* traffic between
+# "interactive" and "bulk" with the X-LP-Proxy-Priority header.
+#
+# Free slots are handed out by smooth weighted round-robin between the lanes
+# that have work, and round-robin between identities inside a lane, so one
+# pipeline hammering searchTasks only ever competes with itself. No identity
+# may hold more than PROXY_UPSTREAM_IDENTITY_CONCURRENCY slots at once.
+#
+#   PROXY_UPSTREAM_CONCURRENCY            Max in-flight upstream calls per
+#                                          worker (default: 16).
+#   PROXY_UPSTREAM_IDENTITY_CONCURRENCY   Max in-flight upstream calls per
+#                                          identity (default: 4).
+#   PROXY_UPSTREAM_LANE_WEIGHTS           Lane weights
+#                                          (default: "login=8,interactive=4,bulk=1").
+#   PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS  Max time a call waits for a slot
+#                                          before failing with 503 (default: 30).
+
+LANE_LOGIN = "login"
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+UPSTREAM_LANES = (LANE_LOGIN, LANE_INTERACTIVE, LANE_BULK)
+
+
+def _parse_weights(value, defaults):
+    """Parse "name=weight,..." into a dict, keeping defaults for names that
+    are missing or malformed."""
+    weights = dict(defaults)
+    for item in (value or "").split(","):
+        name, sep, raw = item.partition("=")
+        name = name.strip().lower()
+        if not sep or name not in weights:
+            continue
+        try:
+            weights[name] = max(0.0, float(raw))
+        except ValueError:
+            continue
+    return weights
+
+
+def _parse_lane_weights(value):
+    return _parse_weights(value, {LANE_LOGIN: 8.0, LANE_INTERACTIVE: 4.0, LANE_BULK: 1.0})
+
+
+PROXY_UPSTREAM_CONCURRENCY = int(os.environ.get("PROXY_UPSTREAM_CONCURRENCY", "16"))
+PROXY_UPSTREAM_IDENTITY_CONCURRENCY = int(
+    os.environ.get("PROXY_UPSTREAM_IDENTITY_CONCURRENCY", "4")
+)
+PROXY_UPSTREAM_LANE_WEIGHTS = _parse_lane_weights(os.environ.get("PROXY_UPSTREAM_LANE_WEIGHTS"))
+PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(
+    os.environ.get("PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS", "30")
+)
+
+
+class _SchedulerWaiter:
+    __slots__ = ("lane", "identity", "enqueued_at", "granted", "shed", "wake")
+
+    def __init__(self, lane, identity, wake):
+        self.lane = lane
+        self.identity = identity
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.shed = False
+        self.wake = wake
+
+
+class _UpstreamScheduler:
+    """Priority-lane scheduler with per-identity fair queuing.
+
+    Both worker threads (sync endpoints) and the event loop (async /devel/*
+    handlers) wait on the same queues, see slot() and async_slot()."""
+
+    def __init__(
+        self,
+        concurrency,
+        identity_concurrency,
+        lane_weights,
+        queue_timeout,
+        limiter=None,
+        admission=None,
+    ):
+        self.limiter = limiter
+        # lane -> _CoDel; lanes without one are never shed.
+        self.admission = admission or {}
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_by_identity = collections.Counter()
+        # lane -> identity -> deque of waiters; dict order is the round-robin order.
+        self._queues = {lane: {} for lane in UPSTREAM_LANES}
+        self._queued = dict.fromkeys(UPSTREAM_LANES, 0)
+        self._credit = dict.fromkeys(UPSTREAM_LANES, 0.0)
+        self._resume_timer = None
+        self.configure(concurrency, identity_concurrency, lane_weights, queue_timeout)
+        self._stats = {
+            lane: {
+                "dispatched": 0,
+                "timed_out": 0,
+                "rejected": 0,
+                "shed": 0,
+                "disconnected": 0,
+                "wait_seconds_total": 0.0,
+                "wait_seconds_max": 0.0,
+            }
+            for lane in UPSTREAM_LANES
+        }
+
+    def configure(self, concurrency, identity_concurrency, lane_weights, queue_timeout):
+        """Set the limits; queued calls that now fit are dispatched."""
+        with self._lock:
+            self.concurrency = max(1, concurrency)
+            self.identity_concurrency = max(1, identity_concurrency)
+            self.lane_weights = {lane: lane_weights.get(lane, 1.0) for lane in UPSTREAM_LANES}
+            self.queue_timeout = queue_timeout
+            if self.limiter is not None:
+                self.limiter.configure(self.concurrency)
+            self._dispatch()
+
+    def capacity(self):
+        if self.limiter is None:
+            return self.concurrency
+        return min(self.concurrency, self.limiter.current_limit())
+
+    def _resume_after_pause(self):
+        with self._lock:
+            self._resume_timer = None
+            self._dispatch()
+
+    def _eligible_identity(self, lane):
+        for identity in self._queues[lane]:
+            if self._in_flight_by_identity[identity] < self.identity_concurrency:
+                return identity
+        return None
+
+    def _pick_lane(self, candidates):
+        # Smooth weighted round-robin (as in nginx): every candidate earns its
+        # weight, the richest one wins and pays back the total.
+        total = 0.0
+        best = None
+        for lane in candidates:
+            weight = self.lane_weights[lane] or 0.001
+            total += weight
+            self._credit[lane] += weight
+            if best is None or self._credit[lane] > self._credit[best]:
+                best = lane
+        self._credit[best] -= total
+        return best
+
+    def _dispatch(self):
+        """Grant free slots to queued waiters. Must hold self._lock."""
+        paused = self.limiter.paused_for() if self.limiter is not None else 0.0
+        if paused > 0:
+            # Launchpad asked us to back off (Retry-After): hold the queue.
+            if self._resume_timer is None and any(self._queued.values()):
+                self._resume_timer = threading.Timer(paused, self._resume_after_pause)
+                self._resume_timer.daemon = True
+                self._resume_timer.start()
+            return
+        while self._in_flight < self.capacity():
+            candidates = {}
+            for lane in UPSTREAM_LANES:
+                identity = self._eligible_identity(lane)
+                if identity is not None:
+                    candidates[lane] = identity
+            if not candidates:
+                return
+            lane = self._pick_lane(candidates)
+            identity = candidates[lane]
+            waiters = self._queues[lane].pop(identity)
+            waiter = waiters.popleft()
+            if waiters:
+                # Re-insert at the end so the next identity gets the next slot.
+                self._queues[lane][identity] = waiters
+            self._queued[lane] -= 1
+            if not self._shed(waiter):
+                self._grant(waiter)
+
+    def _shed(self, waiter):
+        """Feed the waiter's sojourn time to its lane's CoDel and wake it
+        without a slot if it has queued too long. Must hold self._lock."""
+        codel = self.admission.get(waiter.lane)
+        if codel is None:
+            return False
+        now = time.monotonic()
+        if not codel.observe(now - waiter.enqueued_at, now):
+            return False
+        waiter.shed = True
+        self._stats[waiter.lane]["shed"] += 1
+        ADMISSION_REJECTIONS.inc((waiter.lane, "sojourn"))
+        waiter.wake()
+        return True
+
+    def _grant(self, waiter):
+        waiter.granted = True
+        self._in_flight += 1
+        self._in_flight_by_identity[waiter.identity] += 1
+        waited = time.monotonic() - waiter.enqueued_at
+        stats = self._stats[waiter.lane]
+        stats["dispatched"] += 1
+        stats["wait_seconds_total"] += waited
+        stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+        UPSTREAM_QUEUE_WAIT.observe(waited, (waiter.lane,))
+        waiter.wake()
+
+    def _enqueue(self, lane, identity, wake):
+        if lane not in self._queues:
+            lane = LANE_INTERACTIVE
+        waiter = _SchedulerWaiter(lane, identity or "anonymous", wake)
+        with self._lock:
+            codel = self.admission.get(lane)
+            if (
+                codel is not None
+                and not codel.admit(waiter.enqueued_at)
+                and (self._queued[lane] or self._in_flight >= self.capacity())
+            ):
+                # The lane has a standing queue: turn the call away now
+                # rather than after it has waited for nothing.
+                self._stats[lane]["rejected"] += 1
+                ADMISSION_REJECTIONS.inc((lane, "overloaded"))
+                raise self._overload_error(lane, codel)
+            self._queues[lane].setdefault(waiter.identity, collections.deque()).append(waiter)
+            self._queued[lane] += 1
+            self._dispatch()
+        return waiter
+
+    def _abandon(self, waiter, reason="timed_out"):
+        """Drop a waiter that gave up. Returns True if it was still queued,
+        False if it was granted a slot or shed in the meantime."""
+        with self._lock:
+            if waiter.granted or waiter.shed:
+                return False
+            waiters = self._queues[waiter.lane].get(waiter.identity)
+            if waiters is not None:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._queues[waiter.lane][waiter.identity]
+            self._queued[waiter.lane] -= 1
+            self._stats[waiter.lane][reason] += 1
+            return True
+
+    def release(self, identity):
+        with self._lock:
+            identity = identity or "anonymous"
+            self._in_flight -= 1
+            self._in_flight_by_identity[identity] -= 1
+            if self._in_flight_by_identity[identity] <= 0:
+                del self._in_flight_by_identity[identity]
+            self._dispatch()
+
+    def _queue_timeout_error(self, lane):
+        return HTTPException(
+            status_code=503,
+            detail=f"Upstream queue timeout in the {lane} lane; try again later.",
+            headers={"Retry-After": "1"},
+        )
+
+    def _overload_error(self, lane, codel=None):
+        codel = codel or self.admission[lane]
+        return HTTPException(
+            status_code=503,
+            detail=f"The {lane} lane is overloaded; try again later.",
+            headers={"Retry-After": str(max(1, math.ceil(codel.interval)))},
+        )
+
+    @contextlib.contextmanager
+    def slot(self, lane, identity, timeout=None):
+        """Hold one upstream slot; blocks the calling (worker) thread."""
+        event = threading.Event()
+        waiter = self._enqueue(lane, identity, event.set)
+        timeout = self.queue_timeout if timeout is None else timeout
+        if not event.wait(timeout) and self._abandon(waiter):
+            raise self._queue_timeout_error(waiter.lane)
+        if waiter.shed:
+            raise self._overload_error(waiter.lane)
+        try:
+            yield
+        finally:
+            self.release(waiter.identity)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self, lane, identity, timeout=None, receive=None):
+        """Hold one upstream slot without blocking the event loop. With the
+        ASGI ``receive`` of the client request, the call leaves the queue
+        (and fails with 499) as soon as the client disconnects."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _resolve():
+            if not future.done():
+                future.set_result(None)
+
+        def _gone(task):
+            if not task.cancelled() and task.exception() is None and not future.done():
+                future.set_exception(_ClientDisconnected())
+
+        waiter = self._enqueue(lane, identity, lambda: loop.call_soon_threadsafe(_resolve))
+        timeout = self.queue_timeout if timeout is None else timeout
+        watcher = None
+        if receive is not None:
+            watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+            watcher.add_done_callback(_gone)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if self._abandon(waiter):
+                raise self._queue_timeout_error(waiter.lane)
+        except _ClientDisconnected:
+            if not self._abandon(waiter, "disconnected") and waiter.granted:
+                self.release(waiter.identity)
+            ADMISSION_REJECTIONS.inc((waiter.lane, "disconnected"))
+            raise HTTPException(status_code=499, detail="Client closed request")
+        except asyncio.CancelledError:
+            if not self._abandon(waiter) and waiter.granted:
+                self.release(waiter.identity)
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        if waiter.shed:
+            raise self._overload_error(waiter.lane)
+        try:
+            yield
+        finally:
+            self.release(waiter.identity)
+
+    def stats(self):
+        with self._lock:
+            lanes = {}
+            for lane in UPSTREAM_LANES:
+                stats = self._stats[lane]
+                dispatched = stats["dispatched"]
+                lanes[lane] = {
+                    "weight": self.lane_weights[lane],
+                    "queue_depth": self._queued[lane],
+                    "queued_identities": len(self._queues[lane]),
+                    "dispatched": dispatched,
+                    "timed_out": stats["timed_out"],
+                    "overloaded": lane in self.admission and self.admission[lane].overloaded,
+                    "rejected": stats["rejected"],
+                    "shed": stats["shed"],
+                    "disconnected": stats["disconnected"],
+                    "wait_seconds_avg": stats["wait_seconds_total"] / dispatched if dispatched else 0.0,
+                    "wait_seconds_max": stats["wait_seconds_max"],
+                }
+            return {
+                "capacity": self.capacity(),
+                "in_flight": self._in_flight,
+                "identity_concurrency": self.identity_concurrency,
+                "lanes": lanes,
+            }
+
+
+# --- Load shedding ----------------------------------------------------------
+#
+# Under a burst, calls would otherwise sit in the scheduler queue until their
+# clients give up, and the proxy would then spend Launchpad calls on answers
+# nobody reads. Each lane (route class) runs CoDel-style admission control
+# on the time calls spend queued:
+#
+#   - at the end of every interval, the lane counts as overloaded for the
+#     next one if even the shortest queue wait seen in it exceeded the
+#     target, i.e. there is a standing queue rather than a passing burst;
+#   - while overloaded, new calls that would have to queue are rejected at
+#     once with 503 and Retry-After, and queued calls that have already
+#     waited twice the target are shed the same way instead of dispatched.
+#
+# Independently, a /devel/* call leaves the queue as soon as its client
+# disconnects.
+#
+#   PROXY_ADMISSION_TARGET_MS    Acceptable queue wait per lane; 0 disables
+#                                 shedding in that lane
+#                                 (default: "login=0,interactive=100,bulk=500").
+#   PROXY_ADMISSION_INTERVAL_MS  CoDel interval (default: 1000).
+
+
+def _parse_admission_targets(value):
+    return _parse_weights(value, {LANE_LOGIN: 0.0, LANE_INTERACTIVE: 100.0, LANE_BULK: 500.0})
+
+
+PROXY_ADMISSION_TARGET_MS = _parse_admission_targets(os.environ.get("PROXY_ADMISSION_TARGET_MS"))
+PROXY_ADMISSION_INTERVAL_MS = float(os.environ.get("PROXY_ADMISSION_INTERVAL_MS", "1000"))
+
+ADMISSION_REJECTIONS = _Counter(
+    "lp_proxy_admission_rejections_total",
+    "Upstream calls turned away by load shedding, by reason "
+    "(overloaded, sojourn or disconnected).",
+    ("lane", "reason"),
+)
+ADMISSION_OVERLOADED = _Gauge(
+    "lp_proxy_admission_overloaded",
+    "1 while a lane is shedding load.",
+    ("lane",),
+    callback=lambda: [
+        ((lane,), int(codel.overloaded)) for lane, codel in _UPSTREAM_SCHEDULER.admission.items()
+    ],
+)
+
+
+class _ClientDisconnected(Exception):
+    pass
+
+
+async def _wait_for_disconnect(receive):
+    """Return once the client of an HTTP request has gone away."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        if message["type"] == "http.request" and not message.get("more_body", False):
+            break
+    # Once the body is complete, receive() blocks until the disconnect; a
+    # server that repeats the body instead never reports it.
+    if (await receive())["type"] != "http.disconnect":
+        await asyncio.Event().wait()
+
+
+class _CoDel:
+    """Controlled-delay overload detection for one scheduler lane, as used
+    for RPC queues: decide once per interval from the minimum sojourn time."""
+
+    def __init__(self, target, interval):
+        self.target = target
+        self.interval = interval
+        self.overloaded = False
+        self._min_sojourn = None
+        self._interval_end = time.monotonic() + interval
+
+    def _roll(self, now):
+        if now < self._interval_end:
+            return
+        self.overloaded = self._min_sojourn is not None and self._min_sojourn > self.target
+        self._min_sojourn = None
+        self._interval_end = now + self.interval
+
+    def observe(self, sojourn, now):
+        """Record the queue wait of a dequeued call. Returns True if the
+        call should be shed."""
+        if self._min_sojourn is None or sojourn < self._min_sojourn:
+            self._min_sojourn = sojourn
+        self._roll(now)
+        return self.overloaded and sojourn > 2 * self.target
+
+    def admit(self, now):
+        """False while the lane is overloaded. An interval without any
+        dequeue carries no evidence of a standing queue and clears it."""
+        self._roll(now)
+        return not self.overloaded
+
+
+def _admission_control(targets_ms, interval_ms):
+    return {
+        lane: _CoDel(target / 1000.0, interval_ms / 1000.0)
+        for lane, target in targets_ms.items()
+        if target > 0 and interval_ms > 0
+    }
+
+
+# --- Adaptive upstream concurrency ------------------------------------------
+#
+# The scheduler's capacity is capped by an AIMD limiter fed with every
+# Launchpad response, so the proxy settles at the concurrency Launchpad can
+# sustain instead of relaying error storms at full rate:
+#
+#   - 429/503/504, timeouts and connection errors shrink the limit
+#     multiplicatively (at most once per smoothed round-trip, so one burst of
+#     failures from the same window only counts once);
+#   - a lane whose smoothed latency rises above PROXY_UPSTREAM_LATENCY_TOLERANCE
+#     times its long-term baseline shrinks the limit the same way;
+#   - healthy responses grow it additively by about one slot per window;
+#   - Retry-After on 429/503 holds the whole queue until it expires.
+#
+#   PROXY_UPSTREAM_ADAPTIVE               "0" disables the limiter (default: "1").
+#   PROXY_UPSTREAM_MIN_CONCURRENCY        Lower bound of the limit (default: 1).
+#   PROXY_UPSTREAM_BACKOFF_FACTOR         Multiplicative decrease (default: 0.7).
+#   PROXY_UPSTREAM_LATENCY_TOLERANCE      Latency increase that counts as
+#                                          congestion (default: 2.0).
+#   PROXY_UPSTREAM_MAX_RETRY_AFTER_SECONDS  Cap on honored Retry-After (default: 60).
+
+PROXY_UPSTREAM_ADAPTIVE = os.environ.get("PROXY_UPSTREAM_ADAPTIVE", "1") != "0"
+PROXY_UPSTREAM_MIN_CONCURRENCY = int(os.environ.get("PROXY_UPSTREAM_MIN_CONCURRENCY", "1"))
+PROXY_UPSTREAM_BACKOFF_FACTOR = float(os.environ.get("PROXY_UPSTREAM_BACKOFF_FACTOR", "0.7"))
+PROXY_UPSTREAM_LATENCY_TOLERANCE = float(
+    os.environ.get("PROXY_UPSTREAM_LATENCY_TOLERANCE", "2.0")
+)
+PROXY_UPSTREAM_MAX_RETRY_AFTER_SECONDS = float(
+    os.environ.get("PROXY_UPSTREAM_MAX_RETRY_AFTER_SECONDS", "60")
+)
+OVERLOAD_STATUSES = frozenset({429, 503, 504})
+
+
+def _parse_retry_after(value, now=None):
+    """Seconds to wait according to a Retry-After header (delta-seconds or
+    HTTP-date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(0.0, when.timestamp() - (time.time() if now is None else now))
+
+
+class _AdaptiveLimiter:
+    FAST_ALPHA = 0.2
+    SLOW_ALPHA = 0.02
+    # Latency samples per lane before the gradient is trusted.
+    WARMUP_SAMPLES = 20
+
+    def __init__(self, initial, min_limit, max_limit, backoff, latency_tolerance, max_pause):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.backoff = min(max(backoff, 0.1), 0.99)
+        self.latency_tolerance = max(1.0, latency_tolerance)
+        self.max_pause = max_pause
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self._lock = threading.Lock()
+        self._latency = {}  # lane -> [samples, fast ewma, slow ewma]
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._stats = {"decreases": 0, "overloads": 0, "congestion": 0, "pauses": 0}
+
+    def configure(self, max_limit):
+        with self._lock:
+            self.max_limit = max(self.min_limit, max_limit)
+            self._limit = min(self._limit, float(self.max_limit))
+
+    def current_limit(self):
+        return int(self._limit)
+
+    def paused_for(self):
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def _round_trip(self):
+        fast = [entry[1] for entry in self._latency.values() if entry[0]]
+        return max(fast) if fast else 0.0
+
+    def _decrease(self, now, reason):
+        if now - self._last_decrease < max(self._round_trip(), 0.05):
+            return
+        self._last_decrease = now
+        self._limit = max(float(self.min_limit), self._limit * self.backoff)
+        self._stats["decreases"] += 1
+        self._stats[reason] += 1
+
+    def observe(self, lane, status, latency, retry_after=None):
+        """Feed one upstream outcome; status is None for timeouts and
+        connection errors."""
+        now = time.monotonic()
+        with self._lock:
+            if status is None or status in OVERLOAD_STATUSES:
+                self._decrease(now, "overloads")
+                pause = _parse_retry_after(retry_after) if status in (429, 503) else None
+                if pause:
+                    self._paused_until = max(
+                        self._paused_until, now + min(pause, self.max_pause)
+                    )
+                    self._stats["pauses"] += 1
+                return
+
+            entry = self._latency.setdefault(lane, [0, latency, latency])
+            entry[0] += 1
+            entry[1] += self.FAST_ALPHA * (latency - entry[1])
+            entry[2] += self.SLOW_ALPHA * (latency - entry[2])
+            if (
+                entry[0] >= self.WARMUP_SAMPLES
+                and entry[1] > entry[2] * self.latency_tolerance
+            ):
+                self._decrease(now, "congestion")
+                return
+            if status < 500:
+                self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.current_limit(),
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "paused_seconds": round(self.paused_for(), 3),
+                "latency_seconds": {
+                    lane: {"recent": round(entry[1], 4), "baseline": round(entry[2], 4)}
+                    for lane, entry in self._latency.items()
+                },
+                **self._stats,
+            }
+
+
+_UPSTREAM_LIMITER = (
+    _AdaptiveLimiter(
+        PROXY_UPSTREAM_CONCURRENCY,
+        PROXY_UPSTREAM_MIN_CONCURRENCY,
+        PROXY_UPSTREAM_CONCURRENCY,
+        PROXY_UPSTREAM_BACKOFF_FACTOR,
+        PROXY_UPSTREAM_LATENCY_TOLERANCE,
+        PROXY_UPSTREAM_MAX_RETRY_AFTER_SECONDS,
+    )
+    if PROXY_UPSTREAM_ADAPTIVE
+    else None
+)
+
+_UPSTREAM_SCHEDULER = _UpstreamScheduler(
+    PROXY_UPSTREAM_CONCURRENCY,
+    PROXY_UPSTREAM_IDENTITY_CONCURRENCY,
+    PROXY_UPSTREAM_LANE_WEIGHTS,
+    PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+    limiter=_UPSTREAM_LIMITER,
+    admission=_admission_control(PROXY_ADMISSION_TARGET_MS, PROXY_ADMISSION_INTERVAL_MS),
+)
+
+
+UPSTREAM_QUEUE_WAIT = _Histogram(
+    "lp_proxy_upstream_queue_wait_seconds", "Time spent waiting for an upstream slot.", ("lane",)
+)
+UPSTREAM_QUEUE_DEPTH = _Gauge(
+    "lp_proxy_upstream_queue_depth",
+    "Upstream calls waiting for a slot.",
+    ("lane",),
+    callback=lambda: [
+        ((lane,), stats["queue_depth"])
+        for lane, stats in _UPSTREAM_SCHEDULER.stats()["lanes"].items()
+    ],
+)
+UPSTREAM_CONCURRENCY_LIMIT = _Gauge(
+    "lp_proxy_upstream_concurrency_limit",
+    "Current (adaptive) upstream concurrency limit.",
+    callback=lambda: [((), _UPSTREAM_SCHEDULER.capacity())],
+)
+
+
+def _client_identity(request):
+    """Fallback identity for callers without Launchpad credentials."""
+    if request is not None and request.client and request.client.host:
+        return f"ip:{request.client.host}"
+    return "anonymous"
+
+
+def _devel_lane(request):
+    hint = request.headers.get("x-lp-proxy-priority", "").strip().lower()
+    if hint in (LANE_INTERACTIVE, LANE_BULK):
+        return hint
+    params = request.query_params
+    if request.method == "GET" and (
+        "ws.op" in params or "ws.start" in params or "ws.size" in params
+    ):
+        return LANE_BULK
+    return LANE_INTERACTIVE
+
+
+# --- Timeouts, deadlines, retries and circuit breaking ---------------------
+#
+# Every upstream attempt gets a connect/read timeout for its route class
+# (the scheduler lane). A client may pass its own remaining budget in the
+# X-Request-Timeout-Ms header; queueing, timeouts and retries then all fit
+# inside that deadline and the proxy answers 504 once it has passed.
+#
+# GETs and the OAuth token endpoints are retried with full-jitter
+# exponential backoff on connection errors, timeouts and 502/503/504. A
+# circuit breaker per Launchpad host opens after consecutive failures, fails
+# calls fast with 503 + Retry-After, and half-opens after a cool-down to let
+# a single probe through.
+#
+#   PROXY_UPSTREAM_TIMEOUTS            "lane=connect:read" seconds per lane
+#                                       (default: "login=3.05:15,interactive=3.05:30,bulk=3.05:120").
+#   PROXY_REQUEST_TIMEOUT_SECONDS      Default deadline for requests without
+#                                       X-Request-Timeout-Ms; 0 means none (default: 0).
+#   PROXY_UPSTREAM_RETRIES             Extra attempts for retryable calls (default: 2).
+#   PROXY_UPSTREAM_RETRY_BACKOFF_SECONDS  Base of the backoff (default: 0.2).
+#   PROXY_BREAKER_FAILURE_THRESHOLD    Consecutive failures that open the
+#                                       circuit (default: 5).
+#   PROXY_BREAKER_RESET_SECONDS        Time the circuit stays open before a
+#                                       probe is let through (default: 30).
+
+
+def _parse_timeouts(value, defaults):
+    """Parse "lane=connect:read,..." into {lane: (connect, read)}."""
+    timeouts = dict(defaults)
+    for item in (value or "").split(","):
+        name, sep, raw = item.partition("=")
+        name = name.strip().lower()
+        if not sep or name not in timeouts:
+            continue
+        connect, _, read = raw.partition(":")
+        try:
+            timeouts[name] = (float(connect), float(read or connect))
+        except ValueError:
+            continue
+    return timeouts
+
+
+PROXY_UPSTREAM_TIMEOUTS = _parse_timeouts(
+    os.environ.get("PROXY_UPSTREAM_TIMEOUTS"),
+    {LANE_LOGIN: (3.05, 15.0), LANE_INTERACTIVE: (3.05, 30.0), LANE_BULK: (3.05, 120.0)},
+)
+PROXY_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("PROXY_REQUEST_TIMEOUT_SECONDS", "0"))
+PROXY_UPSTREAM_RETRIES = int(os.environ.get("PROXY_UPSTREAM_RETRIES", "2"))
+PROXY_UPSTREAM_RETRY_BACKOFF_SECONDS = float(
+    os.environ.get("PROXY_UPSTREAM_RETRY_BACKOFF_SECONDS", "0.2")
+)
+PROXY_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("PROXY_BREAKER_FAILURE_THRESHOLD", "5"))
+PROXY_BREAKER_RESET_SECONDS = float(os.environ.get("PROXY_BREAKER_RESET_SECONDS", "30"))
+RETRYABLE_STATUSES = frozenset({502, 503, 504})
+MAX_RETRY_BACKOFF_SECONDS = 2.0
+MAX_REQUEST_TIMEOUT_SECONDS = 600.0
+
+
+class _RequestContext:
+    """Per-request state shared by the middleware, the endpoints and the
+    upstream helpers (which may run in a worker thread)."""
+
+    __slots__ = (
+        "deadline",
+        "timings",
+        "cache",
+        "identity",
+        "consumer_key",
+        "upstream_status",
+        "upstream_calls",
+    )
+
+    def __init__(self, deadline=None, timings=None):
+        self.deadline = deadline
+        # Stage durations by Server-Timing name; None when nobody reads them.
+        self.timings = timings
+        # "hit" or "miss" once a response cache was consulted.
+        self.cache = None
+        # Who the upstream calls were made for, and how the last one went.
+        self.identity = None
+        self.consumer_key = None
+        self.upstream_status = None
+        self.upstream_calls = 0
+
+
+_REQUEST_CONTEXT = contextvars.ContextVar("lp_api_proxy_request", default=None)
+
+
+def _current_deadline():
+    context = _REQUEST_CONTEXT.get()
+    return context.deadline if context is not None else None
+
+
+def _deadline_from_headers(headers):
+    """Monotonic deadline from X-Request-Timeout-Ms (raw ASGI headers)."""
+    budget = None
+    for name, value in headers:
+        if name == b"x-request-timeout-ms":
+            try:
+                budget = float(value) / 1000.0
+            except ValueError:
+                budget = None
+            break
+    if budget is None or budget <= 0:
+        budget = PROXY_REQUEST_TIMEOUT_SECONDS
+    if budget <= 0:
+        return None
+    return time.monotonic() + min(budget, MAX_REQUEST_TIMEOUT_SECONDS)
+
+
+def _deadline_exceeded():
+    return HTTPException(status_code=504, detail="Request deadline exceeded")
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise _deadline_exceeded()
+    return remaining
+
+
+def _attempt_timeout(lane, deadline):
+    connect, read = PROXY_UPSTREAM_TIMEOUTS.get(lane, PROXY_UPSTREAM_TIMEOUTS[LANE_INTERACTIVE])
+    remaining = _remaining(deadline)
+    if remaining is None:
+        return connect, read
+    return min(connect, remaining), min(read, remaining)
+
+
+def _queue_timeout(deadline):
+    remaining = _remaining(deadline)
+    if remaining is None:
+        return PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS
+    return min(PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS, remaining)
+
+
+def _retry_delay(attempt, deadline, retry_after=None):
+    """Backoff before the next attempt, or None when it would not fit in
+    the deadline."""
+    delay = random.uniform(
+        0, min(MAX_RETRY_BACKOFF_SECONDS, PROXY_UPSTREAM_RETRY_BACKOFF_SECONDS * 2**attempt)
+    )
+    hinted = _parse_retry_after(retry_after)
+    if hinted is not None:
+        if hinted > MAX_RETRY_BACKOFF_SECONDS:
+            return None
+        delay = max(delay, hinted)
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+
+class _CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host, failure_threshold, reset_timeout):
+        self.host = host
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._stats = {"opened": 0, "rejected": 0}
+
+    def before_call(self):
+        """Raise 503 while the circuit is open; let one probe through once
+        the cool-down has passed."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            retry_in = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == self.OPEN and retry_in <= 0:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self._stats["rejected"] += 1
+        raise HTTPException(
+            status_code=503,
+            detail=f"Launchpad ({self.host}) is unavailable; failing fast.",
+            headers={"Retry-After": str(max(1, int(retry_in + 0.999)))},
+        )
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self._stats["opened"] += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self._failures, **self._stats}
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def _breaker_for(url):
+    host = urllib.parse.urlsplit(url).netloc
+    breaker = _BREAKERS.get(host)
+    if breaker is None:
+        with _BREAKERS_LOCK:
+            breaker = _BREAKERS.setdefault(
+                host,
+                _CircuitBreaker(host, PROXY_BREAKER_FAILURE_THRESHOLD, PROXY_BREAKER_RESET_SECONDS),
+            )
+    return breaker
+
+
+def _upstream_error(exc):
+    if isinstance(exc, requests.Timeout):
+        return HTTPException(status_code=504, detail=f"Launchpad timed out: {exc}")
+    return HTTPException(status_code=502, detail=f"Launchpad is unreachable: {exc}")
+
+
+# --- Upstream connections --------------------------------------------------
+#
+# Calls to Launchpad go through one requests.Session per host, so TCP and TLS
+# connections are kept alive and reused across requests instead of being
+# opened for every call. The session's HTTPAdapter keeps up to
+# PROXY_UPSTREAM_POOL_SIZE idle connections; a burst beyond that opens extra
+# connections that are closed after use. Sessions keep no cookies: they are
+# shared by the calls of every user. The lifespan startup opens a connection
+# to each Launchpad host, so the first request does not pay for DNS, TCP and
+# TLS.
+#
+#   PROXY_UPSTREAM_POOL_SIZE  Kept-alive connections per Launchpad host
+#                             (default: twice PROXY_UPSTREAM_CONCURRENCY, to
+#                             leave room for hedged GETs).
+
+PROXY_UPSTREAM_POOL_SIZE = int(
+    os.environ.get("PROXY_UPSTREAM_POOL_SIZE", str(2 * PROXY_UPSTREAM_CONCURRENCY))
+)
+
+_UPSTREAM_SESSIONS = {}
+_UPSTREAM_SESSIONS_LOCK = threading.Lock()
+# A forked worker must not share the connections of the preloading master.
+os.register_at_fork(after_in_child=_UPSTREAM_SESSIONS.clear)
+
+
+def _upstream_session(url):
+    """The shared requests.Session for the host of ``url``."""
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    session = _UPSTREAM_SESSIONS.get(key)
+    if session is None:
+        with _UPSTREAM_SESSIONS_LOCK:
+            session = _UPSTREAM_SESSIONS.get(key)
+            if session is None:
+                session = requests.Session()
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=PROXY_UPSTREAM_POOL_SIZE
+                )
+                session.mount(f"{parts.scheme}://", adapter)
+                _UPSTREAM_SESSIONS[key] = session
+    return session
+
+
+def _session_request(method, url, **kwargs):
+    """requests.request() over the kept-alive connections of the host."""
+    return _upstream_session(url).request(method, url, **kwargs)
+
+
+def _upstream_pool_stats():
+    """Connection pool counters of the session of each host, by host.
+
+    The counters are read from urllib3's pools; a urllib3 that no longer
+    has them reports zeros instead of failing."""
+    stats = {}
+    for (scheme, netloc), session in list(_UPSTREAM_SESSIONS.items()):
+        adapter = session.get_adapter(f"{scheme}://")
+        host = stats[netloc] = {
+            "max_idle": PROXY_UPSTREAM_POOL_SIZE,
+            "idle": 0,
+            "opened": 0,
+            "requests": 0,
+        }
+        try:
+            for manager in (adapter.poolmanager, *adapter.proxy_manager.values()):
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is None or pool.pool is None:
+                        continue
+                    with pool.pool.mutex:
+                        host["idle"] += sum(conn is not None for conn in pool.pool.queue)
+                    host["opened"] += pool.num_connections
+                    host["requests"] += pool.num_requests
+        except AttributeError:
+            pass
+    return stats
+
+
+def _warm_upstream_connections():
+    """Open one kept-alive connection to each Launchpad host with a HEAD
+    request, which leaves its connection in the session's pool."""
+    for url in (LAUNCHPAD_URL, LAUNCHPAD_API):
+        try:
+            _upstream_session(url).head(url, timeout=_attempt_timeout(LANE_INTERACTIVE, None))
+        except Exception:
+            # The first request opens it instead.
+            _LOGGER.debug("Warming the connection to %s failed", url, exc_info=True)
+
+
+# --- Hedged GETs -----------------------------------------------------------
+#
+# Optional request hedging to cut the tail latency of idempotent reads: if a
+# GET has not been answered after the lane's recent PROXY_HEDGE_PERCENTILE
+# latency, a second identical request is sent and whichever answers first
+# wins. Recent latencies are kept in a decaying log-bucket histogram per
+# lane. A token bucket caps the extra load: each GET earns PROXY_HEDGE_BUDGET
+# tokens and a hedge costs one, so at most ~5% of GETs are hedged by default.
+#
+#   PROXY_HEDGE_ENABLED       "1" enables hedging (default: "0").
+#   PROXY_HEDGE_PERCENTILE    Latency percentile used as hedge delay (default: 95).
+#   PROXY_HEDGE_BUDGET        Fraction of GETs that may be hedged (default: 0.05).
+#   PROXY_HEDGE_MIN_DELAY_MS  Lower bound of the hedge delay (default: 10).
+
+PROXY_HEDGE_ENABLED = os.environ.get("PROXY_HEDGE_ENABLED", "0") == "1"
+PROXY_HEDGE_PERCENTILE = float(os.environ.get("PROXY_HEDGE_PERCENTILE", "95"))
+PROXY_HEDGE_BUDGET = float(os.environ.get("PROXY_HEDGE_BUDGET", "0.05"))
+PROXY_HEDGE_MIN_DELAY_MS = float(os.environ.get("PROXY_HEDGE_MIN_DELAY_MS", "10"))
+
+
+class _LatencyHistogram:
+    """Log-bucketed latency histogram that halves its counts every
+    ``half_life`` samples, so percentiles follow recent traffic."""
+
+    BOUNDS = tuple(0.001 * 1.25**i for i in range(60))  # 1ms .. ~650s
+    MIN_SAMPLES = 50
+
+    def __init__(self, half_life=1000):
+        self.half_life = half_life
+        self._lock = threading.Lock()
+        self._counts = [0.0] * (len(self.BOUNDS) + 1)
+        self._total = 0.0
+        self._since_decay = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+            self._total += 1
+            self._since_decay += 1
+            if self._since_decay >= self.half_life:
+                self._counts = [count / 2 for count in self._counts]
+                self._total /= 2
+                self._since_decay = 0
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, or None
+        while there are too few samples."""
+        with self._lock:
+            if self._total < self.MIN_SAMPLES:
+                return None
+            target = self._total * p / 100.0
+            seen = 0.0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= target:
+                    return self.BOUNDS[min(index, len(self.BOUNDS) - 1)]
+            return self.BOUNDS[-1]
+
+
+class _HedgeBudget:
+    def __init__(self, ratio, burst=10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+
+_UPSTREAM_LATENCY = {lane: _LatencyHistogram() for lane in UPSTREAM_LANES}
+_HEDGE_BUDGET = _HedgeBudget(PROXY_HEDGE_BUDGET)
+_HEDGE_STATS = {"eligible": 0, "hedged": 0, "hedge_won": 0}
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=2 * PROXY_UPSTREAM_CONCURRENCY + 4,
+                    thread_name_prefix="lp-hedge",
+                )
+    return _hedge_executor
+
+
+def _close_late_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def _hedged_request(method, url, lane, timeout, kwargs):
+    """_session_request() with a second attempt raced against the first
+    one once the lane's hedge delay has passed."""
+    _HEDGE_STATS["eligible"] += 1
+    _HEDGE_BUDGET.earn()
+    delay = _UPSTREAM_LATENCY[lane].percentile(PROXY_HEDGE_PERCENTILE)
+    if delay is None:
+        return _session_request(method, url, timeout=timeout, **kwargs)
+
+    executor = _get_hedge_executor()
+    first = executor.submit(_session_request, method, url, timeout=timeout, **kwargs)
+    try:
+        return first.result(timeout=max(delay, PROXY_HEDGE_MIN_DELAY_MS / 1000.0))
+    except concurrent.futures.TimeoutError:
+        pass
+    if not _HEDGE_BUDGET.try_spend():
+        return first.result()
+
+    _HEDGE_STATS["hedged"] += 1
+    second = executor.submit(_session_request, method, url, timeout=timeout, **kwargs)
+    pending = {first, second}
+    while pending:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in sorted(done, key=lambda f: f.exception() is not None):
+            if future.exception() is None or not pending:
+                for other in pending:
+                    other.add_done_callback(_close_late_response)
+                if future is second:
+                    _HEDGE_STATS["hedge_won"] += 1
+                return future.result()
+
+
+# --- Upstream record/replay ------------------------------------------------
+#
+# Record mode appends every Launchpad exchange to a cassette, one JSON line
+# per attempt (gzip-compressed if the name ends in ".gz"). Secrets are never
+# written: request headers and bodies are dropped, oauth_* query parameters
+# are removed from URLs, token endpoint responses have their oauth_token and
+# oauth_token_secret replaced, and only a few response headers are kept.
+#
+# Each worker process must record to its own file: "{pid}" in the path is
+# replaced by the process id, and the replay path may be a glob pattern.
+#
+# Replay mode answers upstream calls from a cassette instead of Launchpad.
+# Exchanges are matched on method and URL and served in recorded order
+# (wrapping around), each after its recorded latency divided by the replay
+# speed; unmatched calls fail like an unreachable Launchpad (502).
+# bench/replay.py replays the recorded /devel traffic shape against it.
+#
+#   PROXY_UPSTREAM_RECORD        Cassette file to record to (default: unset).
+#   PROXY_UPSTREAM_REPLAY        Cassette file to replay from; takes precedence
+#                                 over PROXY_UPSTREAM_RECORD (default: unset).
+#   PROXY_UPSTREAM_REPLAY_SPEED  Latency divisor in replay mode; 0 answers at
+#                                 once (default: 1).
+
+PROXY_UPSTREAM_RECORD = os.environ.get("PROXY_UPSTREAM_RECORD", "")
+PROXY_UPSTREAM_REPLAY = os.environ.get("PROXY_UPSTREAM_REPLAY", "")
+PROXY_UPSTREAM_REPLAY_SPEED = float(os.environ.get("PROXY_UPSTREAM_REPLAY_SPEED", "1"))
+
+CASSETTE_HEADERS = ("Content-Type", "Retry-After", "ETag", "Last-Modified", "Location")
+CASSETTE_SECRET_FIELDS = ("oauth_token", "oauth_token_secret")
+SCRUBBED = "scrubbed"
+
+UPSTREAM_REPLAY_MISSES = _Counter(
+    "lp_proxy_upstream_replay_misses_total",
+    "Upstream calls with no recorded response in replay mode.",
+)
+
+
+def _open_cassette(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _cassette_url(url, params=None):
+    """``url`` with ``params`` applied, without OAuth 1.0a query parameters."""
+    if params:
+        prepared = requests.PreparedRequest()
+        prepared.prepare_url(url, params)
+        url = prepared.url
+    parts = urllib.parse.urlsplit(url)
+    if "oauth_" not in parts.query:
+        return url
+    query = [
+        (key, value)
+        for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith("oauth_")
+    ]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def _cassette_body(url, response):
+    """Response body fields for a cassette entry, with OAuth tokens replaced."""
+    content = response.content or b""
+    path = urllib.parse.urlsplit(url).path
+    if path.endswith(("/+request-token", "/+access-token")):
+        fields = urllib.parse.parse_qsl(content.decode("utf-8", "replace"), keep_blank_values=True)
+        return {
+            "body": urllib.parse.urlencode(
+                [(k, SCRUBBED if k in CASSETTE_SECRET_FIELDS else v) for k, v in fields]
+            )
+        }
+    try:
+        return {"body": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"body_b64": base64.b64encode(content).decode()}
+
+
+def _read_cassettes(pattern):
+    """Entries of every cassette matching ``pattern``, oldest first."""
+    entries = []
+    for path in sorted(glob.glob(pattern)) or [pattern]:
+        with _open_cassette(path, "r") as fh:
+            entries.extend(json.loads(line) for line in fh if line.strip())
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries
+
+
+class _CassetteRecorder:
+    def __init__(self, path):
+        self.pattern = path
+        self.path = None
+        self._lock = threading.Lock()
+        self._stream = None
+
+    def record(self, method, url, params, response, elapsed):
+        entry = {
+            "ts": round(time.time(), 3),
+            "method": method,
+            "url": _cassette_url(url, params),
+            "status": response.status_code,
+            "elapsed": round(elapsed, 4),
+            "headers": {
+                name: response.headers[name]
+                for name in CASSETTE_HEADERS
+                if name in response.headers
+            },
+            **_cassette_body(url, response),
+        }
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._stream is None:
+                # Resolved late: gunicorn may fork workers after import.
+                self.path = self.pattern.replace("{pid}", str(os.getpid()))
+                self._stream = _open_cassette(self.path, "a")
+            self._stream.write(line)
+            self._stream.flush()
+
+    def close(self):
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+
+
+class _CassettePlayer:
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._entries = collections.defaultdict(list)
+        self._next = collections.Counter()
+        for entry in _read_cassettes(path):
+            self._entries[(entry["method"], entry["url"])].append(entry)
+
+    def respond(self, method, url, params=None):
+        key = (method, _cassette_url(url, params))
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                entry = None
+            else:
+                entry = entries[self._next[key] % len(entries)]
+                self._next[key] += 1
+        if entry is None:
+            UPSTREAM_REPLAY_MISSES.inc()
+            raise requests.ConnectionError(f"No recorded response for {method} {key[1]}")
+        if self.speed > 0:
+            time.sleep(entry["elapsed"] / self.speed)
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.url = url
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        response.encoding = "utf-8"
+        response.elapsed = datetime.timedelta(seconds=entry["elapsed"])
+        if "body_b64" in entry:
+            response._content = base64.b64decode(entry["body_b64"])
+        else:
+            response._content = entry["body"].encode("utf-8")
+        return response
+
+
+_UPSTREAM_PLAYER = (
+    _CassettePlayer(PROXY_UPSTREAM_REPLAY, PROXY_UPSTREAM_REPLAY_SPEED)
+    if PROXY_UPSTREAM_REPLAY
+    else None
+)
+_UPSTREAM_RECORDER = (
+    _CassetteRecorder(PROXY_UPSTREAM_RECORD)
+    if PROXY_UPSTREAM_RECORD and _UPSTREAM_PLAYER is None
+    else None
+)
+if _UPSTREAM_RECORDER is not None:
+    atexit.register(_UPSTREAM_RECORDER.close)
+
+
+def _send_attempt(method, url, lane, timeout, kwargs):
+    if _UPSTREAM_PLAYER is not None:
+        return _UPSTREAM_PLAYER.respond(method, url, kwargs.get("params"))
+    started = time.monotonic()
+    if PROXY_HEDGE_ENABLED and method == "GET":
+        response = _hedged_request(method, url, lane, timeout, kwargs)
+    else:
+        response = _session_request(method, url, timeout=timeout, **kwargs)
+    if _UPSTREAM_RECORDER is not None:
+        _UPSTREAM_RECORDER.record(
+            method, url, kwargs.get("params"), response, time.monotonic() - started
+        )
+    return response
+
+
+def _upstream_send(method, url, lane, *, retry=False, deadline=None, **kwargs):
+    """Send a request to Launchpad, retrying if allowed, and report every
+    attempt to the limiter and the circuit breaker. The caller must hold a
+    scheduler slot."""
+    breaker = _breaker_for(url)
+    endpoint = _upstream_endpoint(url, kwargs.get("params"))
+    attempts = 1 + (max(0, PROXY_UPSTREAM_RETRIES) if retry else 0)
+    for attempt in range(attempts):
+        timeout = _attempt_timeout(lane, deadline)
+        breaker.before_call()
+        UPSTREAM_IN_FLIGHT.inc((breaker.host,))
+        span = _start_span(
+            f"{method} {endpoint}",
+            SPAN_KIND_CLIENT,
+            {
+                "http.request.method": method,
+                "server.address": breaker.host,
+                "url.full": url,
+                "lp.lane": lane,
+                "lp.attempt": attempt,
+            },
+        )
+        started = time.monotonic()
+        try:
+            response = _send_attempt(method, url, lane, timeout, kwargs)
+        except requests.RequestException as exc:
+            elapsed = time.monotonic() - started
+            if span is not None:
+                span.end(error=type(exc).__name__)
+            UPSTREAM_IN_FLIGHT.dec((breaker.host,))
+            UPSTREAM_DURATION.observe(elapsed, (breaker.host, endpoint))
+            UPSTREAM_RESPONSES.inc((breaker.host, endpoint, "error"))
+            if _UPSTREAM_LIMITER is not None:
+                _UPSTREAM_LIMITER.observe(lane, None, elapsed)
+            breaker.record_failure()
+            delay = _retry_delay(attempt, deadline) if attempt + 1 < attempts else None
+            if delay is None:
+                raise _upstream_error(exc)
+            time.sleep(delay)
+            continue
+
+        elapsed = time.monotonic() - started
+        if span is not None:
+            span.attributes["http.response.status_code"] = response.status_code
+            span.end(error=str(response.status_code) if response.status_code >= 500 else None)
+        UPSTREAM_IN_FLIGHT.dec((breaker.host,))
+        UPSTREAM_DURATION.observe(elapsed, (breaker.host, endpoint))
+        UPSTREAM_RESPONSES.inc((breaker.host, endpoint, str(response.status_code)))
+        retry_after = response.headers.get("Retry-After")
+        if _UPSTREAM_LIMITER is not None:
+            _UPSTREAM_LIMITER.observe(lane, response.status_code, elapsed, retry_after)
+        if response.status_code < 500:
+            _UPSTREAM_LATENCY[lane].observe(elapsed)
+        if response.status_code not in RETRYABLE_STATUSES:
+            breaker.record_success()
+            return response
+        breaker.record_failure()
+        delay = _retry_delay(attempt, deadline, retry_after) if attempt + 1 < attempts else None
+        if delay is None:
+            return response
+        response.close()
+        time.sleep(delay)
+
+
+# --- Per-identity usage accounting and quotas ------------------------------
+#
+# Upstream requests, response bytes and latency are accounted over a sliding
+# window per identity (Launchpad user, raw OAuth token digest or client IP)
+# and per Launchpad consumer key (e.g. "concourse-ci (https://ci.example.com)").
+# Optional quotas reject calls over budget with 429 + Retry-After before they
+# reach Launchpad. The login lane is accounted but never throttled, so a busy
+# pipeline can't lock its owner out of logging in.
+#
+#   PROXY_USAGE_WINDOW_SECONDS          Sliding window length (default: 60).
+#   PROXY_QUOTA_REQUESTS                Max upstream requests per identity and
+#                                        window; 0 disables (default: 0).
+#   PROXY_QUOTA_BYTES                   Max upstream response bytes per identity
+#                                        and window; 0 disables (default: 0).
+#   PROXY_QUOTA_CONSUMER_REQUESTS       Max upstream requests per consumer key
+#                                        and window; 0 disables (default: 0).
+
+PROXY_USAGE_WINDOW_SECONDS = float(os.environ.get("PROXY_USAGE_WINDOW_SECONDS", "60"))
+PROXY_QUOTA_REQUESTS = int(os.environ.get("PROXY_QUOTA_REQUESTS", "0"))
+PROXY_QUOTA_BYTES = int(os.environ.get("PROXY_QUOTA_BYTES", "0"))
+PROXY_QUOTA_CONSUMER_REQUESTS = int(os.environ.get("PROXY_QUOTA_CONSUMER_REQUESTS", "0"))
+_OAUTH1_CONSUMER_KEY_RE = re.compile(r'oauth_consumer_key="([^"]*)"')
+
+
+def _request_consumer_key(kwargs):
+    """Launchpad consumer key of an outgoing call: from its OAuth header, or
+    from the form body of the token endpoints."""
+    authorization = (kwargs.get("headers") or {}).get("Authorization")
+    if authorization:
+        match = _OAUTH1_CONSUMER_KEY_RE.search(authorization)
+        if match:
+            return urllib.parse.unquote(match.group(1))
+    data = kwargs.get("data")
+    if hasattr(data, "get"):
+        return data.get("oauth_consumer_key")
+    return None
+
+
+class _UsageWindow:
+    """Request/byte/latency totals in ``buckets`` time slices."""
+
+    __slots__ = ("slices",)
+
+    def __init__(self):
+        self.slices = collections.deque()  # [slice_start, requests, bytes, latency]
+
+    def add(self, slice_start, nbytes, latency):
+        if self.slices and self.slices[-1][0] == slice_start:
+            entry = self.slices[-1]
+            entry[1] += 1
+            entry[2] += nbytes
+            entry[3] += latency
+        else:
+            self.slices.append([slice_start, 1, nbytes, latency])
+
+    def expire(self, oldest):
+        while self.slices and self.slices[0][0] < oldest:
+            self.slices.popleft()
+
+    def totals(self):
+        requests_, nbytes, latency = 0, 0, 0.0
+        for _, count, size, seconds in self.slices:
+            requests_ += count
+            nbytes += size
+            latency += seconds
+        return requests_, nbytes, latency
+
+
+class _UsageAccounting:
+    IDENTITY = "identity"
+    CONSUMER_KEY = "consumer_key"
+    SLICES = 12
+    MAX_TRACKED = 10000
+
+    def __init__(self, window, quota_requests=0, quota_bytes=0, quota_consumer_requests=0):
+        self._lock = threading.Lock()
+        self._windows = {self.IDENTITY: {}, self.CONSUMER_KEY: {}}
+        self.rejected = 0
+        self.configure(window, quota_requests, quota_bytes, quota_consumer_requests)
+
+    def configure(self, window, quota_requests=0, quota_bytes=0, quota_consumer_requests=0):
+        with self._lock:
+            self.window = max(1.0, window)
+            self.slice_seconds = self.window / self.SLICES
+            self.quota_requests = quota_requests
+            self.quota_bytes = quota_bytes
+            self.quota_consumer_requests = quota_consumer_requests
+
+    def _slice(self, now):
+        return int(now // self.slice_seconds) * self.slice_seconds
+
+    def _oldest(self, now):
+        return self._slice(now) - self.window + self.slice_seconds
+
+    def record(self, identity, consumer_key, nbytes, latency, now=None):
+        now = time.monotonic() if now is None else now
+        slice_start = self._slice(now)
+        with self._lock:
+            for kind, key in ((self.IDENTITY, identity), (self.CONSUMER_KEY, consumer_key)):
+                if not key:
+                    continue
+                windows = self._windows[kind]
+                window = windows.get(key)
+                if window is None:
+                    if len(windows) >= self.MAX_TRACKED:
+                        self._prune(windows, now)
+                    window = windows[key] = _UsageWindow()
+                window.add(slice_start, nbytes, latency)
+
+    def _prune(self, windows, now):
+        oldest = self._oldest(now)
+        for key in list(windows):
+            windows[key].expire(oldest)
+            if not windows[key].slices:
+                del windows[key]
+        while len(windows) >= self.MAX_TRACKED:
+            # Still full: forget whoever was idle longest.
+            del windows[min(windows, key=lambda k: windows[k].slices[-1][0])]
+
+    def tracked(self):
+        """Number of identities and consumer keys with a usage window."""
+        with self._lock:
+            return {kind: len(windows) for kind, windows in self._windows.items()}
+
+    def _retry_after(self, window, now):
+        if not window.slices:
+            return 1
+        return max(1, int(window.slices[0][0] + self.window - now + 0.999))
+
+    def check_quota(self, identity, consumer_key, now=None):
+        """Raise 429 + Retry-After if identity or consumer key is over quota."""
+        now = time.monotonic() if now is None else now
+        oldest = self._oldest(now)
+        checks = (
+            (self.IDENTITY, identity, self.quota_requests, self.quota_bytes),
+            (self.CONSUMER_KEY, consumer_key, self.quota_consumer_requests, 0),
+        )
+        with self._lock:
+            for kind, key, max_requests, max_bytes in checks:
+                if not key or not (max_requests or max_bytes):
+                    continue
+                window = self._windows[kind].get(key)
+                if window is None:
+                    continue
+                window.expire(oldest)
+                count, nbytes, _ = window.totals()
+                if (max_requests and count >= max_requests) or (max_bytes and nbytes >= max_bytes):
+                    self.rejected += 1
+                    retry_after = self._retry_after(window, now)
+                    break
+            else:
+                return
+        raise HTTPException(
+            status_code=429,
+            detail=f"Upstream quota exceeded for {kind.replace('_', ' ')} {key}",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def top(self, kind=IDENTITY, by="requests", limit=20, now=None):
+        now = time.monotonic() if now is None else now
+        oldest = self._oldest(now)
+        rows = []
+        with self._lock:
+            for key, window in list(self._windows.get(kind, {}).items()):
+                window.expire(oldest)
+                count, nbytes, latency = window.totals()
+                if count:
+                    rows.append(
+                        {
+                            "key": key,
+                            "requests": count,
+                            "bytes": nbytes,
+                            "latency_seconds_total": round(latency, 3),
+                            "latency_seconds_avg": round(latency / count, 4),
+                        }
+                    )
+        sort_key = {"bytes": "bytes", "latency": "latency_seconds_total"}.get(by, "requests")
+        rows.sort(key=lambda row: row[sort_key], reverse=True)
+        return rows[:limit]
+
+
+_UPSTREAM_USAGE = _UsageAccounting(
+    PROXY_USAGE_WINDOW_SECONDS,
+    PROXY_QUOTA_REQUESTS,
+    PROXY_QUOTA_BYTES,
+    PROXY_QUOTA_CONSUMER_REQUESTS,
+)
+
+
+def _note_upstream(identity, consumer_key, response=None):
+    context = _REQUEST_CONTEXT.get()
+    if context is None:
+        return
+    context.identity = identity or context.identity
+    context.consumer_key = consumer_key or context.consumer_key
+    if response is not None:
+        context.upstream_status = response.status_code
+        context.upstream_calls += 1
+
+
+def _account_upstream(identity, consumer_key, response, started):
+    _note_upstream(identity, consumer_key, response)
+    _UPSTREAM_USAGE.record(
+        identity, consumer_key, len(response.content or b""), time.monotonic() - started
+    )
+
+
+def _upstream_request(method, url, *, lane=LANE_INTERACTIVE, identity=None, retry=None, **kwargs):
+    """Perform one Launchpad call from a worker thread, within a scheduler
+    slot. GETs are retried unless retry=False is passed."""
+    deadline = _current_deadline()
+    consumer_key = _request_consumer_key(kwargs)
+    _note_upstream(identity, consumer_key)
+    if lane != LANE_LOGIN:
+        _UPSTREAM_USAGE.check_quota(identity, consumer_key)
+    queued = time.monotonic()
+    with _UPSTREAM_SCHEDULER.slot(lane, identity, _queue_timeout(deadline)):
+        started = time.monotonic()
+        _record_timing("queue", started - queued)
+        try:
+            response = _upstream_send(
+                method,
+                url,
+                lane,
+                retry=method == "GET" if retry is None else retry,
+                deadline=deadline,
+                **kwargs,
+            )
+        finally:
+            _record_timing("upstream", time.monotonic() - started)
+    _account_upstream(identity, consumer_key, response, started)
+    return response
+
+
+async def _upstream_request_async(
+    method, url, *, lane=LANE_INTERACTIVE, identity=None, retry=None, receive=None, **kwargs
+):
+    """Perform one Launchpad call from the event loop: wait for a scheduler
+    slot asynchronously, then run the blocking call in the threadpool.
+    ``receive`` is the client's ASGI receive, see _UpstreamScheduler.async_slot()."""
+    deadline = _current_deadline()
+    consumer_key = _request_consumer_key(kwargs)
+    _note_upstream(identity, consumer_key)
+    if lane != LANE_LOGIN:
+        _UPSTREAM_USAGE.check_quota(identity, consumer_key)
+    queued = time.monotonic()
+    async with _UPSTREAM_SCHEDULER.async_slot(
+        lane, identity, _queue_timeout(deadline), receive=receive
+    ):
+        started = time.monotonic()
+        _record_timing("queue", started - queued)
+        try:
+            response = await run_in_threadpool(
+                functools.partial(
+                    _upstream_send,
+                    method,
+                    url,
+                    lane,
+                    retry=method == "GET" if retry is None else retry,
+                    deadline=deadline,
+                    **kwargs,
+                )
+            )
+        finally:
+            _record_timing("upstream", time.monotonic() - started)
+    _account_upstream(identity, consumer_key, response, started)
+    return response
+
+
+class _RequestContextMiddleware:
+    """Set up the _RequestContext for each HTTP request, record the HTTP
+    metrics, the server span of sampled requests and the access log record.
+    Requests picked by the profiler are profiled while they run."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        context = _RequestContext(
+            deadline=_deadline_from_headers(scope["headers"]),
+            timings={} if PROXY_SERVER_TIMING or _ACCESS_LOG is not None else None,
+        )
+        token = _REQUEST_CONTEXT.set(context)
+        route = _metrics_route(scope["path"])
+        status = "500"
+        sent = 0
+        span = _start_server_span(
+            f"{scope['method']} {route}",
+            scope["headers"],
+            {"http.request.method": scope["method"], "http.route": route, "url.path": scope["path"]},
+        )
+        span_token = _CURRENT_SPAN.set(span)
+        profile = None
+        if _PROFILER.armed is not None or PROXY_ADMIN_TOKEN:
+            profile = _PROFILER.claim(scope["headers"])
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+                extra = []
+                if PROXY_SERVER_TIMING:
+                    header = _server_timing_header(context, time.perf_counter() - started)
+                    extra.append((b"server-timing", header.encode()))
+                    extra.append((b"timing-allow-origin", TIMING_ALLOW_ORIGIN))
+                if profile is not None:
+                    extra.append((b"x-lp-proxy-profile-id", profile.id.encode()))
+                if extra:
+                    message["headers"] = list(message.get("headers", [])) + extra
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        _ensure_metrics_flusher()
+        if PROXY_LOOP_WATCHDOG:
+            _LOOP_WATCHDOG.ensure_started()
+        HTTP_IN_FLIGHT.inc((route,))
+        if profile is not None:
+            _PROFILER.attach(profile)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if profile is not None:
+                _PROFILER.detach(profile)
+            HTTP_IN_FLIGHT.dec((route,))
+            HTTP_DURATION.observe(time.perf_counter() - started, (route, scope["method"]))
+            HTTP_REQUESTS.inc((route, scope["method"], status))
+            HTTP_RESPONSE_BYTES.inc((route,), sent)
+            if span is not None:
+                span.attributes["http.response.status_code"] = int(status)
+                span.end(error=status if status.startswith("5") else None)
+            if _ACCESS_LOG is not None:
+                duration = time.perf_counter() - started
+                if _ACCESS_LOG.wanted(int(status), duration):
+                    record = _access_log_record(
+                        scope, route, context, int(status), duration, sent, span
+                    )
+                    _ACCESS_LOG.log(record)
+            _CURRENT_SPAN.reset(span_token)
+            _REQUEST_CONTEXT.reset(token)
+
+
+# --- Response formats ------------------------------------------------------
+#
+# /devel/* answers in JSON unless the client's Accept header prefers
+# MessagePack (application/msgpack, also as application/x-msgpack or
+# application/vnd.msgpack) or CBOR (application/cbor, RFC 8949). Both carry
+# the same document as the JSON body and are cheaper for clients to decode.
+# They are encoded by the C extensions of the optional msgpack and cbor2
+# packages; a format whose package is not installed is not offered, and
+# such requests get JSON. Responses carry "Vary: Accept".
+
+MEDIA_JSON = "application/json"
+MEDIA_MSGPACK = "application/msgpack"
+MEDIA_CBOR = "application/cbor"
+
+_ACCEPTED_MEDIA_TYPES = {
+    "*/*": MEDIA_JSON,
+    "application/*": MEDIA_JSON,
+    "application/json": MEDIA_JSON,
+    "application/msgpack": MEDIA_MSGPACK,
+    "application/x-msgpack": MEDIA_MSGPACK,
+    "application/vnd.msgpack": MEDIA_MSGPACK,
+    "application/cbor": MEDIA_CBOR,
+}
+VARY_ACCEPT = {"Vary": "Accept"}
+
+
+def _negotiate_media_type(accept):
+    """The /devel/* response media type for an Accept header: the first one
+    of the highest quality, JSON by default."""
+    best, best_q = MEDIA_JSON, 0.0
+    for item in (accept or "").split(","):
+        media_range, *params = item.split(";")
+        media_type = _ACCEPTED_MEDIA_TYPES.get(media_range.strip().lower())
+        if media_type is None or (
+            media_type != MEDIA_JSON and media_type not in _BINARY_ENCODERS
+        ):
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+# media type -> encoder of a decoded JSON document
+_BINARY_ENCODERS = {}
+if msgpack is not None:
+    _BINARY_ENCODERS[MEDIA_MSGPACK] = msgpack.packb
+if cbor2 is not None:
+    _BINARY_ENCODERS[MEDIA_CBOR] = cbor2.dumps
+
+
+def _encode_binary(document, media_type):
+    """Encode a decoded JSON document as MessagePack or CBOR."""
+    return _BINARY_ENCODERS[media_type](document)
+
+
+def _render_body(text, media_type=MEDIA_JSON):
+    """The body /devel/* sends for a Launchpad JSON document."""
+    document = json.loads(text)
+    if media_type == MEDIA_JSON:
+        return JSONResponse(document).body
+    return _encode_binary(document, media_type)
+
+
+# --- Response cache and login warm-up --------------------------------------
+#
+# Successful /devel/* GET responses can be kept in memory for a short while
+# and served again without a Launchpad round-trip. Entries are scoped to the
+# Launchpad credential they were fetched with, by a digest of its token and
+# PLAINTEXT signature (which carries the secrets), so they are never shared
+# between users, or between two logins of one user with different
+# permissions, nor served to a header that only knows someone's token.
+# Credentials signed otherwise are not cached. The cache is bounded by the
+# size of the bodies and evicts the least recently used entries first. A
+# POST, PATCH or PUT through the proxy drops the entries of its credential,
+# and a request with "Cache-Control: no-cache" skips the lookup.
+#
+# Each worker process has its own cache. With PROXY_CACHE_DIR, a directory
+# shared by the workers, a write also drops the entries of its credential
+# in the other workers: it sets the modification time of that credential's
+# stamp file there, and a lookup ignores entries fetched before it. Without
+# it, the other workers serve what they cached before the write for up to
+# PROXY_RESPONSE_CACHE_TTL_SECONDS.
+#
+# Right after a login, the PROXY_WARMUP_PATHS of the new user are fetched in
+# the background with the fresh credential, in the bulk lane, so the first
+# requests of the new session are cache hits. Prefetches never delay the
+# login: they are queued to a small thread pool, dropped when its queue is
+# full, and skipped once the login's budget has been spent.
+#
+#   PROXY_RESPONSE_CACHE_TTL_SECONDS  How long a response is served from the
+#                                      cache; 0 disables it (default: 0).
+#   PROXY_RESPONSE_CACHE_MAX_BYTES    Max total size of cached bodies
+#                                      (default: 67108864).
+#   PROXY_CACHE_DIR                   Directory shared by the workers to
+#                                      invalidate each other's entries and
+#                                      pass on admin commands
+#                                      (default: empty, per worker).
+#   PROXY_WARMUP_PATHS                Comma-separated /devel/ paths fetched
+#                                      after a login, "{username}" is the
+#                                      user's name, e.g.
+#                                      "~{username}/super_teams,~{username}/ppas"
+#                                      (default: empty).
+#   PROXY_WARMUP_CONCURRENCY          Max prefetches in flight per worker
+#                                      (default: 2).
+#   PROXY_WARMUP_QUEUE_SIZE           Max prefetches waiting per worker
+#                                      (default: 64).
+#   PROXY_WARMUP_BUDGET_SECONDS       Prefetches of a login not started
+#                                      within this time are skipped
+#                                      (default: 10).
+
+PROXY_RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("PROXY_RESPONSE_CACHE_TTL_SECONDS", "0"))
+PROXY_RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get("PROXY_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+PROXY_CACHE_DIR = os.environ.get("PROXY_CACHE_DIR", "")
+
+
+def _parse_warmup_paths(value):
+    return [path.removeprefix("/").removeprefix("devel/") for path in _parse_csv(value)]
+
+
+PROXY_WARMUP_PATHS = _parse_warmup_paths(os.environ.get("PROXY_WARMUP_PATHS", ""))
+PROXY_WARMUP_CONCURRENCY = int(os.environ.get("PROXY_WARMUP_CONCURRENCY", "2"))
+PROXY_WARMUP_QUEUE_SIZE = int(os.environ.get("PROXY_WARMUP_QUEUE_SIZE", "64"))
+PROXY_WARMUP_BUDGET_SECONDS = float(os.environ.get("PROXY_WARMUP_BUDGET_SECONDS", "10"))
+
+RESPONSE_CACHE_LOOKUPS = _Counter(
+    "lp_proxy_response_cache_lookups_total", "Response cache lookups by result.", ("result",)
+)
+RESPONSE_CACHE_BYTES = _Gauge(
+    "lp_proxy_response_cache_bytes",
+    "Size of the bodies in the response cache.",
+    callback=lambda: [((), _RESPONSE_CACHE.bytes)],
+)
+WARMUP_PREFETCHES = _Counter(
+    "lp_proxy_warmup_prefetches_total",
+    "Login warm-up prefetches by result (ok, error, skipped, dropped).",
+    ("result",),
+)
+
+
+def _cache_target(api, query):
+    """Cache key part of a /devel/ request: its path and sorted query."""
+    params = sorted(urllib.parse.parse_qsl(query, keep_blank_values=True))
+    return f"{api}?{urllib.parse.urlencode(params)}" if params else api
+
+
+class _ResponseCache:
+    """LRU cache of rendered /devel/* GET bodies by ``(scope, target)``."""
+
+    def __init__(self, ttl, max_bytes):
+        self._lock = threading.Lock()
+        # key -> [expires_at, body, identity, hits, fetched_ns]
+        self._entries = collections.OrderedDict()
+        self.bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.configure(ttl, max_bytes)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def configure(self, ttl, max_bytes):
+        with self._lock:
+            self.ttl = ttl
+            self.max_bytes = max(0, max_bytes)
+            if not self.enabled:
+                self._entries.clear()
+                self.bytes = 0
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= len(entry[1])
+            self._stats["evictions"] += 1
+
+    def get(self, key, now=None, not_before_ns=0):
+        """The body cached for ``key``, unless it expired or was fetched
+        before ``not_before_ns`` (a time.time_ns() value)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] <= now or entry[4] < not_before_ns):
+                del self._entries[key]
+                self.bytes -= len(entry[1])
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            entry[3] += 1
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, body, identity=None, now=None, fetched_ns=None):
+        """Cache ``body`` for ``key``; ``fetched_ns`` is the time.time_ns()
+        at which its upstream request was sent."""
+        if not self.enabled or len(body) > self.max_bytes:
+            return
+        now = time.monotonic() if now is None else now
+        fetched_ns = time.time_ns() if fetched_ns is None else fetched_ns
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self._entries[key] = [now + self.ttl, body, identity, 0, fetched_ns]
+            self.bytes += len(body)
+            self._evict()
+
+    def purge(self, scope=None, prefix=None, identity=None):
+        """Drop the entries of ``scope`` whose target starts with ``prefix``
+        and that were fetched for ``identity`` (all with no filter); return
+        how many."""
+        with self._lock:
+            keys = [
+                key
+                for key, entry in self._entries.items()
+                if (scope is None or key[0] == scope)
+                and (prefix is None or key[1].startswith(prefix))
+                and (identity is None or entry[2] == identity)
+            ]
+            for key in keys:
+                self.bytes -= len(self._entries.pop(key)[1])
+            return len(keys)
+
+    def stats(self, top=10, now=None):
+        """Counters, sizes and the ``top`` most hit entries."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            entries = heapq.nlargest(top, self._entries.items(), key=lambda item: item[1][3])
+            return {
+                "enabled": self.enabled,
+                "ttl_seconds": self.ttl,
+                "max_bytes": self.max_bytes,
+                "bytes": self.bytes,
+                "entries": len(self._entries),
+                **self._stats,
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+                "top_keys": [
+                    {
+                        "target": key[1],
+                        "media_type": key[2],
+                        "identity": entry[2],
+                        "hits": entry[3],
+                        "bytes": len(entry[1]),
+                        "expires_in_seconds": round(max(0.0, entry[0] - now), 3),
+                    }
+                    for key, entry in entries
+                ],
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_RESPONSE_CACHE = _ResponseCache(PROXY_RESPONSE_CACHE_TTL_SECONDS, PROXY_RESPONSE_CACHE_MAX_BYTES)
+
+
+class _ScopeStamps:
+    """Times at which the cache entries of a scope were invalidated, shared
+    by the workers as the modification times of empty files in
+    ``directory``."""
+
+    PRUNE_INTERVAL_SECONDS = 60.0
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._pruned = time.monotonic()
+
+    def _path(self, scope):
+        return os.path.join(self.directory, "scope-" + scope.replace(":", "-"))
+
+    def invalidate(self, scope):
+        """Outdate what any worker cached for ``scope`` until now."""
+        now = time.time_ns()
+        path = self._path(scope)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "a"):
+                pass
+            os.utime(path, ns=(now, now))
+        except OSError as exc:
+            _LOGGER.warning("Invalidating %s in %s failed: %s", scope, self.directory, exc)
+        self._prune(now)
+
+    def invalidated_at(self, scope):
+        """The time.time_ns() of the last invalidation of ``scope``, or 0."""
+        try:
+            return os.stat(self._path(scope)).st_mtime_ns
+        except OSError:
+            return 0
+
+    def _prune(self, now):
+        # A stamp older than the TTL only outdates entries that have expired.
+        if time.monotonic() - self._pruned < self.PRUNE_INTERVAL_SECONDS:
+            return
+        self._pruned = time.monotonic()
+        horizon = now - int(max(PROXY_RESPONSE_CACHE_TTL_SECONDS, 0) * 1e9)
+        for path in glob.glob(os.path.join(self.directory, "scope-*")):
+            try:
+                if os.stat(path).st_mtime_ns < horizon:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+_SCOPE_STAMPS = _ScopeStamps(PROXY_CACHE_DIR) if PROXY_CACHE_DIR else None
+
+
+def _scope_invalidated_at(scope):
+    return _SCOPE_STAMPS.invalidated_at(scope) if _SCOPE_STAMPS is not None else 0
+
+
+def _invalidate_scope(scope):
+    """Drop the cached responses of ``scope``, in every worker with
+    PROXY_CACHE_DIR."""
+    _RESPONSE_CACHE.purge(scope)
+    if _SCOPE_STAMPS is not None:
+        _SCOPE_STAMPS.invalidate(scope)
+
+
+class _Warmup:
+    """Background prefetch of PROXY_WARMUP_PATHS into the response cache."""
+
+    def __init__(self, concurrency, queue_size, budget):
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+
+    def pending(self):
+        return self._pending
+
+    def schedule(self, username, credential):
+        """Queue the prefetches of a login; return how many were queued."""
+        if not PROXY_WARMUP_PATHS or not _RESPONSE_CACHE.enabled:
+            return 0
+        deadline = time.monotonic() + self.budget
+        name = urllib.parse.quote(username, safe="")
+        queued = 0
+        for template in PROXY_WARMUP_PATHS:
+            with self._lock:
+                if self._pending >= self.queue_size:
+                    WARMUP_PREFETCHES.inc(("dropped",))
+                    continue
+                self._pending += 1
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.concurrency, thread_name_prefix="lp-warmup"
+                    )
+            self._executor.submit(
+                self._prefetch,
+                template.replace("{username}", name),
+                username,
+                credential,
+                deadline,
+            )
+            queued += 1
+        return queued
+
+    def _prefetch(self, path, username, credential, deadline):
+        try:
+            if time.monotonic() >= deadline:
+                WARMUP_PREFETCHES.inc(("skipped",))
+                return
+            api, _, query = path.partition("?")
+            header = _oauth1_authorization_header(
+                credential.get("oauth_consumer_key", LP_CONSUMER_KEY),
+                LP_CONSUMER_SECRET,
+                token=credential["oauth_token"],
+                token_secret=credential["oauth_token_secret"],
+                signature_method=LP_SIGNATURE_METHOD,
+            )
+            scope = _credential_scope(header)
+            fetched_ns = time.time_ns()
+            response = _upstream_request(
+                "GET",
+                f"{LAUNCHPAD_API}/devel/{api}",
+                lane=LANE_BULK,
+                identity=f"user:{username}",
+                headers={"Authorization": header},
+                params=urllib.parse.parse_qsl(query, keep_blank_values=True),
+            )
+            if response.status_code != requests.codes.ok:
+                WARMUP_PREFETCHES.inc(("error",))
+                return
+            _RESPONSE_CACHE.put(
+                (scope, _cache_target(api, query), MEDIA_JSON),
+                _render_body(response.text),
+                identity=f"user:{username}",
+                fetched_ns=fetched_ns,
+            )
+            WARMUP_PREFETCHES.inc(("ok",))
+        except (requests.RequestException, HTTPException, ValueError):
+            WARMUP_PREFETCHES.inc(("error",))
+        finally:
+            with self._lock:
+                self._pending -= 1
 
-    name = entry.get("name")
-    if isinstance(name, str) and name and " " not in name:
-        names.add(name)
-        full = _group_full_url(name)
-        if full:
-            urls.add(full)
 
-    return names, urls
+_WARMUP = _Warmup(PROXY_WARMUP_CONCURRENCY, PROXY_WARMUP_QUEUE_SIZE, PROXY_WARMUP_BUDGET_SECONDS)
 
 
-def _lp_fetch_groups(oauth_authorization_header, me_data):
-    links = []
-    for key in (
-        "memberships_details_collection_link",
-        "memberships_collection_link",
-        "super_teams_collection_link",
-        "team_memberships_collection_link",
-    ):
-        link = me_data.get(key)
-        if isinstance(link, str) and link:
-            links.append(link)
+# --- Delta responses -------------------------------------------------------
+#
+# A client polling a large /devel/* document can ask for only what changed
+# since the version it holds (RFC 3229 delta encoding). Every JSON GET
+# response carries an ETag, and the last PROXY_DELTA_VERSIONS bodies of each
+# resource are kept per credential scope, as for the response cache. A
+# request with "If-None-Match: <etag>" is answered 304 when the document has
+# not changed. With "A-IM: json-patch" (RFC 6902) or "A-IM: merge-patch"
+# (RFC 7396) as well, it is answered 226 IM Used with a patch from the held
+# version to the current one, and the current ETag. The full body is sent
+# instead when the held version is no longer known, when the change cannot
+# be expressed as a merge patch (a member set to null), or when the patch
+# would not be smaller.
+#
+#   PROXY_DELTA_VERSIONS   Versions kept per resource to diff against; 0
+#                          disables ETags and deltas (default: 0).
+#   PROXY_DELTA_MAX_BYTES  Max total size of the kept versions; the least
+#                          recently used resources are dropped first
+#                          (default: 67108864).
+
+PROXY_DELTA_VERSIONS = int(os.environ.get("PROXY_DELTA_VERSIONS", "0"))
+PROXY_DELTA_MAX_BYTES = int(os.environ.get("PROXY_DELTA_MAX_BYTES", str(64 * 1024 * 1024)))
+
+DELTA_RESPONSES = _Counter(
+    "lp_proxy_delta_responses_total",
+    "Responses to conditional /devel/* GETs by result "
+    "(json-patch, merge-patch, not_modified, unknown_base, full).",
+    ("result",),
+)
 
-    group_names = set()
-    group_urls = set()
-    for link in dict.fromkeys(links):
-        resp = requests.get(link, headers={"Authorization": oauth_authorization_header})
-        if resp.status_code != requests.codes.ok:
-            continue
-        payload = resp.json()
-        for entry in payload.get("entries", []):
-            names, urls = _extract_groups_from_membership_entry(entry)
-            group_names.update(names)
-            group_urls.update(urls)
+MEDIA_JSON_PATCH = "application/json-patch+json"
+MEDIA_MERGE_PATCH = "application/merge-patch+json"
+_DELTA_MEDIA_TYPES = {"json-patch": MEDIA_JSON_PATCH, "merge-patch": MEDIA_MERGE_PATCH}
+VARY_DELTA = {"Vary": "Accept, A-IM"}
+
+
+class _VersionHistory:
+    """The last few JSON bodies of each /devel/* resource by
+    ``(scope, target)``, keyed by their ETags."""
+
+    def __init__(self, versions, max_bytes):
+        self._lock = threading.Lock()
+        # key -> OrderedDict(etag -> body), oldest version first
+        self._resources = collections.OrderedDict()
+        self.bytes = 0
+        self.configure(versions, max_bytes)
+
+    @property
+    def enabled(self):
+        return self.versions > 0
+
+    def configure(self, versions, max_bytes):
+        with self._lock:
+            self.versions = max(0, versions)
+            self.max_bytes = max(0, max_bytes)
+            for key in list(self._resources):
+                self._trim(self._resources[key])
+                if not self._resources[key]:
+                    del self._resources[key]
+            self._evict()
+
+    def _trim(self, versions):
+        while len(versions) > self.versions:
+            _, body = versions.popitem(last=False)
+            self.bytes -= len(body)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._resources:
+            _, versions = self._resources.popitem(last=False)
+            self.bytes -= sum(len(body) for body in versions.values())
+
+    def record(self, key, etag, body):
+        if not self.enabled or len(body) > self.max_bytes:
+            return
+        with self._lock:
+            versions = self._resources.pop(key, None) or collections.OrderedDict()
+            if etag in versions:
+                versions.move_to_end(etag)
+            else:
+                versions[etag] = body
+                self.bytes += len(body)
+                self._trim(versions)
+            self._resources[key] = versions
+            self._evict()
+
+    def get(self, key, etag):
+        with self._lock:
+            versions = self._resources.get(key)
+            return versions.get(etag) if versions is not None else None
+
+    def __len__(self):
+        return len(self._resources)
+
+
+_VERSION_HISTORY = _VersionHistory(PROXY_DELTA_VERSIONS, PROXY_DELTA_MAX_BYTES)
+
+
+def _body_etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _parse_etags(value):
+    """The entity tags of an If-None-Match header, weak ones compared as
+    strong (RFC 9110, section 13.1.2)."""
+    return [tag.removeprefix("W/") for tag in _parse_csv(value or "")]
+
+
+def _requested_delta(value):
+    """The first instance manipulation of an A-IM header the proxy can
+    produce, or None."""
+    for item in _parse_csv(value or ""):
+        name = item.partition(";")[0].strip().lower()
+        if name in _DELTA_MEDIA_TYPES:
+            return name
+    return None
 
-    return sorted(group_names), sorted(group_urls)
 
+def _json_pointer(path, key):
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def _same(old, new):
+    # 1 == 1.0 == True in Python, but not in JSON.
+    return type(old) is type(new) and old == new
+
+
+def _json_patch(old, new, path="", ops=None):
+    """RFC 6902 operations turning the document ``old`` into ``new``.
+    Objects are diffed member by member and arrays element by element, with
+    elements past the end of the shorter one removed or added."""
+    if ops is None:
+        ops = []
+    if type(old) is dict and type(new) is dict:
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _json_pointer(path, key)})
+        for key, value in new.items():
+            if key in old:
+                _json_patch(old[key], value, _json_pointer(path, key), ops)
+            else:
+                ops.append({"op": "add", "path": _json_pointer(path, key), "value": value})
+    elif type(old) is list and type(new) is list:
+        common = min(len(old), len(new))
+        for index in range(common):
+            _json_patch(old[index], new[index], f"{path}/{index}", ops)
+        for index in range(len(old) - 1, common - 1, -1):
+            ops.append({"op": "remove", "path": f"{path}/{index}"})
+        for index in range(common, len(new)):
+            ops.append({"op": "add", "path": f"{path}/{index}", "value": new[index]})
+    elif not _same(old, new):
+        ops.append({"op": "replace", "path": path, "value": new})
+    return ops
+
+
+def _merge_safe(value):
+    """Whether ``value`` survives being applied as a merge patch: nulls in
+    objects would delete members instead."""
+    if type(value) is dict:
+        return all(item is not None and _merge_safe(item) for item in value.values())
+    return True
+
+
+def _merge_patch(old, new):
+    """RFC 7396 merge patch turning ``old`` into ``new``; ValueError if the
+    change is not expressible as one."""
+    if type(old) is not dict or type(new) is not dict:
+        if not _merge_safe(new) or new is None:
+            raise ValueError("not expressible as a merge patch")
+        return new
+    patch = {}
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = _merge_patch(None, value)
+        elif type(old[key]) is dict and type(value) is dict:
+            nested = _merge_patch(old[key], value)
+            if nested:
+                patch[key] = nested
+        elif not _same(old[key], value):
+            patch[key] = _merge_patch(None, value)
+    return patch
+
+
+_DELTA_BUILDERS = {"json-patch": _json_patch, "merge-patch": _merge_patch}
+
+
+def _versioned_response(request, key, body):
+    """The response to a /devel/* JSON GET of resource ``key`` whose current
+    body is ``body``: 304, 226 with a patch, or 200 with the full body."""
+    etag = _body_etag(body)
+    _VERSION_HISTORY.record(key, etag, body)
+    headers = {"ETag": etag, **VARY_DELTA}
+    held = _parse_etags(request.headers.get("if-none-match"))
+    if not held:
+        return Response(body, media_type=MEDIA_JSON, headers=headers)
+    if etag in held or "*" in held:
+        DELTA_RESPONSES.inc(("not_modified",))
+        return Response(status_code=304, headers=headers)
+    manipulation = _requested_delta(request.headers.get("a-im"))
+    base_etag = base = None
+    if manipulation is not None:
+        for base_etag in held:
+            base = _VERSION_HISTORY.get(key, base_etag)
+            if base is not None:
+                break
+    patch = None
+    if base is not None:
+        with _stage("delta"):
+            try:
+                document = _DELTA_BUILDERS[manipulation](json.loads(base), json.loads(body))
+            except ValueError:
+                pass
+            else:
+                patch = JSONResponse(document).body
+    if patch is None or len(patch) >= len(body):
+        DELTA_RESPONSES.inc(("unknown_base" if manipulation and base is None else "full",))
+        return Response(body, media_type=MEDIA_JSON, headers=headers)
+    DELTA_RESPONSES.inc((manipulation,))
+    headers.update({"IM": manipulation, "Delta-Base": base_etag, "Cache-Control": "no-store, im"})
+    return Response(patch, status_code=226, media_type=_DELTA_MEDIA_TYPES[manipulation],
+                    headers=headers)
+
+
+# --- Configuration reload --------------------------------------------------
+#
+# On SIGHUP a worker re-reads PROXY_ENV_FILE (KEY=VALUE lines, as in a
+# systemd EnvironmentFile) and applies the RELOADABLE_SETTINGS in place,
+# keeping its connections, queues, statistics and caches. Every other
+# setting is only read at startup: under gunicorn, SIGHUP the master
+# instead, which re-imports main.py with the new environment (see
+# gunicorn.conf.py) and gracefully replaces the workers; otherwise restart.
+# A reload that fails to parse leaves every setting unchanged. A worker
+# also applies the file when it starts, so one forked later by the master,
+# e.g. after max-requests, does not fall back to the settings of the master.
+#
+#   PROXY_ENV_FILE   Environment file re-read on SIGHUP and when a worker
+#                    starts (default: empty, SIGHUP is ignored).
+
+PROXY_ENV_FILE = os.environ.get("PROXY_ENV_FILE", "")
+
+RELOADABLE_SETTINGS = {
+    "PROXY_JWT_TTL_SECONDS": int,
+    "PROXY_CODE_TTL_SECONDS": int,
+    "LOGIN_SESSION_TTL_SECONDS": int,
+    "PROXY_ALLOWED_ORIGINS": _parse_origins,
+    "PROXY_CORS_MAX_AGE_SECONDS": int,
+    "LP_ALLOW_PERMISSION": _parse_csv,
+    "PROXY_ACCESS_LOG_SAMPLE_RATE": float,
+    "PROXY_ACCESS_LOG_SLOW_MS": float,
+    "PROXY_USAGE_WINDOW_SECONDS": float,
+    "PROXY_QUOTA_REQUESTS": int,
+    "PROXY_QUOTA_BYTES": int,
+    "PROXY_QUOTA_CONSUMER_REQUESTS": int,
+    "PROXY_RESPONSE_CACHE_TTL_SECONDS": float,
+    "PROXY_RESPONSE_CACHE_MAX_BYTES": int,
+    "PROXY_WARMUP_PATHS": _parse_warmup_paths,
+    "PROXY_DELTA_VERSIONS": int,
+    "PROXY_DELTA_MAX_BYTES": int,
+    "PROXY_ADMISSION_TARGET_MS": _parse_admission_targets,
+    "PROXY_ADMISSION_INTERVAL_MS": float,
+    "PROXY_UPSTREAM_CONCURRENCY": int,
+    "PROXY_UPSTREAM_IDENTITY_CONCURRENCY": int,
+    "PROXY_UPSTREAM_LANE_WEIGHTS": _parse_lane_weights,
+    "PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS": float,
+}
+
+CONFIG_RELOADS = _Counter(
+    "lp_proxy_config_reloads_total", "Configuration reloads by result.", ("result",)
+)
 
-def _lp_fetch_me(oauth_token, oauth_token_secret, oauth_consumer_key):
-    auth = _oauth1_authorization_header(
-        oauth_consumer_key,
-        LP_CONSUMER_SECRET,
-        token=oauth_token,
-        token_secret=oauth_token_secret,
-        signature_method=LP_SIGNATURE_METHOD,
-    )
-    resp = requests.get(
-        f"{LAUNCHPAD_API}/devel/people/+me",
-        headers={"Authorization": auth},
+
+def _read_env_file(path):
+    env = {}
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            name, _, value = line.partition("=")
+            env[name.strip()] = value.strip()
+    return env
+
+
+def _apply_settings(values):
+    """Install already parsed RELOADABLE_SETTINGS ``values``."""
+    global TIMING_ALLOW_ORIGIN
+    globals().update(values)
+    if "PROXY_ALLOWED_ORIGINS" in values or "PROXY_CORS_MAX_AGE_SECONDS" in values:
+        cors_origins = PROXY_ALLOWED_ORIGINS or ["*"]
+        TIMING_ALLOW_ORIGIN = ", ".join(cors_origins).encode()
+        for middleware in app.user_middleware:
+            if middleware.cls is CORSMiddleware:
+                middleware.kwargs["allow_origins"] = cors_origins
+                middleware.kwargs["max_age"] = PROXY_CORS_MAX_AGE_SECONDS
+        # Rebuilt on the next request; requests in flight finish on the old one.
+        app.middleware_stack = None
+    if _ACCESS_LOG is not None:
+        _ACCESS_LOG.sample_rate = PROXY_ACCESS_LOG_SAMPLE_RATE
+        _ACCESS_LOG.slow_seconds = PROXY_ACCESS_LOG_SLOW_MS / 1000.0
+    _UPSTREAM_USAGE.configure(
+        PROXY_USAGE_WINDOW_SECONDS,
+        PROXY_QUOTA_REQUESTS,
+        PROXY_QUOTA_BYTES,
+        PROXY_QUOTA_CONSUMER_REQUESTS,
     )
-    if resp.status_code != requests.codes.ok:
-        raise HTTPException(
-            status_code=502,
-            detail=f"Failed to fetch Launchpad user info: {resp.text}",
+    _RESPONSE_CACHE.configure(PROXY_RESPONSE_CACHE_TTL_SECONDS, PROXY_RESPONSE_CACHE_MAX_BYTES)
+    _VERSION_HISTORY.configure(PROXY_DELTA_VERSIONS, PROXY_DELTA_MAX_BYTES)
+    if "PROXY_ADMISSION_TARGET_MS" in values or "PROXY_ADMISSION_INTERVAL_MS" in values:
+        _UPSTREAM_SCHEDULER.admission = _admission_control(
+            PROXY_ADMISSION_TARGET_MS, PROXY_ADMISSION_INTERVAL_MS
         )
-    data = resp.json()
-    groups, groups_full = _lp_fetch_groups(auth, data)
-    username = data.get("name", oauth_token)
-    email = _lp_extract_preferred_email(data)
-    user = {
-        "sub": username,
-        "username": username,
-        "user_id": username,
-        "name": data.get("display_name", data.get("name", "")),
-        "profile": data.get(
-            "web_link", f"https://launchpad.net/~{data.get('name', '')}"
-        ),
-        "groups": groups,
-        "groups_full": groups_full,
-    }
-    if email:
-        user["email"] = email
-        user["email_verified"] = True
-    return user
+    _UPSTREAM_SCHEDULER.configure(
+        PROXY_UPSTREAM_CONCURRENCY,
+        PROXY_UPSTREAM_IDENTITY_CONCURRENCY,
+        PROXY_UPSTREAM_LANE_WEIGHTS,
+        PROXY_UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+    )
 
 
-def _lp_extract_preferred_email(me_data):
-    """Best-effort extraction of the user's preferred email address.
+def _reload_settings(env):
+    """Apply the RELOADABLE_SETTINGS of ``env`` that changed.
 
-    Launchpad's people/+me resource exposes ``preferred_email_address_link``,
-    a URL of the form ``.../~user/+email/<address>``. The email address is
-    URL-encoded as the final path segment, so we can read it directly without
-    an extra authenticated round-trip to Launchpad. Returns None when the
-    field is absent (e.g. hide_email_addresses is set, or the OAuth scope
-    doesn't grant access to it).
-    """
-    link = me_data.get("preferred_email_address_link")
-    if not isinstance(link, str) or "+email/" not in link:
-        return None
-    candidate = link.rsplit("+email/", 1)[-1]
-    candidate = urllib.parse.unquote(candidate)
-    # Basic sanity check — don't propagate garbage as an email claim.
-    if "@" not in candidate or " " in candidate:
-        return None
-    return candidate
+    Returns ``(applied, ignored)``: the names of the settings applied and of
+    the other changed settings, which need a restart."""
+    values = {}
+    ignored = []
+    for name, raw in env.items():
+        parse = RELOADABLE_SETTINGS.get(name)
+        if parse is None:
+            if os.environ.get(name, "") != raw:
+                ignored.append(name)
+            continue
+        value = parse(raw)
+        if value != globals()[name]:
+            values[name] = value
+    if values:
+        _apply_settings(values)
+        for name in values:
+            os.environ[name] = env[name]
+    return sorted(values), sorted(ignored)
+
+
+def _handle_sighup():
+    if not PROXY_ENV_FILE:
+        return
+    try:
+        applied, ignored = _reload_settings(_read_env_file(PROXY_ENV_FILE))
+    except (OSError, ValueError) as exc:
+        CONFIG_RELOADS.inc(("error",))
+        _LOGGER.error("Configuration reload from %s failed: %s", PROXY_ENV_FILE, exc)
+        return
+    CONFIG_RELOADS.inc(("ok",))
+    _LOGGER.warning(
+        "Configuration reloaded from %s: applied %s",
+        PROXY_ENV_FILE,
+        ", ".join(applied) or "nothing",
+    )
+    if ignored:
+        _LOGGER.warning("Changed settings that need a restart: %s", ", ".join(ignored))
 
 
-# Authorization header resolver (Bearer JWT -> OAuth 1.0a)
+def _apply_env_file():
+    """Bring a starting worker up to date with PROXY_ENV_FILE. Under
+    gunicorn, a worker forked to replace one that reached max-requests or
+    died starts from the master's settings, which a SIGHUP to the workers
+    did not change."""
+    if not PROXY_ENV_FILE:
+        return
+    try:
+        applied, _ = _reload_settings(_read_env_file(PROXY_ENV_FILE))
+    except (OSError, ValueError) as exc:
+        _LOGGER.error("Applying %s at startup failed: %s", PROXY_ENV_FILE, exc)
+        return
+    if applied:
+        _LOGGER.info("Applied from %s at startup: %s", PROXY_ENV_FILE, ", ".join(applied))
 
 
-def _resolve_authorization_header(authorization):
-    """Pass-through for raw OAuth 1.0a headers; translate Bearer JWT issued
-    by /oauth2/token into a fresh OAuth 1.0a signed header."""
-    if not authorization or not authorization.startswith("Bearer "):
-        return authorization
+# --- Startup and health probes ---------------------------------------------
+#
+# The lifespan startup loads the RSA signing key and renders the JWKS (and,
+# with PROXY_BASE_URL, the discovery) document before a worker takes
+# traffic, so the first login does not pay for them, and opens a connection
+# to each Launchpad host in the background (see "Upstream connections").
+# gunicorn.conf.py preloads main.py and loads the key in the master, so
+# forked workers share one key.
+#
+# GET /healthz is the liveness probe: 200 as long as the process serves HTTP.
+# GET /readyz is the readiness probe: 200 once startup has finished, 503
+# before that and after shutdown has begun, so a load balancer only sends
+# requests to warm workers.
 
-    token = authorization[len("Bearer "):]
-    if not PROXY_JWT_SECRET or token.count(".") != 2:
-        return authorization
+_READINESS = {"status": "starting"}
 
-    claims = _verify_jwt(token, audience=PROXY_JWT_AUDIENCE)
-    if claims.get("typ") != "lp-access" or "lp_cred" not in claims:
-        raise HTTPException(status_code=401, detail="Not a valid Launchpad access token")
 
-    cred = json.loads(_fernet().decrypt(claims["lp_cred"].encode()).decode())
-    return _oauth1_authorization_header(
-        cred.get("oauth_consumer_key", LP_CONSUMER_KEY),
-        LP_CONSUMER_SECRET,
-        token=cred["oauth_token"],
-        token_secret=cred["oauth_token_secret"],
-        signature_method=LP_SIGNATURE_METHOD,
-    )
+def _load_signing_key():
+    """Load (or create) the RSA key and pre-render the JWKS document."""
+    _get_rsa_private_key()
+    _jwks_response_body()
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(app):
+    started = time.monotonic()
+    _apply_env_file()
+    await run_in_threadpool(_load_signing_key)
+    if PROXY_BASE_URL:
+        _discovery_document(PROXY_BASE_URL)
+    threading.Thread(target=_warm_upstream_connections, name="lp-warm", daemon=True).start()
+    if _WORKER_COMMANDS is not None:
+        _WORKER_COMMANDS.start()
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGHUP, _handle_sighup)
+        hangup = True
+    except (NotImplementedError, RuntimeError, ValueError):
+        hangup = False  # Not on the main thread, or not on a POSIX system.
+    _READINESS.update(status="ready", startup_seconds=round(time.monotonic() - started, 3))
+    try:
+        yield
+    finally:
+        _READINESS["status"] = "stopping"
+        if _WORKER_COMMANDS is not None:
+            _WORKER_COMMANDS.stop()
+        if hangup:
+            loop.remove_signal_handler(signal.SIGHUP)
 
 
 app = FastAPI(
+    lifespan=_lifespan,
     title="Launchpad API Proxy",
     description="https://github.com/fourdollars/lp-api-proxy/",
     version="0.0.0",
@@ -548,13 +4563,23 @@ app = FastAPI(
 )
 
 origins = PROXY_ALLOWED_ORIGINS if PROXY_ALLOWED_ORIGINS else ["*"]
+# Lets the Resource Timing API of the allowed origins see Server-Timing;
+# expose_headers below lets their scripts read it from fetch() responses.
+TIMING_ALLOW_ORIGIN = ", ".join(origins).encode()
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_methods=["GET", "OPTIONS", "PATCH", "POST", "PUT"],
-    allow_headers=["Authorization"],
+    allow_headers=[
+        "A-IM", "Authorization", "If-None-Match", "X-LP-Proxy-Priority", "X-Request-Timeout-Ms"
+    ],
+    expose_headers=[
+        "Delta-Base", "ETag", "IM", *(["Server-Timing"] if PROXY_SERVER_TIMING else [])
+    ],
+    max_age=PROXY_CORS_MAX_AGE_SECONDS,
 )
+app.add_middleware(_RequestContextMiddleware)
 
 # Workaround the stupid reverse proxy server issue from some hosting service.
 # class PathCorrectionMiddleware(BaseHTTPMiddleware):
@@ -570,7 +4595,500 @@ app.add_middleware(
 
 @app.exception_handler(StarletteHTTPException)
 def http_exception_handler(request, exc):
-    return PlainTextResponse(str(exc.detail), status_code=exc.status_code)
+    return PlainTextResponse(
+        str(exc.detail),
+        status_code=exc.status_code,
+        headers=getattr(exc, "headers", None),
+    )
+
+
+# --- Admin endpoints -------------------------------------------------------
+#
+# Operational views into, and runtime tuning of, a single worker process.
+# Disabled (404) unless PROXY_ADMIN_TOKEN is set; callers must send
+# "Authorization: Bearer <token>".
+#
+# A cache purge or a settings change applies to the worker that accepted
+# the request. With PROXY_CACHE_DIR (see "Response cache"), the worker also
+# appends it to a command log there. Every worker polls that log, applies
+# the commands of the others and appends its result to a results log. The
+# endpoint reports the results received within WAIT_SECONDS, by pid; a
+# worker that is slower applies the command all the same.
+
+PROXY_ADMIN_TOKEN = os.environ.get("PROXY_ADMIN_TOKEN", "")
+
+
+class _WorkerCommands:
+    """Admin commands shared by the workers through append-only logs of
+    JSON lines in ``directory``."""
+
+    POLL_SECONDS = 0.5
+    WAIT_SECONDS = 1.0
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.commands_path = os.path.join(directory, "admin-commands.log")
+        self.results_path = os.path.join(directory, "admin-results.log")
+        self.sender = secrets.token_hex(8)
+        self._lock = threading.Lock()
+        self._offset = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _append(path, record):
+        # One write() of a line opened for appending: lines never interleave.
+        with open(path, "a") as fh:
+            fh.write(json.dumps(record) + "\n")
+
+    def start(self):
+        """Apply the commands sent from now on, in a background thread."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError as exc:
+                _LOGGER.error("Admin commands will not reach this worker: %s", exc)
+                return
+            self._offset = self._size(self.commands_path)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="lp-admin-sync", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stop.set()
+        if thread is not None:
+            thread.join()
+
+    def _loop(self):
+        while not self._stop.wait(self.POLL_SECONDS):
+            try:
+                self.poll()
+            except OSError as exc:
+                _LOGGER.warning("Reading %s failed: %s", self.commands_path, exc)
+
+    def send(self, command, result):
+        """Have the other workers apply ``command``, which gave ``result``
+        here; return its id."""
+        command_id = secrets.token_hex(8)
+        self._append(self.commands_path, {"id": command_id, "sender": self.sender, **command})
+        self._append(self.results_path, {"id": command_id, "pid": os.getpid(), **result})
+        return command_id
+
+    def poll(self):
+        """Apply the commands the other workers sent since the last poll."""
+        with self._lock:
+            if self._offset is None:
+                return
+            size = self._size(self.commands_path)
+            if size <= self._offset:
+                return
+            with open(self.commands_path, "rb") as fh:
+                fh.seek(self._offset)
+                data = fh.read(size - self._offset)
+            data = data[: data.rfind(b"\n") + 1]  # Whole lines only.
+            self._offset += len(data)
+        for line in data.splitlines():
+            try:
+                command = json.loads(line)
+            except ValueError:
+                continue
+            if command.get("sender") == self.sender:
+                continue
+            result = _apply_admin_command(command)
+            self._append(self.results_path, {"id": command["id"], "pid": os.getpid(), **result})
+
+    def results(self, command_id, wait=None):
+        """The results of command ``command_id`` received within ``wait``
+        seconds, one per worker."""
+        time.sleep(self.WAIT_SECONDS if wait is None else wait)
+        results = []
+        try:
+            with open(self.results_path) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.pop("id", None) == command_id:
+                        results.append(record)
+        except OSError as exc:
+            _LOGGER.warning("Reading %s failed: %s", self.results_path, exc)
+        return sorted(results, key=lambda record: record["pid"])
+
+
+_WORKER_COMMANDS = _WorkerCommands(PROXY_CACHE_DIR) if PROXY_CACHE_DIR else None
+
+
+def _purge_cache(name, prefix=None, identity=None):
+    if name == "discovery":
+        purged = _discovery_document.cache_info().currsize
+        _discovery_document.cache_clear()
+        return purged
+    return _RESPONSE_CACHE.purge(prefix=prefix, identity=identity)
+
+
+def _apply_admin_command(command):
+    """Apply a command of another worker; return its result."""
+    if command.get("op") == "purge":
+        return {"purged": _purge_cache(command["cache"], command["prefix"], command["identity"])}
+    if command.get("op") == "settings":
+        try:
+            applied, _ = _reload_settings(command["settings"])
+        except ValueError as exc:
+            return {"error": f"Invalid setting: {exc}"}
+        return {"applied": applied}
+    return {"error": f"Unknown command {command.get('op')!r}"}
+
+
+def _fan_out(command, result):
+    """Send ``command``, applied here with ``result``, to the other
+    workers; return the results of all workers."""
+    if _WORKER_COMMANDS is None:
+        return [{"pid": os.getpid(), **result}]
+    try:
+        return _WORKER_COMMANDS.results(_WORKER_COMMANDS.send(command, result))
+    except OSError as exc:
+        _LOGGER.error("Sending %s to the other workers failed: %s", command["op"], exc)
+        return [{"pid": os.getpid(), **result}]
+
+
+def _require_admin(authorization):
+    if not PROXY_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not authorization or not authorization.startswith("Bearer ") or not hmac.compare_digest(
+        authorization[len("Bearer "):].encode(), PROXY_ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=401, detail="Admin token required")
+
+
+@app.get("/admin/consumers", response_class=JSONResponse, include_in_schema=False)
+def admin_consumers(
+    authorization: Union[str, None] = Header(default=None),
+    kind: str = "identity",
+    by: str = "requests",
+    limit: int = 20,
+):
+    """Top upstream consumers over the usage window, by identity or by
+    consumer key, ordered by requests, bytes or latency."""
+    _require_admin(authorization)
+    if kind not in (_UsageAccounting.IDENTITY, _UsageAccounting.CONSUMER_KEY):
+        raise HTTPException(status_code=400, detail="kind must be identity or consumer_key")
+    return {
+        "pid": os.getpid(),
+        "window_seconds": _UPSTREAM_USAGE.window,
+        "quota_rejections": _UPSTREAM_USAGE.rejected,
+        "consumers": _UPSTREAM_USAGE.top(kind, by, max(1, min(limit, 1000))),
+    }
+
+
+@app.post("/admin/profile", response_class=JSONResponse, include_in_schema=False)
+def admin_profile_start(
+    authorization: Union[str, None] = Header(default=None),
+    seconds: float = 0,
+    request_count: int = Query(default=0, alias="requests"),
+    idle: bool = False,
+):
+    """Profile this worker for ``seconds``, or its next ``requests``
+    requests. ``idle=true`` keeps samples of threads waiting for work."""
+    _require_admin(authorization)
+    if (seconds > 0) == (request_count > 0):
+        raise HTTPException(status_code=400, detail="Pass either seconds or requests")
+    profile = _PROFILER.start(
+        seconds=min(seconds, MAX_PROFILE_SECONDS) if seconds > 0 else None,
+        requests=min(request_count, MAX_PROFILE_REQUESTS) if request_count > 0 else None,
+        idle=idle,
+    )
+    return {"pid": os.getpid(), **profile.summary()}
+
+
+@app.get("/admin/profile", response_class=JSONResponse, include_in_schema=False)
+def admin_profile_list(authorization: Union[str, None] = Header(default=None)):
+    _require_admin(authorization)
+    return {"pid": os.getpid(), "profiles": _PROFILER.summaries()}
+
+
+@app.get("/admin/profile/{profile_id}", include_in_schema=False)
+def admin_profile_download(
+    profile_id: str,
+    authorization: Union[str, None] = Header(default=None),
+    format: str = "collapsed",
+):
+    """A finished profile as collapsed stacks or speedscope JSON; 202 with
+    the profile status while it is still collecting."""
+    _require_admin(authorization)
+    if format not in ("collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail="format must be collapsed or speedscope")
+    profile = _PROFILER.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    if not profile.finished:
+        return JSONResponse(profile.summary(), status_code=202)
+    if format == "speedscope":
+        return JSONResponse(
+            profile.speedscope(),
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.speedscope.json"'},
+        )
+    return PlainTextResponse(
+        profile.collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.collapsed.txt"'},
+    )
+
+
+@app.get("/admin/memory", response_class=JSONResponse, include_in_schema=False)
+def admin_memory(authorization: Union[str, None] = Header(default=None)):
+    """RSS, garbage collector and tracemalloc status, and the sizes of the
+    proxy's internal caches and pools, for this worker process."""
+    import gc
+    import tracemalloc
+
+    _require_admin(authorization)
+    tracing = tracemalloc.is_tracing()
+    current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+    return {
+        "pid": os.getpid(),
+        "rss_bytes": _rss_bytes(),
+        "gc": {"counts": gc.get_count(), "objects": len(gc.get_objects())},
+        "tracemalloc": {
+            "tracing": tracing,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "snapshots": _MEMORY_SNAPSHOTS.ids(),
+        },
+        "internal": _internal_sizes(),
+    }
+
+
+@app.post("/admin/memory/tracemalloc", response_class=JSONResponse, include_in_schema=False)
+def admin_memory_tracemalloc(
+    action: str,
+    authorization: Union[str, None] = Header(default=None),
+    frames: int = 1,
+):
+    """Start (keeping ``frames`` frames per allocation) or stop tracemalloc.
+    Stopping drops all snapshots."""
+    import tracemalloc
+
+    _require_admin(authorization)
+    if action == "start":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(max(1, min(frames, 64)))
+    elif action == "stop":
+        tracemalloc.stop()
+        _MEMORY_SNAPSHOTS.clear()
+    else:
+        raise HTTPException(status_code=400, detail="action must be start or stop")
+    return {"pid": os.getpid(), "tracing": tracemalloc.is_tracing()}
+
+
+@app.post("/admin/memory/snapshots", response_class=JSONResponse, include_in_schema=False)
+def admin_memory_snapshot(
+    authorization: Union[str, None] = Header(default=None),
+    group_by: str = "lineno",
+    limit: int = 20,
+):
+    """Take a tracemalloc snapshot and return its id and top allocations."""
+    _require_admin(authorization)
+    if group_by not in MEMORY_GROUPINGS:
+        raise HTTPException(status_code=400, detail="group_by must be filename, lineno or traceback")
+    snapshot_id, snapshot = _MEMORY_SNAPSHOTS.take()
+    stats = snapshot.statistics(group_by)
+    return {
+        "pid": os.getpid(),
+        "id": snapshot_id,
+        "total_bytes": sum(stat.size for stat in stats),
+        "top": [_format_memory_stat(stat, group_by) for stat in stats[: max(1, min(limit, 500))]],
+    }
+
+
+@app.get("/admin/memory/diff", response_class=JSONResponse, include_in_schema=False)
+def admin_memory_diff(
+    base: str,
+    authorization: Union[str, None] = Header(default=None),
+    target: str = "now",
+    group_by: str = "lineno",
+    limit: int = 20,
+):
+    """Largest allocation changes between snapshot ``base`` and snapshot
+    ``target`` (a fresh one by default)."""
+    _require_admin(authorization)
+    if group_by not in MEMORY_GROUPINGS:
+        raise HTTPException(status_code=400, detail="group_by must be filename, lineno or traceback")
+    old = _MEMORY_SNAPSHOTS.get(base)
+    if target == "now":
+        target, new = _MEMORY_SNAPSHOTS.take()
+    else:
+        new = _MEMORY_SNAPSHOTS.get(target)
+    stats = new.compare_to(old, group_by)
+    return {
+        "pid": os.getpid(),
+        "base": base,
+        "target": target,
+        "size_diff_bytes": sum(stat.size_diff for stat in stats),
+        "top": [_format_memory_stat(stat, group_by) for stat in stats[: max(1, min(limit, 500))]],
+    }
+
+
+@app.get("/admin/upstream", response_class=JSONResponse, include_in_schema=False)
+def admin_upstream(authorization: Union[str, None] = Header(default=None)):
+    """Upstream scheduler state: in-flight calls plus queue depth and wait
+    time per lane, for this worker process."""
+    _require_admin(authorization)
+    return {
+        "pid": os.getpid(),
+        "scheduler": _UPSTREAM_SCHEDULER.stats(),
+        "limiter": _UPSTREAM_LIMITER.stats() if _UPSTREAM_LIMITER is not None else None,
+        "breakers": {host: breaker.stats() for host, breaker in list(_BREAKERS.items())},
+        "hedging": {
+            "enabled": PROXY_HEDGE_ENABLED,
+            "delay_seconds": {
+                lane: histogram.percentile(PROXY_HEDGE_PERCENTILE)
+                for lane, histogram in _UPSTREAM_LATENCY.items()
+            },
+            **_HEDGE_STATS,
+        },
+    }
+
+
+@app.get("/admin/upstream/hosts", response_class=JSONResponse, include_in_schema=False)
+def admin_upstream_hosts(authorization: Union[str, None] = Header(default=None)):
+    """Calls to each Launchpad host: calls in flight, responses by status,
+    the connection pool and the circuit breaker, for this worker process."""
+    _require_admin(authorization)
+    hosts = collections.defaultdict(lambda: {"in_flight": 0, "responses": collections.Counter()})
+    for host, pool in _upstream_pool_stats().items():
+        hosts[host]["pool"] = pool
+    for (host,), value in UPSTREAM_IN_FLIGHT.samples():
+        hosts[host]["in_flight"] = value
+    for (host, _, status), value in UPSTREAM_RESPONSES.samples():
+        hosts[host]["responses"][status] += value
+    for host, breaker in list(_BREAKERS.items()):
+        hosts[host]["breaker"] = breaker.stats()
+    return {"pid": os.getpid(), "hosts": hosts}
+
+
+ADMIN_CACHES = ("response", "discovery")
+
+
+@app.get("/admin/caches", response_class=JSONResponse, include_in_schema=False)
+def admin_caches(authorization: Union[str, None] = Header(default=None), top: int = 10):
+    """Hit rates, sizes and the ``top`` most hit keys of this worker's
+    caches."""
+    _require_admin(authorization)
+    discovery = _discovery_document.cache_info()
+    lookups = discovery.hits + discovery.misses
+    return {
+        "pid": os.getpid(),
+        "caches": {
+            "response": _RESPONSE_CACHE.stats(max(0, min(top, 1000))),
+            "discovery": {
+                "entries": discovery.currsize,
+                "max_entries": discovery.maxsize,
+                "hits": discovery.hits,
+                "misses": discovery.misses,
+                "hit_rate": discovery.hits / lookups if lookups else 0.0,
+            },
+        },
+    }
+
+
+@app.post("/admin/caches/{name}/purge", response_class=JSONResponse, include_in_schema=False)
+def admin_cache_purge(
+    name: str,
+    authorization: Union[str, None] = Header(default=None),
+    prefix: Union[str, None] = None,
+    identity: Union[str, None] = None,
+):
+    """Drop the entries of cache ``name``, optionally only those under a
+    /devel/ path ``prefix`` or fetched for ``identity`` (as listed by
+    /admin/consumers), in every worker with PROXY_CACHE_DIR."""
+    _require_admin(authorization)
+    if name not in ADMIN_CACHES:
+        raise HTTPException(status_code=404, detail="Unknown cache")
+    if name == "discovery" and (prefix is not None or identity is not None):
+        raise HTTPException(status_code=400, detail="The discovery cache is purged as a whole")
+    if prefix is not None:
+        prefix = prefix.removeprefix("/").removeprefix("devel/")
+    purged = _purge_cache(name, prefix, identity)
+    workers = _fan_out(
+        {"op": "purge", "cache": name, "prefix": prefix, "identity": identity}, {"purged": purged}
+    )
+    return {"pid": os.getpid(), "cache": name, "purged": purged, "workers": workers}
+
+
+@app.get("/admin/settings", response_class=JSONResponse, include_in_schema=False)
+def admin_settings(authorization: Union[str, None] = Header(default=None)):
+    """Current values of the settings that can be changed at runtime."""
+    _require_admin(authorization)
+    return {
+        "pid": os.getpid(),
+        "settings": {name: globals()[name] for name in RELOADABLE_SETTINGS},
+    }
+
+
+@app.post("/admin/settings", response_class=JSONResponse, include_in_schema=False)
+def admin_settings_update(
+    settings: dict = Body(...),
+    authorization: Union[str, None] = Header(default=None),
+):
+    """Change RELOADABLE_SETTINGS, given as a JSON object of
+    environment-style values, e.g. {"PROXY_UPSTREAM_CONCURRENCY": "32"}, in
+    every worker with PROXY_CACHE_DIR. The next SIGHUP reload applies
+    PROXY_ENV_FILE over them."""
+    _require_admin(authorization)
+    unknown = sorted(name for name in settings if name not in RELOADABLE_SETTINGS)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Not runtime settings: {', '.join(unknown)}"
+        )
+    if not all(isinstance(value, (str, int, float)) for value in settings.values()):
+        raise HTTPException(status_code=400, detail="Values must be strings or numbers")
+    settings = {name: str(value) for name, value in settings.items()}
+    try:
+        applied, _ = _reload_settings(settings)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Invalid setting: {exc}")
+    workers = _fan_out({"op": "settings", "settings": settings}, {"applied": applied})
+    return {
+        "pid": os.getpid(),
+        "applied": applied,
+        "settings": {name: globals()[name] for name in RELOADABLE_SETTINGS},
+        "workers": workers,
+    }
+
+
+if PROXY_METRICS_ENABLED:
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        """Prometheus metrics, aggregated over all workers when
+        PROXY_METRICS_DIR is set."""
+        return PlainTextResponse(
+            _render_metrics(_collect_metrics()),
+            media_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
+@app.get("/healthz", include_in_schema=False)
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz", include_in_schema=False)
+def readyz():
+    return JSONResponse(
+        dict(_READINESS), status_code=200 if _READINESS["status"] == "ready" else 503
+    )
 
 
 @app.get("/example.html", include_in_schema=False)
@@ -585,6 +5103,7 @@ def request_token(
     oauth_consumer_key: Annotated[str, Form()],
     oauth_signature_method: Annotated[str, Form()],
     oauth_signature: Annotated[str, Form()],
+    request: Request = None,
 ):
     data = {
         "oauth_consumer_key": oauth_consumer_key,
@@ -592,7 +5111,14 @@ def request_token(
         "oauth_signature": oauth_signature,
     }
 
-    response = requests.post(f"{LAUNCHPAD_URL}/+request-token", data=data)
+    response = _upstream_request(
+        "POST",
+        f"{LAUNCHPAD_URL}/+request-token",
+        lane=LANE_LOGIN,
+        identity=_client_identity(request),
+        retry=True,
+        data=data,
+    )
 
     if response.status_code == requests.codes.ok:
         return response.text
@@ -623,6 +5149,7 @@ def access_token(
     oauth_consumer_key: Annotated[str, Form()],
     oauth_signature_method: Annotated[str, Form()],
     oauth_signature: Annotated[str, Form()],
+    request: Request = None,
 ):
     data = {
         "oauth_token": oauth_token,
@@ -631,7 +5158,14 @@ def access_token(
         "oauth_signature": oauth_signature,
     }
 
-    response = requests.post(f"{LAUNCHPAD_URL}/+access-token", data=data)
+    response = _upstream_request(
+        "POST",
+        f"{LAUNCHPAD_URL}/+access-token",
+        lane=LANE_LOGIN,
+        identity=_client_identity(request),
+        retry=True,
+        data=data,
+    )
     if response.status_code == requests.codes.ok:
         return response.text
 
@@ -645,7 +5179,11 @@ def access_token(
 def oidc_provider_discovery(request: Request = None):
     """Standard OIDC discovery document. Point Concourse at this proxy by
     setting the OIDC connector issuer to PROXY_BASE_URL."""
-    base = effective_base_url(request)
+    return _discovery_document(effective_base_url(request))
+
+
+@functools.lru_cache(maxsize=16)
+def _discovery_document(base):
     return {
         "issuer": base,
         "authorization_endpoint": f"{base}/oauth2/login",
@@ -680,7 +5218,7 @@ def oidc_provider_discovery(request: Request = None):
 @app.get("/oauth2/jwks", response_class=JSONResponse)
 def launchpad_jwks():
     """JWKS endpoint — Concourse fetches this to verify id_token RS256 signatures."""
-    return _jwks_document()
+    return Response(_jwks_response_body(), media_type="application/json")
 
 
 @app.get("/oauth2/login")
@@ -711,8 +5249,12 @@ def oauth2_launchpad_login(
         url=f"{LAUNCHPAD_URL}/+request-token",
         callback=None,
     )
-    response = requests.post(
+    response = _upstream_request(
+        "POST",
         f"{LAUNCHPAD_URL}/+request-token",
+        lane=LANE_LOGIN,
+        identity=_client_identity(request),
+        retry=True,
         data=request_token_data,
     )
     if response.status_code != requests.codes.ok:
@@ -760,6 +5302,7 @@ def oauth2_launchpad_login(
 def oauth2_launchpad_callback(
     session: Annotated[str, Query()],
     oauth_token: Annotated[str | None, Query()] = None,
+    request: Request = None,
 ):
     """Completes the Launchpad OAuth 1.0a handshake, fetches the user
     profile, then issues a short-lived encrypted authorization code and
@@ -786,8 +5329,13 @@ def oauth2_launchpad_callback(
         http_method="POST",
         url=f"{LAUNCHPAD_URL}/+access-token",
     )
-    response = requests.post(
-        f"{LAUNCHPAD_URL}/+access-token", data=access_token_data
+    response = _upstream_request(
+        "POST",
+        f"{LAUNCHPAD_URL}/+access-token",
+        lane=LANE_LOGIN,
+        identity=_client_identity(request),
+        retry=True,
+        data=access_token_data,
     )
     if response.status_code != requests.codes.ok:
         raise HTTPException(status_code=response.status_code, detail=response.text)
@@ -802,10 +5350,18 @@ def oauth2_launchpad_callback(
         )
 
     user = _lp_fetch_me(lp_token, lp_token_secret, oauth_consumer_key)
+    _WARMUP.schedule(
+        user["username"],
+        {
+            "oauth_token": lp_token,
+            "oauth_token_secret": lp_token_secret,
+            "oauth_consumer_key": oauth_consumer_key,
+        },
+    )
 
-    encrypted_cred = (
-        _fernet()
-        .encrypt(
+    fernet = _fernet()
+    with _stage("credential_encrypt"):
+        encrypted_cred = fernet.encrypt(
             json.dumps(
                 {
                     "oauth_token": lp_token,
@@ -813,9 +5369,7 @@ def oauth2_launchpad_callback(
                     "oauth_consumer_key": oauth_consumer_key,
                 }
             ).encode()
-        )
-        .decode()
-    )
+        ).decode()
 
     code = _sign_jwt(
         {
@@ -971,77 +5525,107 @@ def oauth2_launchpad_userinfo(
     }
 
 
-@app.get("/devel/{api:path}", response_class=JSONResponse)
-async def devel_get(
-    request: Request, api: str, authorization: Union[str, None] = Header(default=None)
-):
+def _devel_response(request, body, media_type, version_key):
+    if version_key is None:
+        return Response(body, media_type=media_type, headers=VARY_ACCEPT)
+    return _versioned_response(request, version_key, body)
+
+
+async def _devel_forward(request, method, api, authorization, **kwargs):
+    resolved_authorization, identity = _resolve_authorization(authorization)
+    identity = identity or _client_identity(request)
+    media_type = _negotiate_media_type(request.headers.get("accept"))
     headers = {}
-    resolved_authorization = _resolve_authorization_header(authorization)
     if resolved_authorization:
         headers["Authorization"] = resolved_authorization
-    response = requests.get(
-        f"{LAUNCHPAD_API}/devel/{api}", headers=headers, params=request.query_params
-    )
+    cache_key = version_key = write_scope = None
+    if _RESPONSE_CACHE.enabled or _VERSION_HISTORY.enabled:
+        scope = (
+            _credential_scope(resolved_authorization)
+            if resolved_authorization
+            else "anonymous"
+        )
+        if scope and method != "GET":
+            write_scope = scope
+        elif scope:
+            target = _cache_target(api, request.url.query)
+            if _VERSION_HISTORY.enabled and media_type == MEDIA_JSON:
+                version_key = (scope, target)
+            if _RESPONSE_CACHE.enabled:
+                cache_key = (scope, target, media_type)
+                body = None
+                if "no-cache" not in request.headers.get("cache-control", ""):
+                    body = _RESPONSE_CACHE.get(
+                        cache_key, not_before_ns=_scope_invalidated_at(scope)
+                    )
+                result = "hit" if body is not None else "miss"
+                RESPONSE_CACHE_LOOKUPS.inc((result,))
+                context = _REQUEST_CONTEXT.get()
+                if context is not None:
+                    context.cache = result
+                if body is not None:
+                    return _devel_response(request, body, media_type, version_key)
+    fetched_ns = time.time_ns()
+    try:
+        response = await _upstream_request_async(
+            method,
+            f"{LAUNCHPAD_API}/devel/{api}",
+            lane=_devel_lane(request),
+            identity=identity,
+            headers=headers,
+            params=request.query_params,
+            receive=request.receive,
+            **kwargs,
+        )
+    finally:
+        # Once the write is done (or failed halfway), what was fetched
+        # before it is stale.
+        if write_scope is not None and _RESPONSE_CACHE.enabled:
+            _invalidate_scope(write_scope)
     if response.status_code == requests.codes.ok:
-        return json.loads(response.text)
-    raise HTTPException(status_code=response.status_code, detail=response.text)
+        with _stage("body"):
+            body = _render_body(response.text, media_type)
+        if cache_key is not None:
+            _RESPONSE_CACHE.put(cache_key, body, identity=identity, fetched_ns=fetched_ns)
+        return _devel_response(request, body, media_type, version_key)
+    retry_after = response.headers.get("Retry-After")
+    raise HTTPException(
+        status_code=response.status_code,
+        detail=response.text,
+        headers={"Retry-After": retry_after} if retry_after else None,
+    )
+
+
+@app.get("/devel/{api:path}", response_class=JSONResponse)
+async def devel_get(
+    request: Request, api: str, authorization: Union[str, None] = Header(default=None)
+):
+    return await _devel_forward(request, "GET", api, authorization)
 
 
 @app.post("/devel/{api:path}", response_class=JSONResponse)
 async def devel_post(
     request: Request, api: str, authorization: Union[str, None] = Header(default=None)
 ):
-    headers = {}
-    resolved_authorization = _resolve_authorization_header(authorization)
-    if resolved_authorization:
-        headers["Authorization"] = resolved_authorization
     payload = await request.form()
-    response = requests.post(
-        f"{LAUNCHPAD_API}/devel/{api}",
-        headers=headers,
-        params=request.query_params,
-        data=payload,
-    )
-    if response.status_code == requests.codes.ok:
-        return json.loads(response.text)
-    raise HTTPException(status_code=response.status_code, detail=response.text)
+    return await _devel_forward(request, "POST", api, authorization, data=payload)
 
 
 @app.patch("/devel/{api:path}", response_class=JSONResponse)
 async def devel_patch(
     request: Request, api: str, authorization: Union[str, None] = Header(default=None)
 ):
-    headers = {}
-    resolved_authorization = _resolve_authorization_header(authorization)
-    if resolved_authorization:
-        headers["Authorization"] = resolved_authorization
     payload = await request.json()
-    response = requests.patch(
-        f"{LAUNCHPAD_API}/devel/{api}",
-        headers=headers,
-        params=request.query_params,
-        data=json.dumps(payload),
+    return await _devel_forward(
+        request, "PATCH", api, authorization, data=json.dumps(payload)
     )
-    if response.status_code == requests.codes.ok:
-        return json.loads(response.text)
-    raise HTTPException(status_code=response.status_code, detail=response.text)
 
 
 @app.put("/devel/{api:path}", response_class=JSONResponse)
 async def devel_put(
     request: Request, api: str, authorization: Union[str, None] = Header(default=None)
 ):
-    headers = {}
-    resolved_authorization = _resolve_authorization_header(authorization)
-    if resolved_authorization:
-        headers["Authorization"] = resolved_authorization
     payload = await request.json()
-    response = requests.put(
-        f"{LAUNCHPAD_API}/devel/{api}",
-        headers=headers,
-        params=request.query_params,
-        data=json.dumps(payload),
+    return await _devel_forward(
+        request, "PUT", api, authorization, data=json.dumps(payload)
     )
-    if response.status_code == requests.codes.ok:
-        return json.loads(response.text)
-    raise HTTPException(status_code=response.status_code, detail=response.text)
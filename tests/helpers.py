@@ -0,0 +1,60 @@
+"""Helpers shared by the tests: call main.app through ASGI without a server,
+and fake Launchpad responses and credentials."""
+
+import asyncio
+import json
+
+import requests
+
+
+def asgi_request(app, method, path, query=b"", headers=(), body=b"", receive=None):
+    """Send one request to ``app`` and return its status, its headers as a
+    dict of lower-case byte strings, and its body. ``receive`` replaces the
+    default one that sends ``body`` at once."""
+    messages = []
+
+    async def receive_body():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query,
+        "root_path": "",
+        "headers": [(b"host", b"testserver"), *headers],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    asyncio.run(app(scope, receive or receive_body, send))
+    start = next(m for m in messages if m["type"] == "http.response.start")
+    content = b"".join(m.get("body", b"") for m in messages if m["type"] == "http.response.body")
+    return start["status"], dict(start["headers"]), content
+
+
+def make_response(body, status=200, headers=None):
+    """A Launchpad response. A ``body`` that is not bytes is sent as JSON."""
+    response = requests.Response()
+    response.status_code = status
+    if isinstance(body, bytes):
+        response._content = body
+    else:
+        response._content = json.dumps(body).encode()
+        headers = {"Content-Type": "application/json", **(headers or {})}
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    return response
+
+
+def oauth_header(token, secret="s"):
+    """A PLAINTEXT-signed OAuth 1.0a Authorization header for ``token``."""
+    return (b"authorization", (
+        f'OAuth oauth_consumer_key="k", oauth_token="{token}", '
+        f'oauth_signature_method="PLAINTEXT", oauth_signature="%26{secret}"'
+    ).encode())
@@ -0,0 +1,104 @@
+import importlib
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from helpers import asgi_request
+
+
+class AccessLogTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "access.log")
+
+    def _use(self, access_log):
+        patcher = mock.patch.object(self.main, "_ACCESS_LOG", access_log)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: access_log._stream and access_log._stream.close())
+        return access_log
+
+    def _records(self, access_log):
+        access_log.drain()
+        with open(self.path) as fh:
+            return [json.loads(line) for line in fh]
+
+    def _authorization(self):
+        cred = self.main._fernet().encrypt(
+            json.dumps({"oauth_token": "t", "oauth_token_secret": "s"}).encode()
+        )
+        token = self.main._sign_jwt(
+            {
+                "typ": "lp-access",
+                "sub": "alice",
+                "aud": self.main.PROXY_JWT_AUDIENCE,
+                "lp_cred": cred.decode(),
+            },
+            60,
+        )
+        return (b"authorization", b"Bearer " + token.encode())
+
+    def test_record_has_identity_upstream_status_and_timings(self):
+        access_log = self._use(self.main._AccessLog(self.path, 100, 1.0, 10))
+        access_log._thread = object()  # write from the test thread only
+        response = mock.Mock(status_code=200, text="{}", content=b"{}", headers={})
+        with mock.patch.object(self.main.requests.Session, "request", return_value=response):
+            asgi_request(
+                self.main.app,
+                "GET",
+                "/devel/people/+me",
+                headers=[self._authorization(), (b"user-agent", b"launchpadlib")],
+            )
+
+        (record,) = self._records(access_log)
+        self.assertEqual("/devel/*", record["route"])
+        self.assertEqual(200, record["status"])
+        self.assertEqual("user:alice", record["identity"])
+        self.assertEqual(200, record["upstream_status"])
+        self.assertEqual(1, record["upstream_calls"])
+        self.assertEqual("launchpadlib", record["user_agent"])
+        for name in ("auth", "decrypt", "upstream", "body"):
+            self.assertIn(name, record["timings_ms"])
+        self.assertIsNone(record["cache"])
+
+    def test_successes_are_sampled_but_errors_and_slow_requests_are_not(self):
+        access_log = self.main._AccessLog(self.path, 100, 0.0, 0.5)
+        self.assertFalse(access_log.wanted(200, 0.1))
+        self.assertTrue(access_log.wanted(404, 0.1))
+        self.assertTrue(access_log.wanted(502, 0.1))
+        self.assertTrue(access_log.wanted(200, 0.6))
+
+    def test_full_queue_drops_and_counts(self):
+        access_log = self.main._AccessLog(self.path, 1, 1.0, 10)
+        access_log._thread = object()
+        access_log.log({"n": 1})
+        access_log.log({"n": 2})
+        self.assertIn([[], 1], self.main.ACCESS_LOG_DROPPED.samples())
+        self.assertEqual([{"n": 1}], self._records(access_log))
+        access_log._stream.close()
+
+    def test_background_writer(self):
+        access_log = self.main._AccessLog(self.path, 100, 1.0, 10)
+        access_log.log({"n": 1})
+        for _ in range(100):
+            if os.path.exists(self.path) and os.path.getsize(self.path):
+                break
+            time.sleep(0.01)
+        with open(self.path) as fh:
+            self.assertEqual({"n": 1}, json.loads(fh.readline()))
+
+
+if __name__ == "__main__":
+    unittest.main()
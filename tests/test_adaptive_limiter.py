@@ -0,0 +1,88 @@
+import importlib
+import os
+import unittest
+from unittest import mock
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def _limiter(self, initial=10):
+        return self.main._AdaptiveLimiter(
+            initial, 1, 20, backoff=0.5, latency_tolerance=2.0, max_pause=60
+        )
+
+    def test_overload_shrinks_limit_once_per_round_trip(self):
+        limiter = self._limiter()
+        limiter.observe("bulk", 429, 0.1)
+        limiter.observe("bulk", 503, 0.1)
+        self.assertEqual(5, limiter.current_limit())
+
+    def test_timeouts_shrink_limit(self):
+        limiter = self._limiter()
+        limiter.observe("interactive", None, 30.0)
+        self.assertEqual(5, limiter.current_limit())
+
+    def test_healthy_responses_grow_limit_up_to_max(self):
+        limiter = self._limiter(initial=2)
+        for _ in range(500):
+            limiter.observe("interactive", 200, 0.1)
+        self.assertEqual(20, limiter.current_limit())
+
+    def test_latency_increase_shrinks_limit(self):
+        limiter = self._limiter()
+        for _ in range(limiter.WARMUP_SAMPLES):
+            limiter.observe("interactive", 200, 0.1)
+        before = limiter.current_limit()
+        for _ in range(10):
+            limiter.observe("interactive", 200, 2.0)
+        self.assertLess(limiter.current_limit(), before)
+        self.assertGreaterEqual(limiter.stats()["congestion"], 1)
+
+    def test_retry_after_pauses_the_scheduler(self):
+        limiter = self._limiter()
+        limiter.observe("bulk", 503, 0.1, retry_after="5")
+        self.assertGreater(limiter.paused_for(), 4)
+
+        scheduler = self.main._UpstreamScheduler(
+            4, 4, {"login": 1, "interactive": 1, "bulk": 1}, 1, limiter=limiter
+        )
+        granted = []
+        scheduler._enqueue("login", "alice", lambda: granted.append(True))
+        self.assertEqual([], granted)
+        scheduler._resume_timer.cancel()
+
+    def test_parse_retry_after_http_date(self):
+        self.assertEqual(
+            30.0,
+            self.main._parse_retry_after("Thu, 01 Jan 1970 00:00:30 GMT", now=0),
+        )
+        self.assertEqual(7.0, self.main._parse_retry_after("7"))
+        self.assertIsNone(self.main._parse_retry_after("soon"))
+
+    def test_scheduler_capacity_follows_limit(self):
+        limiter = self._limiter(initial=3)
+        scheduler = self.main._UpstreamScheduler(
+            10, 10, {"login": 1, "interactive": 1, "bulk": 1}, 1, limiter=limiter
+        )
+        self.assertEqual(3, scheduler.capacity())
+
+    def test_upstream_send_reports_status_to_limiter(self):
+        response = mock.Mock(status_code=429, headers={"Retry-After": "2"})
+        limiter = self._limiter()
+        with mock.patch.object(self.main, "_UPSTREAM_LIMITER", limiter), mock.patch.object(
+            self.main.requests.Session, "request", return_value=response
+        ):
+            self.main._upstream_send("GET", "https://api.launchpad.net/devel/bugs", "bulk")
+        self.assertEqual(5, limiter.current_limit())
+        self.assertGreater(limiter.paused_for(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import importlib
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import asgi_request, make_response, oauth_header
+
+
+ADMIN = (b"authorization", b"Bearer admin-secret")
+
+
+class AdminApiTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        main = self.main
+        original = {name: getattr(main, name) for name in main.RELOADABLE_SETTINGS}
+        self.addCleanup(main._apply_settings, original)
+        for patcher in (
+            mock.patch.dict(os.environ),
+            mock.patch.object(main, "PROXY_ADMIN_TOKEN", "admin-secret"),
+            mock.patch.object(main, "_RESPONSE_CACHE", main._ResponseCache(60, 1 << 20)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _admin(self, method, path, query=b"", body=None):
+        headers = [ADMIN]
+        if body is not None:
+            headers.append((b"content-type", b"application/json"))
+            body = json.dumps(body).encode()
+        status, _, content = asgi_request(
+            self.main.app, method, path, query, headers, body or b""
+        )
+        return status, json.loads(content) if status == 200 else content
+
+    def _fill_cache(self):
+        upstream = mock.Mock(side_effect=lambda *a, **kw: make_response({"ok": True}))
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            for token, path in (
+                ("alice", "/devel/bugs/1"),
+                ("alice", "/devel/bugs/1"),
+                ("alice", "/devel/~alice"),
+                ("bob", "/devel/bugs/2"),
+            ):
+                asgi_request(self.main.app, "GET", path, headers=[oauth_header(token)])
+
+    def test_cache_stats_and_purge(self):
+        self._fill_cache()
+        status, body = self._admin("GET", "/admin/caches", b"top=1")
+        response = body["caches"]["response"]
+        self.assertEqual((3, 1, 3), (response["entries"], response["hits"], response["misses"]))
+        self.assertEqual(0.25, response["hit_rate"])
+        [top] = response["top_keys"]
+        alice = self.main._oauth1_header_identity(oauth_header("alice")[1].decode())
+        self.assertEqual(("bugs/1", alice, 1), (top["target"], top["identity"], top["hits"]))
+        self.assertIn("discovery", body["caches"])
+
+        status, body = self._admin(
+            "POST", "/admin/caches/response/purge", b"prefix=/devel/bugs/&identity=" + alice.encode()
+        )
+        self.assertEqual(1, body["purged"])
+        status, body = self._admin("POST", "/admin/caches/response/purge", b"prefix=bugs")
+        self.assertEqual(1, body["purged"])  # bob's
+        self.assertEqual(1, len(self.main._RESPONSE_CACHE))
+
+        self.assertEqual(404, self._admin("POST", "/admin/caches/nope/purge")[0])
+        self.assertEqual(400, self._admin("POST", "/admin/caches/discovery/purge", b"prefix=x")[0])
+
+    def test_settings_change_limits_at_runtime(self):
+        main = self.main
+        status, body = self._admin("POST", "/admin/settings", body={
+            "PROXY_UPSTREAM_CONCURRENCY": 3,
+            "PROXY_RESPONSE_CACHE_MAX_BYTES": "1024",
+            "PROXY_UPSTREAM_LANE_WEIGHTS": "bulk=2",
+        })
+        self.assertEqual(200, status)
+        self.assertEqual(
+            ["PROXY_RESPONSE_CACHE_MAX_BYTES", "PROXY_UPSTREAM_CONCURRENCY", "PROXY_UPSTREAM_LANE_WEIGHTS"],
+            body["applied"],
+        )
+        self.assertEqual(3, main._UPSTREAM_SCHEDULER.concurrency)
+        self.assertEqual(3, main._UPSTREAM_SCHEDULER.capacity())
+        self.assertEqual(2.0, main._UPSTREAM_SCHEDULER.lane_weights["bulk"])
+        self.assertEqual(1024, main._RESPONSE_CACHE.max_bytes)
+        self.assertEqual(1024, self._admin("GET", "/admin/settings")[1]["settings"][
+            "PROXY_RESPONSE_CACHE_MAX_BYTES"
+        ])
+
+        for settings in (
+            {"PROXY_BASE_URL": "https://elsewhere.example.com"},
+            {"PROXY_UPSTREAM_CONCURRENCY": "many"},
+            {"LP_ALLOW_PERMISSION": ["READ_PUBLIC"]},
+        ):
+            self.assertEqual(400, self._admin("POST", "/admin/settings", body=settings)[0])
+        self.assertEqual(3, main._UPSTREAM_SCHEDULER.concurrency)
+
+    def test_purges_and_settings_reach_every_worker(self):
+        main = self.main
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        other_worker = main._WorkerCommands(tmp.name)
+        apply = mock.Mock(wraps=main._apply_admin_command)
+        for patcher in (
+            mock.patch.object(main, "_WORKER_COMMANDS", main._WorkerCommands(tmp.name)),
+            mock.patch.object(main, "_apply_admin_command", apply),
+            mock.patch.multiple(main._WorkerCommands, POLL_SECONDS=0.01, WAIT_SECONDS=0.5),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        other_worker.start()
+        self.addCleanup(other_worker.stop)
+        self._fill_cache()
+
+        status, body = self._admin("POST", "/admin/caches/response/purge", b"prefix=bugs")
+        self.assertEqual(2, body["purged"])
+        self.assertEqual([2, 0], [worker["purged"] for worker in body["workers"]])
+        apply.assert_called_once_with(mock.ANY)
+        self.assertEqual(
+            {"op": "purge", "cache": "response", "prefix": "bugs", "identity": None},
+            {k: v for k, v in apply.call_args.args[0].items() if k not in ("id", "sender")},
+        )
+
+        status, body = self._admin(
+            "POST", "/admin/settings", body={"PROXY_RESPONSE_CACHE_MAX_BYTES": 4096}
+        )
+        self.assertEqual(
+            [["PROXY_RESPONSE_CACHE_MAX_BYTES"], []],
+            [worker["applied"] for worker in body["workers"]],
+        )
+
+    def test_upstream_hosts(self):
+        self._fill_cache()
+        status, body = self._admin("GET", "/admin/upstream/hosts")
+        host = self.main.urllib.parse.urlsplit(self.main.LAUNCHPAD_API).netloc
+        self.assertEqual(0, body["hosts"][host]["in_flight"])
+        self.assertGreaterEqual(body["hosts"][host]["responses"]["200"], 3)
+        pool = body["hosts"][host]["pool"]
+        self.assertEqual(self.main.PROXY_UPSTREAM_POOL_SIZE, pool["max_idle"])
+        self.assertEqual({"max_idle", "idle", "opened", "requests"}, set(pool))
+
+    def test_admin_token_is_required(self):
+        status, _, _ = asgi_request(self.main.app, "GET", "/admin/caches")
+        self.assertEqual(401, status)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import http.server
+import importlib
+import os
+import socketserver
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from unittest import mock
+
+import requests
+
+from bench import loadgen
+from bench.fake_launchpad import FakeLaunchpad
+from helpers import asgi_request
+
+
+class FakeLaunchpadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+        cls.fake = FakeLaunchpad(teams=3, collection_size=10, page_size=4).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.stop()
+
+    def setUp(self):
+        for name in ("LAUNCHPAD_URL", "LAUNCHPAD_API"):
+            patcher = mock.patch.object(self.main, name, self.fake.url)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.main, "PROXY_ALLOWED_ORIGINS", [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_login_through_the_proxy(self):
+        verifier = "v" * 43
+        challenge = (
+            base64.urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest())
+            .rstrip(b"=")
+            .decode()
+        )
+        status, headers, _ = asgi_request(
+            self.main.app,
+            "GET",
+            "/oauth2/login",
+            urllib.parse.urlencode(
+                {
+                    "redirect_uri": loadgen.REDIRECT_URI,
+                    "code_challenge": challenge,
+                    "code_challenge_method": "S256",
+                }
+            ).encode(),
+        )
+        self.assertEqual(307, status)
+        authorize = headers[b"location"].decode()
+        self.assertTrue(authorize.startswith(f"{self.fake.url}/+authorize-token?"))
+
+        response = requests.get(authorize, allow_redirects=False)
+        self.assertEqual(302, response.status_code)
+        callback = urllib.parse.urlsplit(response.headers["Location"])
+        self.assertIn("oauth_token=", callback.query)
+
+        status, headers, _ = asgi_request(
+            self.main.app, "GET", callback.path, callback.query.encode()
+        )
+        self.assertEqual(307, status)
+        code = urllib.parse.parse_qs(
+            urllib.parse.urlsplit(headers[b"location"].decode()).query
+        )["code"][0]
+        claims = self.main._verify_jwt(code)
+        self.assertEqual("bench-user", claims["user"]["sub"])
+        self.assertEqual("bench-user@example.com", claims["user"]["email"])
+        self.assertEqual(
+            ["bench-team-0", "bench-team-1", "bench-team-2"],
+            claims["user"]["groups"],
+        )
+
+        status, _, body = asgi_request(
+            self.main.app,
+            "POST",
+            "/oauth2/token",
+            headers=[(b"content-type", b"application/x-www-form-urlencoded")],
+            body=urllib.parse.urlencode(
+                {
+                    "grant_type": "authorization_code",
+                    "code": code,
+                    "redirect_uri": loadgen.REDIRECT_URI,
+                    "code_verifier": verifier,
+                }
+            ).encode(),
+        )
+        self.assertEqual(200, status, body)
+        self.assertIn(b"access_token", body)
+
+    def test_collections_are_paginated(self):
+        page = requests.get(f"{self.fake.url}/devel/bugs", params={"ws.start": 8}).json()
+        self.assertEqual(10, page["total_size"])
+        self.assertEqual(2, len(page["entries"]))
+        self.assertNotIn("next_collection_link", page)
+        first = requests.get(f"{self.fake.url}/devel/bugs").json()
+        self.assertIn("ws.start=4", first["next_collection_link"])
+
+    def test_error_injection(self):
+        fake = FakeLaunchpad(error_rate=1.0).start()
+        self.addCleanup(fake.stop)
+        response = requests.post(f"{fake.url}/+request-token", data={})
+        self.assertEqual(503, response.status_code)
+        self.assertEqual("0", response.headers["Retry-After"])
+
+
+class _EchoHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LoadgenUnixSocketTest(unittest.TestCase):
+    def test_proxy_url_goes_over_the_unix_socket(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "proxy.sock")
+        server = _UnixHTTPServer(path, _EchoHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        fake = FakeLaunchpad(collection_size=3).start()
+        self.addCleanup(fake.stop)
+
+        session = loadgen.new_session("http://proxy.sock", path)
+        self.addCleanup(session.close)
+        for _ in range(2):
+            response = session.get("http://proxy.sock/devel/bugs", params={"ws.size": 1})
+            self.assertEqual("/devel/bugs?ws.size=1", response.text)
+        # Other hosts, such as the fake Launchpad, still go over TCP.
+        self.assertEqual(3, session.get(f"{fake.url}/devel/bugs").json()["total_size"])
+
+
+class LoadgenReportTest(unittest.TestCase):
+    def test_percentiles_and_baseline_comparison(self):
+        latencies = [i / 1000 for i in range(1, 101)]
+        self.assertEqual(0.05, loadgen.percentile(latencies, 0.5))
+        self.assertEqual(0.099, loadgen.percentile(latencies, 0.99))
+        changes = loadgen.compare(
+            {"rps": 110, "p99_ms": 9, "cpu_ms_per_request": None},
+            {"rps": 100, "p99_ms": 10, "cpu_ms_per_request": 1.0},
+        )
+        self.assertEqual({"rps": 10.0, "p99_ms": 10.0}, changes)
+        line = loadgen.format_report(
+            {"scenario": "devel", "transport": "unix", "concurrency": 4, "requests": 10,
+             "errors": 0, "seconds": 1.0, "rps": 110, "p50_ms": 1, "p95_ms": 2, "p99_ms": 9,
+             "cpu_ms_per_request": None},
+            changes,
+            "tcp",
+        )
+        self.assertIn("devel  unix", line)
+        self.assertIn("vs tcp: rps +10.0%", line)
+
+
+if __name__ == "__main__":
+    unittest.main()
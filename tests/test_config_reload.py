@@ -0,0 +1,137 @@
+import asyncio
+import importlib
+import os
+import re
+import signal
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import asgi_request
+
+
+class ConfigReloadTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        main = self.main
+        original = {name: getattr(main, name) for name in main.RELOADABLE_SETTINGS}
+        self.addCleanup(main._apply_settings, original)
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.env_file = os.path.join(tmp.name, "lp-api-proxy.env")
+
+    def _write_env(self, **values):
+        with open(self.env_file, "w") as fh:
+            fh.write("# written by the charm\n")
+            for name, value in values.items():
+                fh.write(f"{name}={value}\n")
+
+    def test_reloadable_settings_apply_in_place(self):
+        main = self.main
+        usage = main._UPSTREAM_USAGE
+        self._write_env(
+            PROXY_JWT_TTL_SECONDS="3600",
+            LP_ALLOW_PERMISSION="READ_PUBLIC, WRITE_PUBLIC",
+            PROXY_QUOTA_REQUESTS="100",
+            PROXY_BASE_URL="https://elsewhere.example.com",
+        )
+        applied, ignored = main._reload_settings(main._read_env_file(self.env_file))
+        self.assertEqual(
+            ["LP_ALLOW_PERMISSION", "PROXY_JWT_TTL_SECONDS", "PROXY_QUOTA_REQUESTS"], applied
+        )
+        self.assertEqual(["PROXY_BASE_URL"], ignored)
+        self.assertEqual(3600, main.PROXY_JWT_TTL_SECONDS)
+        self.assertEqual(["READ_PUBLIC", "WRITE_PUBLIC"], main.LP_ALLOW_PERMISSION)
+        self.assertEqual(100, usage.quota_requests)
+        self.assertIs(usage, main._UPSTREAM_USAGE)
+        self.assertEqual("3600", os.environ["PROXY_JWT_TTL_SECONDS"])
+
+        # Nothing changed since: nothing to apply.
+        self.assertEqual(([], ["PROXY_BASE_URL"]), main._reload_settings(
+            main._read_env_file(self.env_file)
+        ))
+
+    def test_allowed_origins_rebuild_cors(self):
+        main = self.main
+        origin = (b"origin", b"https://ci.example.com")
+        self._write_env(PROXY_ALLOWED_ORIGINS="https://ci.example.com/")
+        main._reload_settings(main._read_env_file(self.env_file))
+        self.assertEqual(["https://ci.example.com"], main.PROXY_ALLOWED_ORIGINS)
+        _, headers, _ = asgi_request(main.app, "GET", "/healthz", headers=[origin])
+        self.assertEqual(b"https://ci.example.com", headers[b"access-control-allow-origin"])
+
+        self._write_env(PROXY_ALLOWED_ORIGINS="https://other.example.com")
+        main._reload_settings(main._read_env_file(self.env_file))
+        _, headers, _ = asgi_request(main.app, "GET", "/healthz", headers=[origin])
+        self.assertNotIn(b"access-control-allow-origin", headers)
+
+    def test_preflight_max_age_follows_the_setting(self):
+        main = self.main
+        preflight = [
+            (b"origin", b"https://ci.example.com"),
+            (b"access-control-request-method", b"GET"),
+            (b"access-control-request-headers", b"authorization, a-im"),
+        ]
+        self._write_env(PROXY_CORS_MAX_AGE_SECONDS="7200")
+        main._reload_settings(main._read_env_file(self.env_file))
+        status, headers, _ = asgi_request(main.app, "OPTIONS", "/devel/bugs/1", headers=preflight)
+        self.assertEqual(200, status)
+        self.assertEqual(b"7200", headers[b"access-control-max-age"])
+
+    def test_starting_worker_applies_the_env_file(self):
+        main = self.main
+        self._write_env(PROXY_CODE_TTL_SECONDS="45", PROXY_ALLOWED_ORIGINS="https://ci.example.com")
+
+        async def scenario():
+            async with main.app.router.lifespan_context(main.app):
+                self.assertEqual(45, main.PROXY_CODE_TTL_SECONDS)
+                self.assertEqual(["https://ci.example.com"], main.PROXY_ALLOWED_ORIGINS)
+
+        with mock.patch.object(main, "PROXY_ENV_FILE", self.env_file), \
+                mock.patch.dict(main._READINESS):
+            asyncio.run(scenario())
+
+    def test_charm_reloads_the_same_settings(self):
+        hooks = os.path.join(os.path.dirname(__file__), "..", "hooks", "common.sh")
+        with open(hooks) as fh:
+            match = re.search(r'^RELOADABLE_ENV_KEYS="([^"]*)"', fh.read(), re.MULTILINE)
+        self.assertEqual(sorted(self.main.RELOADABLE_SETTINGS), sorted(match.group(1).split()))
+
+    def test_sighup_reloads_the_env_file(self):
+        main = self.main
+        self._write_env(PROXY_CODE_TTL_SECONDS="30")
+        errors = sum(value for labels, value in main.CONFIG_RELOADS.samples() if labels == ["error"])
+
+        async def scenario():
+            async with main.app.router.lifespan_context(main.app):
+                os.kill(os.getpid(), signal.SIGHUP)
+                await asyncio.sleep(0.05)
+                self.assertEqual(30, main.PROXY_CODE_TTL_SECONDS)
+
+                # A value that does not parse leaves every setting alone.
+                self._write_env(PROXY_CODE_TTL_SECONDS="60", PROXY_JWT_TTL_SECONDS="soon")
+                os.kill(os.getpid(), signal.SIGHUP)
+                await asyncio.sleep(0.05)
+                self.assertEqual(30, main.PROXY_CODE_TTL_SECONDS)
+
+        with mock.patch.object(main, "PROXY_ENV_FILE", self.env_file), \
+                mock.patch.dict(main._READINESS), self.assertLogs("lp_api_proxy"):
+            asyncio.run(scenario())
+        self.assertEqual(
+            errors + 1,
+            sum(value for labels, value in main.CONFIG_RELOADS.samples() if labels == ["error"]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import importlib
+import json
+import os
+import unittest
+from unittest import mock
+
+from helpers import asgi_request, make_response
+
+
+def apply_json_patch(document, ops):
+    """Just enough of RFC 6902 to check the proxy's patches."""
+    document = json.loads(json.dumps(document))
+    for op in ops:
+        tokens = [
+            token.replace("~1", "/").replace("~0", "~") for token in op["path"].split("/")[1:]
+        ]
+        if not tokens:
+            document = op["value"]
+            continue
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token) if isinstance(parent, list) else token]
+        last = tokens[-1]
+        if isinstance(parent, list):
+            last = int(last)
+        if op["op"] == "remove":
+            del parent[last]
+        elif op["op"] == "add" and isinstance(parent, list):
+            parent.insert(last, op["value"])
+        else:
+            parent[last] = op["value"]
+    return document
+
+
+def apply_merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return patch
+    target = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = apply_merge_patch(target.get(key), value)
+    return target
+
+
+BUG = {
+    "id": 1,
+    "title": "Crash on start",
+    "tags": ["a", "b", "c"],
+    "owner": {"name": "alice", "karma": 10},
+    "a/b~c": 1,
+    "description": "x" * 400,
+}
+
+
+class DeltaResponsesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        self.history = self.main._VersionHistory(versions=2, max_bytes=1 << 20)
+        patcher = mock.patch.object(self.main, "_VERSION_HISTORY", self.history)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.documents = []
+        upstream = mock.Mock(side_effect=lambda *a, **kw: make_response(self.documents[-1]))
+        patcher = mock.patch.object(self.main.requests.Session, "request", upstream)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get(self, *headers):
+        return asgi_request(self.main.app, "GET", "/devel/bugs/1", headers=headers)
+
+    def test_json_patch_from_a_known_version(self):
+        self.documents.append(BUG)
+        status, headers, body = self._get()
+        self.assertEqual(200, status)
+        first = headers[b"etag"]
+
+        # Unchanged: 304 with no body.
+        status, headers, body = self._get((b"if-none-match", first))
+        self.assertEqual((304, b""), (status, body))
+        self.assertEqual(first, headers[b"etag"])
+
+        changed = json.loads(json.dumps(BUG))
+        changed["title"] = "Crash on start (again)"
+        changed["tags"] = ["a", "c"]
+        changed["owner"]["karma"] = 11
+        changed["a/b~c"] = 2
+        del changed["id"]
+        self.documents.append(changed)
+        status, headers, body = self._get(
+            (b"if-none-match", first), (b"a-im", b"vcdiff, json-patch")
+        )
+        self.assertEqual(226, status)
+        self.assertEqual(b"application/json-patch+json", headers[b"content-type"])
+        self.assertEqual((b"json-patch", first), (headers[b"im"], headers[b"delta-base"]))
+        self.assertNotEqual(first, headers[b"etag"])
+        ops = json.loads(body)
+        self.assertIn({"op": "replace", "path": "/a~1b~0c", "value": 2}, ops)
+        self.assertEqual(changed, apply_json_patch(BUG, ops))
+
+        # Without A-IM a changed document comes in full.
+        status, _, body = self._get((b"if-none-match", first))
+        self.assertEqual((200, changed), (status, json.loads(body)))
+
+    def test_merge_patch_and_fallbacks(self):
+        self.documents.append(BUG)
+        first = self._get()[1][b"etag"]
+        changed = dict(BUG, title="Renamed", owner={"name": "bob", "karma": 10})
+        self.documents.append(changed)
+        status, headers, body = self._get((b"if-none-match", first), (b"a-im", b"merge-patch"))
+        self.assertEqual(226, status)
+        self.assertEqual(b"application/merge-patch+json", headers[b"content-type"])
+        self.assertEqual({"title": "Renamed", "owner": {"name": "bob"}}, json.loads(body))
+        self.assertEqual(changed, apply_merge_patch(BUG, json.loads(body)))
+
+        # A member set to null cannot be merge-patched: full body.
+        self.documents.append(dict(changed, title=None))
+        status, _, body = self._get((b"if-none-match", first), (b"a-im", b"merge-patch"))
+        self.assertEqual(200, status)
+        self.assertIsNone(json.loads(body)["title"])
+
+        # Only two versions are kept: the first one is gone.
+        self.documents.append(dict(changed, title="Third"))
+        status, _, body = self._get((b"if-none-match", first), (b"a-im", b"json-patch"))
+        self.assertEqual((200, "Third"), (status, json.loads(body)["title"]))
+
+    def test_history_is_bounded_and_scoped(self):
+        history = self.main._VersionHistory(versions=2, max_bytes=10)
+        history.record(("s", "a"), "1", b"aaaa")
+        history.record(("s", "a"), "2", b"aaab")
+        history.record(("s", "a"), "3", b"aaac")
+        self.assertIsNone(history.get(("s", "a"), "1"))
+        self.assertIsNone(history.get(("t", "a"), "2"))
+        history.record(("s", "b"), "1", b"bbbb")  # evicts the whole of a
+        self.assertEqual((1, 4), (len(history), history.bytes))
+        history.configure(0, 10)
+        self.assertEqual((0, 0), (len(history), history.bytes))
+
+        # Disabled: no ETag, conditional requests are answered in full.
+        self.history.configure(0, 1 << 20)
+        self.documents.append(BUG)
+        status, headers, _ = self._get((b"if-none-match", b'"x"'), (b"a-im", b"json-patch"))
+        self.assertEqual(200, status)
+        self.assertNotIn(b"etag", headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
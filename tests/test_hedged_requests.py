@@ -0,0 +1,111 @@
+import importlib
+import os
+import threading
+import unittest
+from unittest import mock
+
+
+class HedgedRequestsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        self.histogram = self.main._LatencyHistogram()
+        for _ in range(100):
+            self.histogram.observe(0.02)
+        patchers = [
+            mock.patch.object(self.main, "PROXY_HEDGE_ENABLED", True),
+            mock.patch.dict(self.main._UPSTREAM_LATENCY, {"interactive": self.histogram}),
+            mock.patch.object(self.main, "_HEDGE_BUDGET", self.main._HedgeBudget(1.0)),
+            mock.patch.dict(self.main._HEDGE_STATS, {"eligible": 0, "hedged": 0, "hedge_won": 0}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_histogram_percentile_tracks_recent_latency(self):
+        histogram = self.main._LatencyHistogram(half_life=100)
+        self.assertIsNone(histogram.percentile(95))
+        for _ in range(100):
+            histogram.observe(0.01)
+        self.assertLess(histogram.percentile(95), 0.02)
+        for _ in range(400):
+            histogram.observe(1.0)
+        self.assertGreaterEqual(histogram.percentile(50), 1.0)
+
+    def test_budget_caps_hedges(self):
+        budget = self.main._HedgeBudget(0.05)
+        spent = 0
+        for _ in range(100):
+            budget.earn()
+            spent += budget.try_spend()
+        self.assertEqual(5, spent)
+
+    def test_slow_first_attempt_is_hedged(self):
+        release_first = threading.Event()
+        fast = mock.Mock(status_code=200)
+        slow = mock.Mock(status_code=200)
+        calls = []
+
+        def request(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                release_first.wait(2)
+                return slow
+            return fast
+
+        with mock.patch.object(self.main.requests.Session, "request", side_effect=request):
+            response = self.main._hedged_request(
+                "GET", "https://api.launchpad.net/devel/bugs/1", "interactive", (1, 1), {}
+            )
+        release_first.set()
+        self.assertIs(fast, response)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(1, self.main._HEDGE_STATS["hedge_won"])
+
+    def test_fast_first_attempt_is_not_hedged(self):
+        response = mock.Mock(status_code=200)
+        with mock.patch.object(self.main.requests.Session, "request", return_value=response) as request:
+            result = self.main._hedged_request(
+                "GET", "https://api.launchpad.net/devel/bugs/1", "interactive", (1, 1), {}
+            )
+        self.assertIs(response, result)
+        request.assert_called_once()
+        self.assertEqual(0, self.main._HEDGE_STATS["hedged"])
+
+    def test_failed_attempt_falls_back_to_the_other(self):
+        fast_failure = self.main.requests.ConnectionError("reset")
+        slow = mock.Mock(status_code=200)
+        calls = []
+
+        def request(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                threading.Event().wait(0.1)
+                return slow
+            raise fast_failure
+
+        with mock.patch.object(self.main.requests.Session, "request", side_effect=request):
+            response = self.main._hedged_request(
+                "GET", "https://api.launchpad.net/devel/bugs/1", "interactive", (1, 1), {}
+            )
+        self.assertIs(slow, response)
+
+    def test_writes_are_never_hedged(self):
+        response = mock.Mock(status_code=200)
+        with mock.patch.object(self.main.requests.Session, "request", return_value=response), mock.patch.object(
+            self.main, "_hedged_request"
+        ) as hedged:
+            self.main._send_attempt(
+                "POST", "https://api.launchpad.net/devel/bugs", "interactive", (1, 1), {}
+            )
+        hedged.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
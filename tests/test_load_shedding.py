@@ -0,0 +1,98 @@
+import asyncio
+import importlib
+import os
+import time
+import unittest
+from unittest import mock
+
+from helpers import asgi_request
+
+
+class LoadSheddingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def _scheduler(self, codel):
+        return self.main._UpstreamScheduler(
+            1, 4, {"login": 8, "interactive": 4, "bulk": 1}, queue_timeout=1,
+            admission={"bulk": codel},
+        )
+
+    def test_codel_needs_a_standing_queue(self):
+        codel = self.main._CoDel(target=0.1, interval=1.0)
+        codel._interval_end = 1.0
+        # A burst that drains within the interval is not overload.
+        codel.observe(0.5, now=0.2)
+        codel.observe(0.0, now=0.5)
+        self.assertFalse(codel.observe(0.3, now=1.0))
+        self.assertFalse(codel.overloaded)
+
+        # Every call in an interval waited past the target: overloaded.
+        codel.observe(0.15, now=1.5)
+        self.assertTrue(codel.observe(0.3, now=2.0))
+        self.assertTrue(codel.overloaded)
+        self.assertFalse(codel.admit(now=2.5))
+        self.assertFalse(codel.observe(0.15, now=2.6))  # within twice the target
+
+        # The call at 2.6 still waited too long; the next interval without
+        # any dequeue clears it.
+        self.assertFalse(codel.admit(now=3.0))
+        self.assertTrue(codel.admit(now=4.0))
+
+    def test_overloaded_lane_rejects_and_sheds(self):
+        codel = self.main._CoDel(target=0.01, interval=60)
+        scheduler = self._scheduler(codel)
+        woken = []
+        scheduler._enqueue("bulk", "ci", lambda: None)  # takes the only slot
+        queued = scheduler._enqueue("bulk", "alice", lambda: woken.append("alice"))
+        codel.overloaded = True
+
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            scheduler._enqueue("bulk", "bob", lambda: None)
+        self.assertEqual((503, "60"), (ctx.exception.status_code, ctx.exception.headers["Retry-After"]))
+
+        time.sleep(0.03)
+        scheduler.release("ci")
+        self.assertEqual(["alice"], woken)
+        self.assertTrue(queued.shed)
+        # Calls that need not queue are still admitted.
+        scheduler._enqueue("bulk", "bob", lambda: None)
+        stats = scheduler.stats()
+        self.assertEqual(1, stats["in_flight"])
+        self.assertEqual(
+            (True, 1, 1, 0),
+            tuple(stats["lanes"]["bulk"][key] for key in ("overloaded", "rejected", "shed", "queue_depth")),
+        )
+
+    def test_queued_call_of_a_disconnected_client_is_dropped(self):
+        scheduler = self._scheduler(self.main._CoDel(target=0.01, interval=60))
+        scheduler._enqueue("interactive", "ci", lambda: None)  # takes the only slot
+        calls = 0
+
+        async def receive():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.sleep(0.05)
+            return {"type": "http.disconnect"}
+
+        with mock.patch.object(self.main, "_UPSTREAM_SCHEDULER", scheduler), mock.patch.object(
+            self.main.requests.Session, "request", side_effect=AssertionError("called Launchpad")
+        ):
+            self.assertEqual(499, asgi_request(self.main.app, "GET", "/devel/bugs/1", receive=receive)[0])
+        stats = scheduler.stats()
+        self.assertEqual(1, stats["in_flight"])
+        self.assertEqual((0, 1), (
+            stats["lanes"]["interactive"]["queue_depth"],
+            stats["lanes"]["interactive"]["disconnected"],
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
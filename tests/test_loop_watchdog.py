@@ -0,0 +1,59 @@
+import asyncio
+import importlib
+import os
+import time
+import unittest
+
+
+def _block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+class LoopWatchdogTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def _run(self, watchdog, *blocks):
+        async def scenario():
+            watchdog.ensure_started()
+            await asyncio.sleep(0.05)
+            for seconds in blocks:
+                _block_the_loop(seconds)
+                await asyncio.sleep(0.05)
+
+        asyncio.run(scenario())
+
+    def test_blocking_call_is_counted_and_its_stack_logged(self):
+        watchdog = self.main._LoopWatchdog(0.01, 0.1, 60)
+        with self.assertLogs("lp_api_proxy", "WARNING") as logs:
+            self._run(watchdog, 0.4)
+        self.assertEqual(1, watchdog.stalls)
+        self.assertEqual(1, len(logs.output))
+        self.assertIn("Event loop blocked", logs.output[0])
+        self.assertIn("in _block_the_loop", logs.output[0])
+        lag = self.main.LOOP_LAG.samples()[0][1]
+        self.assertGreaterEqual(lag[1], 0.25)  # sum of observed lag
+
+    def test_stack_logging_is_rate_limited(self):
+        watchdog = self.main._LoopWatchdog(0.01, 0.1, 60)
+        with self.assertLogs("lp_api_proxy", "WARNING") as logs:
+            self._run(watchdog, 0.3, 0.3)
+        self.assertEqual(2, watchdog.stalls)
+        self.assertEqual(1, len(logs.output))
+        self.assertEqual(1, watchdog.suppressed)
+
+    def test_short_pauses_and_closed_loops_are_not_stalls(self):
+        watchdog = self.main._LoopWatchdog(0.01, 0.2, 60)
+        self._run(watchdog, 0.02)
+        time.sleep(0.3)
+        self.assertEqual(0, watchdog.stalls)
+        self.assertIsNone(watchdog._thread)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import importlib
+import os
+import tracemalloc
+import unittest
+from unittest import mock
+
+ADMIN = "Bearer s3cret"
+
+
+def _allocate():
+    return [bytearray(1024) for _ in range(200)]
+
+
+class MemoryIntrospectionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        patcher = mock.patch.object(self.main, "PROXY_ADMIN_TOKEN", "s3cret")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.main.admin_memory_tracemalloc, "stop", ADMIN)
+
+    def test_memory_report_lists_internal_sizes(self):
+        report = self.main.admin_memory(ADMIN)
+        self.assertEqual(os.getpid(), report["pid"])
+        self.assertFalse(report["tracemalloc"]["tracing"])
+        internal = report["internal"]
+        for key in ("upstream_queue_depth", "usage_windows", "circuit_breakers", "metric_series"):
+            self.assertIn(key, internal)
+        self.assertEqual({"identity": 0, "consumer_key": 0}, internal["usage_windows"])
+
+    def test_snapshot_requires_tracemalloc(self):
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            self.main.admin_memory_snapshot(ADMIN)
+        self.assertEqual(409, ctx.exception.status_code)
+
+    def test_snapshot_diff_points_at_the_allocating_line(self):
+        self.assertTrue(self.main.admin_memory_tracemalloc("start", ADMIN)["tracing"])
+        base = self.main.admin_memory_snapshot(ADMIN)["id"]
+        kept = _allocate()
+        diff = self.main.admin_memory_diff(base, ADMIN, group_by="filename")
+        top = diff["top"][0]
+        self.assertTrue(top["where"].startswith(__file__))
+        self.assertGreater(top["size_diff_bytes"], 150 * 1024)
+        self.assertEqual(2, len(self.main.admin_memory(ADMIN)["tracemalloc"]["snapshots"]))
+        del kept
+
+        self.main.admin_memory_tracemalloc("stop", ADMIN)
+        self.assertFalse(tracemalloc.is_tracing())
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            self.main.admin_memory_diff(base, ADMIN)
+        self.assertEqual(404, ctx.exception.status_code)
+
+    def test_snapshots_are_bounded(self):
+        self.main.admin_memory_tracemalloc("start", ADMIN)
+        for _ in range(self.main.MAX_MEMORY_SNAPSHOTS + 2):
+            self.main.admin_memory_snapshot(ADMIN, limit=1)
+        self.assertEqual(self.main.MAX_MEMORY_SNAPSHOTS, len(self.main._MEMORY_SNAPSHOTS))
+
+    def test_requires_admin_token(self):
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            self.main.admin_memory_tracemalloc("start", "Bearer wrong")
+        self.assertEqual(401, ctx.exception.status_code)
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+if __name__ == "__main__":
+    unittest.main()
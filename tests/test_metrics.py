@@ -0,0 +1,146 @@
+import importlib
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import asgi_request
+
+
+class MetricsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def test_http_requests_are_recorded_and_exposed(self):
+        status, _, _ = asgi_request(self.main.app, "GET", "/.well-known/openid-configuration")
+        self.assertEqual(200, status)
+        status, headers, body = asgi_request(self.main.app, "GET", "/metrics")
+        self.assertEqual(200, status)
+        self.assertTrue(headers[b"content-type"].startswith(b"text/plain; version=0.0.4"))
+        text = body.decode()
+        self.assertIn(
+            'lp_proxy_http_requests_total{route="/.well-known/openid-configuration",'
+            'method="GET",status="200"} 1',
+            text,
+        )
+        self.assertIn("# TYPE lp_proxy_http_request_duration_seconds histogram", text)
+        self.assertIn('lp_proxy_upstream_concurrency_limit 16', text)
+        self.assertIn('lp_proxy_upstream_queue_depth{lane="bulk"} 0', text)
+
+    def test_stage_timings_are_recorded(self):
+        token = self.main._sign_jwt({"typ": "lp-access"}, 60)
+        self.main._verify_jwt(token)
+        stages = {labels[0] for labels, _ in self.main.STAGE_DURATION.samples()}
+        self.assertIn("jwt_sign", stages)
+        self.assertIn("jwt_verify", stages)
+
+    def test_upstream_calls_are_recorded_by_host_and_endpoint(self):
+        response = mock.Mock(status_code=200, headers={})
+        with mock.patch.object(self.main.requests.Session, "request", return_value=response):
+            self.main._upstream_send(
+                "GET", "https://api.launchpad.net/devel/people/+me", "login"
+            )
+        samples = dict(
+            (tuple(labels), value) for labels, value in self.main.UPSTREAM_RESPONSES.samples()
+        )
+        self.assertEqual(1, samples[("api.launchpad.net", "people/+me", "200")])
+
+    def test_histogram_rendering_is_cumulative(self):
+        histogram = self.main._Histogram("test_seconds", "Test.", ("stage",), buckets=(0.1, 1))
+        self.main._METRICS.remove(histogram)
+        histogram.observe(0.05, ("a",))
+        histogram.observe(0.5, ("a",))
+        histogram.observe(5, ("a",))
+        family = {
+            "kind": "histogram",
+            "documentation": "Test.",
+            "labelnames": ["stage"],
+            "buckets": [0.1, 1],
+            "samples": histogram.samples(),
+        }
+        text = self.main._render_metrics({"test_seconds": family})
+        self.assertIn('test_seconds_bucket{stage="a",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{stage="a"} 3', text)
+
+    def test_route_labels_are_bounded(self):
+        self.assertEqual("/devel/*", self.main._metrics_route("/devel/bugs/1"))
+        self.assertEqual("/oauth2/token", self.main._metrics_route("/oauth2/token"))
+        self.assertEqual("other", self.main._metrics_route("/random/path"))
+
+    def test_unknown_paths_share_one_route_label(self):
+        def routes():
+            return {labels[0] for labels, _ in self.main.HTTP_REQUESTS.samples()}
+
+        before = routes()
+        for path in ("/oauth2/nope0", "/oauth2/nope1", "/.well-known/x", "/+junk0", "/+junk1"):
+            status, _, _ = asgi_request(self.main.app, "GET", path)
+            self.assertEqual(404, status)
+        self.assertLessEqual(routes() - before, {"other"})
+        self.assertIn("other", routes())
+
+    def test_every_route_has_its_own_label(self):
+        for route in self.main.app.routes:
+            label = self.main._metrics_route(route.path)
+            if label not in ("/devel/*", "/admin/*"):
+                self.assertEqual(route.path, label)
+
+    def test_multi_worker_aggregation(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = self.main._metrics_snapshot()
+            self.main.HTTP_IN_FLIGHT.inc(("/devel/*",), 0)
+
+            def family(name, samples):
+                return {**snapshot[name], "samples": samples}
+
+            other_live = {
+                "lp_proxy_http_requests_total": family(
+                    "lp_proxy_http_requests_total", [[["/devel/*", "GET", "200"], 5]]
+                ),
+                "lp_proxy_http_requests_in_flight": family(
+                    "lp_proxy_http_requests_in_flight", [[["/devel/*"], 2]]
+                ),
+            }
+            exited = {
+                "lp_proxy_http_requests_total": family(
+                    "lp_proxy_http_requests_total", [[["/devel/*", "GET", "200"], 7]]
+                ),
+                "lp_proxy_http_requests_in_flight": family(
+                    "lp_proxy_http_requests_in_flight", [[["/devel/*"], 9]]
+                ),
+            }
+            with open(os.path.join(tmp, "metrics-1.json"), "w") as fh:
+                json.dump(other_live, fh)
+            with open(os.path.join(tmp, "metrics-999999999.json"), "w") as fh:
+                json.dump(exited, fh)
+
+            with mock.patch.object(self.main, "PROXY_METRICS_DIR", tmp), mock.patch.object(
+                self.main, "_pid_alive", side_effect=lambda pid: pid != 999999999
+            ):
+                merged = self.main._collect_metrics()
+                again = self.main._collect_metrics()
+            self.assertFalse(os.path.exists(os.path.join(tmp, "metrics-999999999.json")))
+
+        def value(snapshot, name, labels):
+            return dict((tuple(l), v) for l, v in snapshot[name]["samples"]).get(labels, 0)
+
+        ours = value(self.main._metrics_snapshot(), "lp_proxy_http_requests_total", ("/devel/*", "GET", "200"))
+        self.assertEqual(
+            12 + ours, value(merged, "lp_proxy_http_requests_total", ("/devel/*", "GET", "200"))
+        )
+        self.assertEqual(
+            12 + ours, value(again, "lp_proxy_http_requests_total", ("/devel/*", "GET", "200"))
+        )
+        # Gauges of exited workers are dropped.
+        self.assertEqual(2, value(merged, "lp_proxy_http_requests_in_flight", ("/devel/*",)))
+
+
+if __name__ == "__main__":
+    unittest.main()
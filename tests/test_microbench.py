@@ -0,0 +1,59 @@
+import importlib
+import json
+import os
+import unittest
+
+
+class MicrobenchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+        from bench import micro
+
+        cls.micro = micro
+
+    def test_every_benchmark_runs(self):
+        for name, setup in self.micro.BENCHMARKS.items():
+            with self.subTest(name):
+                setup()()
+
+    def test_access_token_is_realistically_large(self):
+        claims = self.micro._access_claims()
+        self.assertEqual(self.micro.GROUPS, len(claims["groups"]))
+        self.assertGreater(len(self.main._sign_jwt(claims, 60)), 10000)
+
+    def test_regressions_are_judged_against_the_calibrated_baseline(self):
+        baseline = {
+            "benchmarks": {
+                "a": {"us": 10.0, "calibration_us": 20.0},
+                "b": {"us": 10.0, "calibration_us": 20.0},
+            }
+        }
+        results = {
+            "benchmarks": {
+                # Twice as slow, but so is the calibration loop: no regression.
+                "a": {"us": 20.0, "calibration_us": 40.0},
+                "b": {"us": 13.0, "calibration_us": 20.0},
+                "new": {"us": 99.0, "calibration_us": 20.0},
+            }
+        }
+        self.assertEqual([], self.micro.check(results, baseline, 0.5))
+        ((name, us, expected, change),) = self.micro.check(results, baseline, 0.25)
+        self.assertEqual(("b", 13.0, 10.0), (name, us, expected))
+        self.assertAlmostEqual(0.3, change)
+
+    def test_stored_baseline_covers_every_benchmark(self):
+        with open(self.micro.BASELINE) as fh:
+            baseline = json.load(fh)
+        self.assertEqual(set(self.micro.BENCHMARKS), set(baseline["benchmarks"]))
+
+    def test_measure(self):
+        self.assertGreater(self.micro.measure(lambda: sum(range(100)), 2, 0.01), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import importlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from helpers import asgi_request
+
+
+def _busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class ProfilerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        self.profiler = self.main._Profiler(0.001)
+        patcher = mock.patch.object(self.main, "_PROFILER", self.profiler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _wait_finished(self, profile):
+        for _ in range(200):
+            if profile.finished:
+                return
+            time.sleep(0.01)
+        self.fail("profile did not finish")
+
+    def test_time_window_profile_samples_busy_threads(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=_busy_loop, args=(stop,), name="busy")
+        worker.start()
+        try:
+            profile = self.profiler.start(seconds=0.2)
+            self._wait_finished(profile)
+        finally:
+            stop.set()
+            worker.join()
+
+        collapsed = profile.collapsed()
+        self.assertIn("busy;", collapsed)
+        self.assertIn("_busy_loop (tests/test_profiler.py:", collapsed)
+        speedscope = profile.speedscope()
+        names = {frame["name"] for frame in speedscope["shared"]["frames"]}
+        self.assertIn("_busy_loop", names)
+        busy = next(p for p in speedscope["profiles"] if p["name"] == "busy")
+        self.assertEqual("sampled", busy["type"])
+        self.assertEqual(len(busy["samples"]), len(busy["weights"]))
+        # The sampler thread stops once nothing is collecting.
+        for _ in range(100):
+            if self.profiler._thread is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(self.profiler._thread)
+
+    def test_next_requests_are_claimed_then_finished(self):
+        profile = self.profiler.start(requests=2)
+        self.assertIsNone(self.profiler._thread)
+        first = self.profiler.claim([])
+        second = self.profiler.claim([])
+        self.assertIs(profile, first)
+        self.assertIs(profile, second)
+        self.assertIsNone(self.profiler.claim([]))
+        self.profiler.attach(first)
+        self.profiler.attach(second)
+        self.profiler.detach(first)
+        self.assertIsNone(profile.finished)
+        self.profiler.detach(second)
+        self.assertIsNotNone(profile.finished)
+
+    def test_header_profiles_a_single_request(self):
+        with mock.patch.object(self.main, "PROXY_ADMIN_TOKEN", "s3cret"):
+            _, headers, _ = asgi_request(
+                self.main.app, "GET", "/oauth2/jwks", headers=[(b"x-lp-proxy-profile", b"s3cret")]
+            )
+            profile_id = headers[b"x-lp-proxy-profile-id"].decode()
+            self.assertIsNotNone(self.profiler.get(profile_id).finished)
+
+            _, headers, _ = asgi_request(
+                self.main.app, "GET", "/oauth2/jwks", headers=[(b"x-lp-proxy-profile", b"wrong")]
+            )
+            self.assertNotIn(b"x-lp-proxy-profile-id", headers)
+
+    def test_nothing_runs_when_not_triggered(self):
+        _, headers, _ = asgi_request(self.main.app, "GET", "/oauth2/jwks")
+        self.assertNotIn(b"x-lp-proxy-profile-id", headers)
+        self.assertIsNone(self.profiler._thread)
+        self.assertEqual([], self.profiler.summaries())
+
+    def test_finished_profiles_are_shared_through_the_profile_dir(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(
+            self.main, "PROXY_PROFILE_DIR", tmp
+        ):
+            profile = self.profiler.start(requests=1)
+            self.profiler.attach(self.profiler.claim([]))
+            profile.stacks[("MainThread", (("handler", "/srv/main.py", 10),))] = 3
+            self.profiler.detach(profile)
+
+            other_worker = self.main._Profiler(0.001)
+            loaded = other_worker.get(profile.id)
+        self.assertEqual("MainThread;handler (srv/main.py:10) 3\n", loaded.collapsed())
+
+    def test_admin_endpoints(self):
+        with mock.patch.object(self.main, "PROXY_ADMIN_TOKEN", "s3cret"):
+            with self.assertRaises(self.main.HTTPException) as ctx:
+                self.main.admin_profile_start("Bearer s3cret", seconds=1, request_count=1)
+            self.assertEqual(400, ctx.exception.status_code)
+            started = self.main.admin_profile_start("Bearer s3cret", request_count=1)
+            pending = self.main.admin_profile_download(started["id"], "Bearer s3cret")
+            self.assertEqual(202, pending.status_code)
+            with self.assertRaises(self.main.HTTPException) as ctx:
+                self.main.admin_profile_download("1-99", "Bearer s3cret")
+            self.assertEqual(404, ctx.exception.status_code)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import glob
+import gzip
+import importlib
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import asgi_request, make_response
+
+
+class RecordReplayTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def _patch(self, name, value):
+        patcher = mock.patch.object(self.main, name, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _misses(self):
+        return sum(value for _, value in self.main.UPSTREAM_REPLAY_MISSES.samples())
+
+    def _record(self, path):
+        recorder = self.main._CassetteRecorder(path)
+        self.addCleanup(recorder.close)
+        self._patch("_UPSTREAM_RECORDER", recorder)
+        responses = [
+            make_response(
+                b"oauth_token=REQTOKEN&oauth_token_secret=REQSECRET",
+                headers={"Content-Type": "application/x-www-form-urlencoded", "Set-Cookie": "s=1"},
+            ),
+            make_response(
+                {"total_size": 1, "entries": [{"id": 1}]}, headers={"ETag": '"abc"'}
+            ),
+        ]
+        with mock.patch.object(self.main.requests.Session, "request", side_effect=responses):
+            self.main._upstream_request(
+                "POST",
+                f"{self.main.LAUNCHPAD_URL}/+request-token",
+                lane=self.main.LANE_LOGIN,
+                data={"oauth_consumer_key": "k", "oauth_signature": "SIGNATURE"},
+            )
+            self.main._upstream_request(
+                "GET",
+                f"{self.main.LAUNCHPAD_API}/devel/bugs?ws.size=5&oauth_signature=SIGNATURE",
+                headers={"Authorization": 'OAuth oauth_signature="SIGNATURE"'},
+            )
+        recorder.close()
+        return recorder.path
+
+    def test_recorded_cassette_is_scrubbed(self):
+        path = self._record(os.path.join(self.dir, "lp.jsonl"))
+        with open(path) as fh:
+            raw = fh.read()
+        for secret in ("REQTOKEN", "REQSECRET", "SIGNATURE", "Set-Cookie", "Authorization"):
+            self.assertNotIn(secret, raw)
+        token, bugs = [json.loads(line) for line in raw.splitlines()]
+        self.assertEqual(
+            "oauth_token=scrubbed&oauth_token_secret=scrubbed", token["body"]
+        )
+        self.assertEqual(f"{self.main.LAUNCHPAD_API}/devel/bugs?ws.size=5", bugs["url"])
+        self.assertEqual('"abc"', bugs["headers"]["ETag"])
+        self.assertGreaterEqual(bugs["elapsed"], 0)
+
+    def test_replay_serves_recorded_responses_without_launchpad(self):
+        path = self._record(os.path.join(self.dir, "lp-{pid}.jsonl.gz"))
+        self.assertEqual(os.path.join(self.dir, f"lp-{os.getpid()}.jsonl.gz"), path)
+        with gzip.open(path, "rt") as fh:
+            self.assertEqual(2, len(fh.readlines()))
+
+        self._patch("_UPSTREAM_RECORDER", None)
+        self._patch(
+            "_UPSTREAM_PLAYER",
+            self.main._CassettePlayer(os.path.join(self.dir, "lp-*.jsonl.gz"), speed=0),
+        )
+        with mock.patch.object(
+            self.main.requests.Session, "request", side_effect=AssertionError("called Launchpad")
+        ):
+            status, _, body = asgi_request(self.main.app, "GET", "/devel/bugs", b"ws.size=5")
+            self.assertEqual(200, status)
+            self.assertEqual({"total_size": 1, "entries": [{"id": 1}]}, json.loads(body))
+
+            misses = self._misses()
+            status, _, _ = asgi_request(self.main.app, "GET", "/devel/bugs/2")
+            self.assertEqual(502, status)
+            self.assertGreater(self._misses(), misses)
+
+    def test_replay_scales_recorded_latency(self):
+        path = os.path.join(self.dir, "lp.jsonl")
+        with open(path, "w") as fh:
+            for elapsed in (0.2, 0.4):
+                fh.write(json.dumps({
+                    "ts": 1.0, "method": "GET", "url": "https://lp/devel/x", "status": 200,
+                    "elapsed": elapsed, "headers": {}, "body": str(elapsed),
+                }) + "\n")
+        player = self.main._CassettePlayer(path, speed=2)
+        with mock.patch.object(self.main.time, "sleep") as sleep:
+            bodies = [player.respond("GET", "https://lp/devel/x").text for _ in range(3)]
+        self.assertEqual(["0.2", "0.4", "0.2"], bodies)
+        self.assertEqual([0.1, 0.2, 0.1], [call.args[0] for call in sleep.call_args_list])
+
+    def test_traffic_shape_schedule(self):
+        from bench import replay
+
+        path = self._record(os.path.join(self.dir, "lp.jsonl"))
+        schedule = replay.devel_schedule(path)
+        self.assertEqual([(0, "/devel/bugs?ws.size=5")], schedule)
+        self.assertEqual([path], glob.glob(os.path.join(self.dir, "*.jsonl")))
+
+
+if __name__ == "__main__":
+    unittest.main()
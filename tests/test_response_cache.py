@@ -0,0 +1,219 @@
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from helpers import asgi_request, make_response, oauth_header
+
+
+class _CacheTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        self.cache = self.main._ResponseCache(ttl=60, max_bytes=1 << 20)
+        patcher = mock.patch.object(self.main, "_RESPONSE_CACHE", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class ResponseCacheTest(_CacheTestCase):
+    def _lookups(self, result):
+        return sum(
+            value for labels, value in self.main.RESPONSE_CACHE_LOOKUPS.samples()
+            if labels == [result]
+        )
+
+    def test_get_is_served_from_the_cache_per_credential(self):
+        upstream = mock.Mock(side_effect=lambda *a, **kw: make_response({"id": 1, "n": "é"}))
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            hits = self._lookups("hit")
+            first = asgi_request(
+                self.main.app, "GET", "/devel/bugs/1", b"b=2&a=1", [oauth_header("alice")]
+            )
+            second = asgi_request(
+                self.main.app, "GET", "/devel/bugs/1", b"a=1&b=2", [oauth_header("alice")]
+            )
+            self.assertEqual(1, upstream.call_count)
+            self.assertEqual(first[2], second[2])
+            self.assertEqual({"id": 1, "n": "é"}, json.loads(second[2]))
+            self.assertEqual(hits + 1, self._lookups("hit"))
+            self.assertIn(b'cache;desc="hit"', second[1][b"server-timing"])
+
+            # Another credential, or an explicit no-cache, goes to Launchpad.
+            asgi_request(self.main.app, "GET", "/devel/bugs/1", b"a=1&b=2", [oauth_header("bob")])
+            asgi_request(
+                self.main.app, "GET", "/devel/bugs/1", b"a=1&b=2",
+                [oauth_header("alice"), (b"cache-control", b"no-cache")],
+            )
+            self.assertEqual(3, upstream.call_count)
+
+            # A write through the proxy drops the credential's entries.
+            asgi_request(
+                self.main.app, "PATCH", "/devel/bugs/1", headers=[
+                    oauth_header("alice"), (b"content-type", b"application/json")
+                ], body=b'{"title": "x"}',
+            )
+            alice = self.main._credential_scope(oauth_header("alice")[1].decode())
+            self.assertEqual(0, self.cache.purge(alice))
+            self.assertEqual(1, self.cache.purge())
+
+    def test_a_write_in_another_worker_outdates_the_entries(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.object(self.main, "_SCOPE_STAMPS", self.main._ScopeStamps(tmp.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        versions = iter(range(1, 10))
+        upstream = mock.Mock(side_effect=lambda *a, **kw: make_response({"v": next(versions)}))
+
+        def get(who):
+            return asgi_request(self.main.app, "GET", "/devel/bugs/1", headers=[oauth_header(who)])[2]
+
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            self.assertEqual({"v": 1}, json.loads(get("alice")))
+            self.assertEqual({"v": 2}, json.loads(get("bob")))
+            self.assertEqual({"v": 1}, json.loads(get("alice")))
+
+            # Another worker proxies a PATCH of alice's.
+            other_worker = self.main._ScopeStamps(tmp.name)
+            other_worker.invalidate(self.main._credential_scope(oauth_header("alice")[1].decode()))
+            self.assertEqual({"v": 3}, json.loads(get("alice")))
+            self.assertEqual({"v": 2}, json.loads(get("bob")))
+        self.assertEqual(3, upstream.call_count)
+
+    def test_same_token_with_another_signature_misses(self):
+        upstream = mock.Mock(side_effect=[
+            make_response({"secret": "victim data"}), make_response({}, status=401),
+        ])
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            asgi_request(self.main.app, "GET", "/devel/bugs/1", headers=[oauth_header("alice")])
+            status, headers, body = asgi_request(
+                self.main.app, "GET", "/devel/bugs/1",
+                headers=[oauth_header("alice", secret="forged")],
+            )
+        self.assertEqual(401, status)
+        self.assertNotIn(b"victim", body)
+        self.assertEqual(2, upstream.call_count)
+        self.assertIn(b'cache;desc="miss"', headers[b"server-timing"])
+
+    def test_only_plaintext_credentials_are_cached(self):
+        header = 'OAuth oauth_token="alice", oauth_signature_method="HMAC-SHA1", oauth_signature="x"'
+        self.assertIsNone(self.main._credential_scope(header))
+        upstream = mock.Mock(side_effect=lambda *a, **kw: make_response({"id": 1}))
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            for _ in range(2):
+                asgi_request(
+                    self.main.app, "GET", "/devel/bugs/1",
+                    headers=[(b"authorization", header.encode())],
+                )
+        self.assertEqual(2, upstream.call_count)
+
+    def test_disabled_cache_is_not_consulted(self):
+        self.cache.configure(0, 1 << 20)
+        upstream = mock.Mock(side_effect=lambda *a, **kw: make_response({"id": 1}))
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            for _ in range(2):
+                _, headers, _ = asgi_request(
+                    self.main.app, "GET", "/devel/bugs/1", headers=[oauth_header("alice")]
+                )
+        self.assertEqual(2, upstream.call_count)
+        self.assertNotIn(b"cache;", headers.get(b"server-timing", b""))
+
+    def test_expiry_and_lru_eviction_by_size(self):
+        cache = self.main._ResponseCache(ttl=10, max_bytes=10)
+        cache.put(("s", "a"), b"aaaa", now=0)
+        cache.put(("s", "b"), b"bbbb", now=0)
+        self.assertEqual(b"aaaa", cache.get(("s", "a"), now=1))
+        cache.put(("s", "c"), b"cccc", now=1)  # evicts b, the least recently used
+        self.assertIsNone(cache.get(("s", "b"), now=1))
+        self.assertEqual(8, cache.bytes)
+        self.assertIsNone(cache.get(("s", "a"), now=10))
+        self.assertEqual(4, cache.bytes)
+        cache.put(("s", "d"), b"d" * 11, now=1)  # larger than the whole cache
+        self.assertEqual(1, len(cache))
+
+
+class WarmupTest(_CacheTestCase):
+    credential = {"oauth_token": "alice", "oauth_token_secret": "s", "oauth_consumer_key": "k"}
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(
+            self.main, "PROXY_WARMUP_PATHS", ["~{username}/super_teams", "bugs?ws.size=5"]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _prefetches(self, result):
+        return sum(
+            value for labels, value in self.main.WARMUP_PREFETCHES.samples()
+            if labels == [result]
+        )
+
+    def _drain(self, warmup):
+        for _ in range(200):
+            if not warmup.pending():
+                return
+            time.sleep(0.01)
+        self.fail("warm-up did not finish")
+
+    def test_login_prefetches_land_in_the_cache(self):
+        warmup = self.main._Warmup(concurrency=2, queue_size=8, budget=10)
+        upstream = mock.Mock(side_effect=lambda method, url, **kw: make_response({"url": url}))
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            self.assertEqual(2, warmup.schedule("alice", self.credential))
+            self._drain(warmup)
+            self.assertEqual(2, upstream.call_count)
+            authorization = upstream.call_args.kwargs["headers"]["Authorization"]
+            self.assertIn('oauth_token="alice"', authorization)
+
+            status, _, body = asgi_request(
+                self.main.app, "GET", "/devel/~alice/super_teams", headers=[oauth_header("alice")]
+            )
+            self.assertEqual(200, status)
+            self.assertEqual(
+                f"{self.main.LAUNCHPAD_API}/devel/~alice/super_teams", json.loads(body)["url"]
+            )
+            asgi_request(
+                self.main.app, "GET", "/devel/bugs", b"ws.size=5", [oauth_header("alice")]
+            )
+            self.assertEqual(2, upstream.call_count)
+
+    def test_prefetches_are_bounded(self):
+        dropped, skipped = self._prefetches("dropped"), self._prefetches("skipped")
+        release = threading.Event()
+        warmup = self.main._Warmup(concurrency=1, queue_size=1, budget=10)
+        upstream = mock.Mock(side_effect=lambda *a, **kw: release.wait() and make_response({}))
+        with mock.patch.object(self.main.requests.Session, "request", upstream):
+            # The queue holds one prefetch: the second path is dropped.
+            self.assertEqual(1, warmup.schedule("alice", self.credential))
+            self.assertEqual(dropped + 1, self._prefetches("dropped"))
+            release.set()
+            self._drain(warmup)
+
+            # Prefetches not started within the budget are skipped.
+            warmup.budget = 0
+            warmup.queue_size = 8
+            warmup.schedule("alice", self.credential)
+            self._drain(warmup)
+        self.assertEqual(1, upstream.call_count)
+        self.assertEqual(skipped + 2, self._prefetches("skipped"))
+
+    def test_nothing_is_prefetched_without_a_cache(self):
+        self.cache.configure(0, 1 << 20)
+        warmup = self.main._Warmup(concurrency=1, queue_size=8, budget=10)
+        self.assertEqual(0, warmup.schedule("alice", self.credential))
+
+
+if __name__ == "__main__":
+    unittest.main()
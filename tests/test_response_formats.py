@@ -0,0 +1,82 @@
+import importlib
+import json
+import os
+import unittest
+from unittest import mock
+
+from helpers import asgi_request, make_response
+
+try:
+    import cbor2
+    import msgpack
+except ImportError:
+    cbor2 = msgpack = None
+
+
+DOCUMENT = {"a": [1, -300, None, True, 1.5, "é"], "b": {"a": "é"}}
+
+
+@unittest.skipIf(msgpack is None, "needs the optional msgpack and cbor2 packages")
+class ResponseFormatsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def test_negotiation(self):
+        negotiate = self.main._negotiate_media_type
+        for accept, expected in (
+            (None, "application/json"),
+            ("*/*", "application/json"),
+            ("text/html", "application/json"),
+            ("application/msgpack", "application/msgpack"),
+            ("application/x-msgpack, application/json", "application/msgpack"),
+            ("application/json, application/cbor", "application/json"),
+            ("application/json;q=0.5, application/cbor", "application/cbor"),
+            ("application/msgpack;q=0.5, */*", "application/json"),
+            ("application/cbor;q=0", "application/json"),
+        ):
+            with self.subTest(accept):
+                self.assertEqual(expected, negotiate(accept))
+
+    def test_without_the_packages_only_json_is_offered(self):
+        negotiate = self.main._negotiate_media_type
+        with mock.patch.dict(self.main._BINARY_ENCODERS, clear=True):
+            self.assertEqual("application/json", negotiate("application/msgpack"))
+            self.assertEqual("application/json", negotiate("application/cbor, */*;q=0.1"))
+        with mock.patch.dict(self.main._BINARY_ENCODERS):
+            del self.main._BINARY_ENCODERS["application/msgpack"]
+            self.assertEqual("application/cbor", negotiate("application/msgpack, application/cbor"))
+
+    def test_binary_bodies_decode_to_the_document(self):
+        encode = self.main._encode_binary
+        self.assertEqual(DOCUMENT, msgpack.unpackb(encode(DOCUMENT, self.main.MEDIA_MSGPACK)))
+        self.assertEqual(DOCUMENT, cbor2.loads(encode(DOCUMENT, self.main.MEDIA_CBOR)))
+
+    def test_devel_get_answers_in_the_accepted_format(self):
+        main = self.main
+        cache = main._ResponseCache(ttl=60, max_bytes=1 << 20)
+        upstream = mock.Mock(side_effect=lambda *a, **kw: make_response(DOCUMENT))
+        with mock.patch.object(main, "_RESPONSE_CACHE", cache), mock.patch.object(
+            main.requests.Session, "request", upstream
+        ):
+            _, headers, body = asgi_request(main.app, "GET", "/devel/bugs/1")
+            self.assertEqual(b"application/json", headers[b"content-type"])
+            self.assertEqual(DOCUMENT, json.loads(body))
+
+            for _ in range(2):
+                _, headers, body = asgi_request(
+                    main.app, "GET", "/devel/bugs/1", headers=[(b"accept", b"application/msgpack")]
+                )
+                self.assertEqual(b"application/msgpack", headers[b"content-type"])
+                self.assertIn(b"Accept", headers[b"vary"])
+                self.assertEqual(main._encode_binary(DOCUMENT, main.MEDIA_MSGPACK), body)
+        # One call per format; the second msgpack request was a cache hit.
+        self.assertEqual(2, upstream.call_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import importlib
+import json
+import os
+import unittest
+from unittest import mock
+
+from helpers import asgi_request
+
+
+def parse_server_timing(value):
+    metrics = {}
+    for part in value.split(", "):
+        name, *params = part.split(";")
+        metrics[name] = dict(param.split("=", 1) for param in params)
+    return metrics
+
+
+class ServerTimingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def _authorization(self):
+        cred = self.main._fernet().encrypt(
+            json.dumps({"oauth_token": "t", "oauth_token_secret": "s"}).encode()
+        )
+        token = self.main._sign_jwt(
+            {
+                "typ": "lp-access",
+                "sub": "alice",
+                "aud": self.main.PROXY_JWT_AUDIENCE,
+                "lp_cred": cred.decode(),
+            },
+            60,
+        )
+        return (b"authorization", b"Bearer " + token.encode())
+
+    def test_devel_response_breaks_down_each_stage(self):
+        response = mock.Mock(status_code=200, text='{"name": "alice"}', content=b"{}", headers={})
+        with mock.patch.object(self.main.requests.Session, "request", return_value=response):
+            status, headers, _ = asgi_request(
+                self.main.app, "GET", "/devel/people/+me", headers=[self._authorization()]
+            )
+        self.assertEqual(200, status)
+        metrics = parse_server_timing(headers[b"server-timing"].decode())
+        for name in ("auth", "decrypt", "queue", "upstream", "body", "total"):
+            self.assertGreaterEqual(float(metrics[name]["dur"]), 0)
+        self.assertNotIn("cache", metrics)
+        self.assertEqual(
+            ", ".join(self.main.origins).encode(), headers[b"timing-allow-origin"]
+        )
+
+    def test_failed_upstream_call_is_still_timed(self):
+        with mock.patch.object(
+            self.main.requests,
+            "request",
+            side_effect=self.main.requests.ConnectionError("refused"),
+        ):
+            status, headers, _ = asgi_request(self.main.app, "GET", "/devel/bugs/1")
+        self.assertEqual(502, status)
+        self.assertIn("upstream", parse_server_timing(headers[b"server-timing"].decode()))
+
+    def test_cache_status_is_reported(self):
+        context = self.main._RequestContext(timings={"upstream": 0.0123})
+        context.cache = "hit"
+        self.assertEqual(
+            'upstream;dur=12.30, cache;desc="hit", total;dur=20.00',
+            self.main._server_timing_header(context, 0.02),
+        )
+
+    def test_cross_origin_scripts_can_read_the_header(self):
+        origin = (b"origin", b"https://ci.example.com")
+        _, headers, _ = asgi_request(self.main.app, "GET", "/oauth2/jwks", headers=[origin])
+        self.assertIn(b"server-timing", headers)
+        exposed = headers[b"access-control-expose-headers"].decode().lower().split(", ")
+        self.assertIn("server-timing", exposed)
+
+    def test_header_can_be_disabled(self):
+        with mock.patch.object(self.main, "PROXY_SERVER_TIMING", False):
+            _, headers, _ = asgi_request(self.main.app, "GET", "/oauth2/jwks")
+        self.assertNotIn(b"server-timing", headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import asyncio
+import http.server
+import importlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from helpers import asgi_request
+
+
+class StartupTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def setUp(self):
+        patcher = mock.patch.dict(self.main._READINESS, {"status": "starting"}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _fresh_key_state(self, **patches):
+        patches.setdefault("_rsa_private_key", None)
+        patches.setdefault("_rsa_key_id", None)
+        patches.setdefault("_jwks_body", None)
+        patcher = mock.patch.multiple(self.main, **patches)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_readiness_follows_the_lifespan(self):
+        self._fresh_key_state(PROXY_RSA_PRIVATE_KEY_PEM=None, PROXY_RSA_PRIVATE_KEY_FILE="")
+        status, _, body = asgi_request(self.main.app, "GET", "/healthz")
+        self.assertEqual((200, {"status": "ok"}), (status, json.loads(body)))
+        status, _, body = asgi_request(self.main.app, "GET", "/readyz")
+        self.assertEqual((503, "starting"), (status, json.loads(body)["status"]))
+
+        async def scenario():
+            async with self.main.app.router.lifespan_context(self.main.app):
+                # The key and JWKS are ready before the first request.
+                self.assertIsNotNone(self.main._rsa_private_key)
+                self.assertIsNotNone(self.main._jwks_body)
+                return await asyncio.to_thread(asgi_request, self.main.app, "GET", "/readyz")
+
+        with self.assertWarns(UserWarning):
+            status, _, body = asyncio.run(scenario())
+        body = json.loads(body)
+        self.assertEqual((200, "ready"), (status, body["status"]))
+        self.assertGreaterEqual(body["startup_seconds"], 0)
+        self.assertEqual(503, asgi_request(self.main.app, "GET", "/readyz")[0])
+
+    def test_upstream_connections_are_opened_at_startup_and_reused(self):
+        peers = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                peers.append(self.client_address)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.send_header("Set-Cookie", "session=alice")
+                self.end_headers()
+
+            def do_GET(self):
+                self.do_HEAD()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        root = f"http://127.0.0.1:{server.server_port}"
+        with mock.patch.multiple(self.main, LAUNCHPAD_URL=root, LAUNCHPAD_API=root), \
+                mock.patch.dict(self.main._UPSTREAM_SESSIONS, clear=True), \
+                mock.patch.dict(os.environ, {"NO_PROXY": "*"}):
+            self.main._warm_upstream_connections()
+            for _ in range(3):
+                self.main._session_request("GET", f"{root}/devel/bugs/1", timeout=5)
+            # Users share the session: it must not send one's cookies for another.
+            self.assertEqual(0, len(self.main._upstream_session(root).cookies))
+        self.assertEqual(1, len(peers))
+
+    def test_key_file_is_created_once_and_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "rsa.pem")
+            self._fresh_key_state(PROXY_RSA_PRIVATE_KEY_PEM=None, PROXY_RSA_PRIVATE_KEY_FILE=path)
+            _, first_kid = self.main._get_rsa_private_key()
+            self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+            self.assertEqual([], [name for name in os.listdir(tmp) if name.endswith(".tmp")])
+
+            # Another worker (or a restart) reads the same key.
+            self.main._rsa_private_key = None
+            key, second_kid = self.main._get_rsa_private_key()
+            self.assertEqual(first_kid, second_kid)
+
+            _, _, jwks = asgi_request(self.main.app, "GET", "/oauth2/jwks")
+            self.assertEqual(first_kid, json.loads(jwks)["keys"][0]["kid"])
+            token = self.main._sign_id_token({"sub": "alice"})
+            self.assertEqual(first_kid, jwt.get_unverified_header(token)["kid"])
+
+    def test_kid_is_the_rfc7638_thumbprint(self):
+        # Example from RFC 7638, section 3.1.
+        n = (
+            "0vx7agoebGcQSuuPiLJXZptN9nndrQmbXEps2aiAFbWhM78LhWx4cbbfAAtVT86zwu1RK7aPFFxuhDR1L6tSoc_B"
+            "JECPebWKRXjBZCiFV4n3oknjhMstn64tZ_2W-5JsGY4Hc5n9yBXArwl93lqt7_RN5w6Cf0h4QyQ5v-65YGjQR0_"
+            "FDW2QvzqY368QQMicAtaSqzs8KJZgnYb9c7d0zgdAZHzu6qMQvRL5hajrn1n91CbOpbISD08qNLyrdkt-bFTWh"
+            "AI4vMQFh6WeZu0fM4lFd2NcRwr3XPksINHaQ-G_xBniIqbw0Ls1jF44-csFCur-kEgU8awapJzKnqDKgw"
+        )
+        numbers = rsa.RSAPublicNumbers(
+            65537, int.from_bytes(jwt.utils.base64url_decode(n), "big")
+        )
+        self.assertEqual(
+            "NzbLsXh8uDCcd-6MNwXF4W_7noWXFZAfHkxZsRGC9Xs", self.main._jwk_thumbprint(numbers)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
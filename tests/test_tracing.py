@@ -0,0 +1,164 @@
+import http.server
+import importlib
+import json
+import os
+import threading
+import unittest
+from unittest import mock
+
+from helpers import asgi_request
+
+
+class _Collector(http.server.BaseHTTPRequestHandler):
+    """Stand-in for an OTLP/HTTP collector: records posted JSON bodies."""
+
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.received.append((self.path, json.loads(body)))
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+class TracingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.collector = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Collector)
+        threading.Thread(target=cls.collector.serve_forever, daemon=True).start()
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        os.environ["PROXY_OTLP_ENDPOINT"] = "http://127.0.0.1:%d" % cls.collector.server_port
+        os.environ["PROXY_TRACE_SAMPLE_RATIO"] = "0"
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    @classmethod
+    def tearDownClass(cls):
+        del os.environ["PROXY_OTLP_ENDPOINT"]
+        del os.environ["PROXY_TRACE_SAMPLE_RATIO"]
+        cls.collector.shutdown()
+        cls.collector.server_close()
+
+    def setUp(self):
+        _Collector.received.clear()
+
+    def _exported_spans(self):
+        self.main._TRACE_EXPORTER.flush()
+        spans = []
+        for path, body in _Collector.received:
+            self.assertEqual("/v1/traces", path)
+            for resource in body["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    spans.extend(scope["spans"])
+        return spans
+
+    def _access_token(self):
+        cred = self.main._fernet().encrypt(
+            json.dumps({"oauth_token": "t", "oauth_token_secret": "s"}).encode()
+        )
+        return self.main._sign_jwt(
+            {
+                "typ": "lp-access",
+                "sub": "alice",
+                "aud": self.main.PROXY_JWT_AUDIENCE,
+                "lp_cred": cred.decode(),
+            },
+            60,
+        )
+
+    def test_traceparent_parsing(self):
+        self.assertEqual(
+            (TRACE_ID, PARENT_ID, True),
+            self.main._parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01"),
+        )
+        self.assertFalse(self.main._parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-00")[2])
+        self.assertIsNone(self.main._parse_traceparent(f"ff-{TRACE_ID}-{PARENT_ID}-01"))
+        self.assertIsNone(self.main._parse_traceparent(f"00-{'0' * 32}-{PARENT_ID}-01"))
+        self.assertIsNone(self.main._parse_traceparent("garbage"))
+
+    def test_devel_request_is_traced_through_every_stage(self):
+        response = mock.Mock(status_code=200, text='{"name": "alice"}', content=b"{}", headers={})
+        traceparent = f"00-{TRACE_ID}-{PARENT_ID}-01".encode()
+        with mock.patch.object(self.main.requests.Session, "request", return_value=response):
+            status, _, _ = asgi_request(
+                self.main.app,
+                "GET",
+                "/devel/people/+me",
+                headers=[
+                    (b"traceparent", traceparent),
+                    (b"authorization", b"Bearer " + self._access_token().encode()),
+                ],
+            )
+        self.assertEqual(200, status)
+
+        spans = {span["name"]: span for span in self._exported_spans()}
+        server = spans["GET /devel/*"]
+        self.assertEqual(TRACE_ID, server["traceId"])
+        self.assertEqual(PARENT_ID, server["parentSpanId"])
+        self.assertEqual(2, server["kind"])
+        for name in ("jwt_verify", "credential_decrypt", "oauth1_sign", "body", "GET people/+me"):
+            self.assertEqual(TRACE_ID, spans[name]["traceId"])
+            self.assertEqual(server["spanId"], spans[name]["parentSpanId"])
+        client = spans["GET people/+me"]
+        self.assertEqual(3, client["kind"])
+        attributes = {a["key"]: a["value"] for a in client["attributes"]}
+        self.assertEqual({"intValue": "200"}, attributes["http.response.status_code"])
+        self.assertEqual({"stringValue": "api.launchpad.net"}, attributes["server.address"])
+
+    def test_unsampled_requests_are_not_exported(self):
+        traceparent = f"00-{TRACE_ID}-{PARENT_ID}-00".encode()
+        asgi_request(self.main.app, "GET", "/oauth2/jwks", headers=[(b"traceparent", traceparent)])
+        # PROXY_TRACE_SAMPLE_RATIO=0: new traces are not sampled either.
+        asgi_request(self.main.app, "GET", "/oauth2/jwks")
+        self.assertEqual([], self._exported_spans())
+
+    def test_each_group_collection_gets_a_span(self):
+        response = mock.Mock(status_code=200, headers={}, content=b"{}")
+        response.json.return_value = {"entries": []}
+        me = {
+            "memberships_details_collection_link": "https://api.launchpad.net/devel/~alice/memberships_details",
+            "super_teams_collection_link": "https://api.launchpad.net/devel/~alice/super_teams",
+        }
+        root = self.main._Span("login", TRACE_ID)
+        token = self.main._CURRENT_SPAN.set(root)
+        try:
+            with mock.patch.object(self.main.requests.Session, "request", return_value=response):
+                self.main._lp_fetch_groups("OAuth ...", me)
+        finally:
+            self.main._CURRENT_SPAN.reset(token)
+
+        spans = self._exported_spans()
+        group = next(span for span in spans if span["name"] == "lp_fetch_groups")
+        self.assertEqual(root.span_id, group["parentSpanId"])
+        urls = sorted(
+            attribute["value"]["stringValue"]
+            for span in spans
+            if span.get("parentSpanId") == group["spanId"]
+            for attribute in span["attributes"]
+            if attribute["key"] == "url.full"
+        )
+        self.assertEqual(sorted(me.values()), urls)
+
+    def test_full_queue_drops_spans(self):
+        exporter = self.main._SpanExporter("http://127.0.0.1:9", {}, 60)
+        exporter._thread = object()  # do not start the export thread
+        with mock.patch.object(exporter, "MAX_QUEUE", 1):
+            exporter.enqueue(self.main._Span("a", TRACE_ID), 1)
+            exporter.enqueue(self.main._Span("b", TRACE_ID), 1)
+        self.assertEqual(1, len(exporter._queue))
+        self.assertIn([["dropped"], 1], self.main.TRACE_SPANS.samples())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import importlib
+import os
+import time
+import unittest
+from unittest import mock
+
+
+class UpstreamResilienceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        os.environ["PROXY_UPSTREAM_TIMEOUTS"] = "bulk=1:90"
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    @classmethod
+    def tearDownClass(cls):
+        del os.environ["PROXY_UPSTREAM_TIMEOUTS"]
+
+    def setUp(self):
+        self.main._BREAKERS.clear()
+        patcher = mock.patch.object(self.main, "PROXY_UPSTREAM_RETRY_BACKOFF_SECONDS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _send(self, side_effect, method="GET", **kwargs):
+        with mock.patch.object(self.main.requests.Session, "request", side_effect=side_effect) as request:
+            try:
+                return self.main._upstream_send(
+                    method, "https://api.launchpad.net/devel/bugs", "bulk", **kwargs
+                ), request
+            except self.main.HTTPException as exc:
+                exc.request_mock = request
+                raise
+
+    def _response(self, status, headers=None):
+        return mock.Mock(status_code=status, headers=headers or {})
+
+    def test_route_class_timeouts_are_passed_to_requests(self):
+        _, request = self._send([self._response(200)])
+        self.assertEqual((1.0, 90.0), request.call_args.kwargs["timeout"])
+        self.assertEqual((3.05, 15.0), self.main.PROXY_UPSTREAM_TIMEOUTS["login"])
+
+    def test_deadline_caps_timeouts(self):
+        deadline = time.monotonic() + 0.5
+        _, request = self._send([self._response(200)], deadline=deadline)
+        connect, read = request.call_args.kwargs["timeout"]
+        self.assertLessEqual(connect, 0.5)
+        self.assertLessEqual(read, 0.5)
+
+    def test_expired_deadline_is_a_504(self):
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            self._send([self._response(200)], deadline=time.monotonic() - 1)
+        self.assertEqual(504, ctx.exception.status_code)
+        ctx.exception.request_mock.assert_not_called()
+
+    def test_deadline_header_parsing(self):
+        deadline = self.main._deadline_from_headers([(b"x-request-timeout-ms", b"2500")])
+        self.assertAlmostEqual(time.monotonic() + 2.5, deadline, delta=0.5)
+        self.assertIsNone(self.main._deadline_from_headers([]))
+        self.assertIsNone(self.main._deadline_from_headers([(b"x-request-timeout-ms", b"x")]))
+
+    def test_retryable_status_is_retried(self):
+        response, request = self._send(
+            [self._response(503), self._response(200)], retry=True
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, request.call_count)
+
+    def test_no_retry_unless_requested(self):
+        response, request = self._send([self._response(503)], method="POST")
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(1, request.call_count)
+
+    def test_timeout_maps_to_504_after_retries(self):
+        timeout = self.main.requests.Timeout("read timed out")
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            self._send([timeout, timeout, timeout], retry=True)
+        self.assertEqual(504, ctx.exception.status_code)
+        self.assertEqual(3, ctx.exception.request_mock.call_count)
+
+    def test_connection_error_maps_to_502(self):
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            self._send([self.main.requests.ConnectionError("refused")])
+        self.assertEqual(502, ctx.exception.status_code)
+
+    def test_breaker_opens_and_fails_fast(self):
+        breaker = self.main._CircuitBreaker("api.launchpad.net", 2, 30)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            breaker.before_call()
+        self.assertEqual(503, ctx.exception.status_code)
+        self.assertIn("Retry-After", ctx.exception.headers)
+        self.assertEqual("open", breaker.stats()["state"])
+
+    def test_breaker_half_opens_for_a_single_probe(self):
+        breaker = self.main._CircuitBreaker("api.launchpad.net", 1, 0)
+        breaker.record_failure()
+        breaker.before_call()  # the probe
+        self.assertEqual("half-open", breaker.state)
+        with self.assertRaises(self.main.HTTPException):
+            breaker.before_call()
+        breaker.record_success()
+        self.assertEqual("closed", breaker.state)
+        breaker.before_call()
+
+    def test_failed_probe_reopens_circuit(self):
+        breaker = self.main._CircuitBreaker("api.launchpad.net", 5, 0)
+        for _ in range(5):
+            breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual("open", breaker.state)
+
+    def test_breakers_are_per_host(self):
+        self.assertIsNot(
+            self.main._breaker_for("https://launchpad.net/+request-token"),
+            self.main._breaker_for("https://api.launchpad.net/devel/bugs"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import asyncio
+import importlib
+import os
+import threading
+import unittest
+
+
+class UpstreamSchedulerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def _scheduler(self, concurrency=1, identity_concurrency=4, weights=None):
+        return self.main._UpstreamScheduler(
+            concurrency,
+            identity_concurrency,
+            weights or {"login": 8, "interactive": 4, "bulk": 1},
+            queue_timeout=1,
+        )
+
+    def _queue(self, scheduler, lane, identity, order):
+        waiter = scheduler._enqueue(lane, identity, lambda: order.append((lane, identity)))
+        return waiter
+
+    def test_login_lane_is_served_before_bulk(self):
+        scheduler = self._scheduler()
+        order = []
+        self._queue(scheduler, "bulk", "ci", order)  # takes the only slot
+        self._queue(scheduler, "bulk", "ci", order)
+        self._queue(scheduler, "login", "ip:10.0.0.1", order)
+        scheduler.release("ci")
+        self.assertEqual([("bulk", "ci"), ("login", "ip:10.0.0.1")], order)
+
+    def test_identities_take_turns_inside_a_lane(self):
+        scheduler = self._scheduler()
+        order = []
+        self._queue(scheduler, "bulk", "ci", order)
+        for _ in range(3):
+            self._queue(scheduler, "bulk", "ci", order)
+        self._queue(scheduler, "bulk", "alice", order)
+        scheduler.release("ci")
+        scheduler.release("ci")
+        # alice is served after one more "ci" call, not after all three.
+        self.assertEqual(
+            [("bulk", "ci"), ("bulk", "ci"), ("bulk", "alice")], order
+        )
+
+    def test_identity_concurrency_cap(self):
+        scheduler = self._scheduler(concurrency=4, identity_concurrency=2)
+        order = []
+        for _ in range(3):
+            self._queue(scheduler, "bulk", "ci", order)
+        self.assertEqual(2, len(order))
+        stats = scheduler.stats()
+        self.assertEqual(2, stats["in_flight"])
+        self.assertEqual(1, stats["lanes"]["bulk"]["queue_depth"])
+
+    def test_lane_weights_share_slots(self):
+        scheduler = self._scheduler(
+            identity_concurrency=100, weights={"login": 1, "interactive": 1, "bulk": 1}
+        )
+        order = []
+        self._queue(scheduler, "bulk", "ci", order)
+        for _ in range(4):
+            self._queue(scheduler, "interactive", "alice", order)
+            self._queue(scheduler, "bulk", "ci", order)
+        for _ in range(8):
+            scheduler.release(order[-1][1])
+        lanes = [lane for lane, _ in order[1:]]
+        self.assertEqual(4, lanes.count("interactive"))
+        self.assertEqual(4, lanes.count("bulk"))
+
+    def test_queue_timeout_raises_503_with_retry_after(self):
+        scheduler = self._scheduler()
+        scheduler.queue_timeout = 0.05
+        with scheduler.slot("bulk", "ci"):
+            with self.assertRaises(self.main.HTTPException) as ctx:
+                with scheduler.slot("bulk", "ci"):
+                    pass
+        self.assertEqual(503, ctx.exception.status_code)
+        self.assertIn("Retry-After", ctx.exception.headers)
+        stats = scheduler.stats()
+        self.assertEqual(0, stats["in_flight"])
+        self.assertEqual(1, stats["lanes"]["bulk"]["timed_out"])
+
+    def test_async_slot_waits_for_a_thread_to_release(self):
+        scheduler = self._scheduler()
+        held = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            with scheduler.slot("bulk", "ci"):
+                held.set()
+                done.wait(1)
+
+        worker = threading.Thread(target=hold)
+        worker.start()
+        held.wait(1)
+
+        async def acquire():
+            threading.Timer(0.05, done.set).start()
+            async with scheduler.async_slot("login", "alice"):
+                return scheduler.stats()["in_flight"]
+
+        self.assertEqual(1, asyncio.run(acquire()))
+        worker.join()
+        self.assertEqual(0, scheduler.stats()["in_flight"])
+
+    def test_devel_lane_classification(self):
+        class FakeRequest:
+            def __init__(self, method, query, headers=None):
+                self.method = method
+                self.query_params = query
+                self.headers = headers or {}
+
+        self.assertEqual("bulk", self.main._devel_lane(FakeRequest("GET", {"ws.op": "searchTasks"})))
+        self.assertEqual("interactive", self.main._devel_lane(FakeRequest("GET", {})))
+        self.assertEqual(
+            "bulk",
+            self.main._devel_lane(FakeRequest("GET", {}, {"x-lp-proxy-priority": "bulk"})),
+        )
+        self.assertEqual(
+            "interactive",
+            self.main._devel_lane(FakeRequest("GET", {}, {"x-lp-proxy-priority": "login"})),
+        )
+
+    def test_raw_oauth_identity_hides_token(self):
+        identity = self.main._oauth1_header_identity(
+            'OAuth oauth_consumer_key="x", oauth_token="secret-token"'
+        )
+        self.assertTrue(identity.startswith("oauth:"))
+        self.assertNotIn("secret-token", identity)
+
+    def test_admin_endpoint_is_disabled_without_token(self):
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            self.main.admin_upstream("Bearer anything")
+        self.assertEqual(404, ctx.exception.status_code)
+
+
+if __name__ == "__main__":
+    unittest.main()
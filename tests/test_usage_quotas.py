@@ -0,0 +1,109 @@
+import importlib
+import os
+import unittest
+from unittest import mock
+
+
+class UsageQuotasTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ["PROXY_JWT_SECRET"] = "0123456789abcdef0123456789abcdef"
+        os.environ["PROXY_JWT_ENCRYPTION_KEY"] = "uqrbQQAj_ErcRA_DJ0JQcNoeFI-NSBU1MCk9cLI0BZM="
+        import main as main_module
+
+        cls.main = importlib.reload(main_module)
+
+    def _accounting(self, **quotas):
+        return self.main._UsageAccounting(60, **quotas)
+
+    def test_usage_is_accounted_per_identity_and_consumer_key(self):
+        usage = self._accounting()
+        usage.record("user:alice", "concourse-ci (https://ci.example.com)", 100, 0.5, now=1000)
+        usage.record("user:alice", "concourse-ci (https://ci.example.com)", 50, 0.25, now=1001)
+        usage.record("user:bob", "lp-api-proxy", 10, 0.1, now=1002)
+
+        top = usage.top("identity", now=1003)
+        self.assertEqual("user:alice", top[0]["key"])
+        self.assertEqual(2, top[0]["requests"])
+        self.assertEqual(150, top[0]["bytes"])
+        self.assertEqual(0.75, top[0]["latency_seconds_total"])
+
+        consumers = usage.top("consumer_key", by="bytes", now=1003)
+        self.assertEqual(
+            ["concourse-ci (https://ci.example.com)", "lp-api-proxy"],
+            [row["key"] for row in consumers],
+        )
+
+    def test_window_slides(self):
+        usage = self._accounting()
+        usage.record("user:alice", None, 1, 0.1, now=1000)
+        self.assertEqual([], usage.top("identity", now=1100))
+
+    def test_request_quota_rejects_with_retry_after(self):
+        usage = self._accounting(quota_requests=2)
+        usage.record("user:alice", None, 1, 0.1, now=1000)
+        usage.check_quota("user:alice", None, now=1001)
+        usage.record("user:alice", None, 1, 0.1, now=1001)
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            usage.check_quota("user:alice", None, now=1002)
+        self.assertEqual(429, ctx.exception.status_code)
+        self.assertLessEqual(int(ctx.exception.headers["Retry-After"]), 60)
+        usage.check_quota("user:bob", None, now=1002)
+        usage.check_quota("user:alice", None, now=1070)
+
+    def test_byte_and_consumer_quotas(self):
+        usage = self._accounting(quota_bytes=100, quota_consumer_requests=1)
+        usage.record("user:alice", "ci", 150, 0.1, now=1000)
+        with self.assertRaises(self.main.HTTPException):
+            usage.check_quota("user:alice", None, now=1001)
+        with self.assertRaises(self.main.HTTPException) as ctx:
+            usage.check_quota("user:bob", "ci", now=1001)
+        self.assertIn("consumer key", ctx.exception.detail)
+
+    def test_consumer_key_is_read_from_the_outgoing_request(self):
+        header = self.main._oauth1_authorization_header(
+            "concourse-ci (https://ci.example.com)", "", token="t", token_secret="s"
+        )
+        self.assertEqual(
+            "concourse-ci (https://ci.example.com)",
+            self.main._request_consumer_key({"headers": {"Authorization": header}}),
+        )
+        self.assertEqual(
+            "lp-api-proxy",
+            self.main._request_consumer_key({"data": {"oauth_consumer_key": "lp-api-proxy"}}),
+        )
+
+    def test_login_lane_is_not_throttled(self):
+        usage = self._accounting(quota_requests=1)
+        usage.record("ip:10.0.0.1", None, 1, 0.1)
+        response = mock.Mock(status_code=200, content=b"{}", headers={})
+        with mock.patch.object(self.main, "_UPSTREAM_USAGE", usage), mock.patch.object(
+            self.main.requests.Session, "request", return_value=response
+        ):
+            self.main._upstream_request(
+                "POST", "https://launchpad.net/+request-token", lane="login", identity="ip:10.0.0.1"
+            )
+            with self.assertRaises(self.main.HTTPException):
+                self.main._upstream_request(
+                    "GET",
+                    "https://api.launchpad.net/devel/bugs",
+                    lane="bulk",
+                    identity="ip:10.0.0.1",
+                )
+        self.assertEqual(2, usage.top("identity")[0]["requests"])
+
+    def test_admin_consumers_lists_top_consumers(self):
+        usage = self._accounting()
+        usage.record("user:alice", None, 1, 0.1)
+        with mock.patch.object(self.main, "PROXY_ADMIN_TOKEN", "s3cret"), mock.patch.object(
+            self.main, "_UPSTREAM_USAGE", usage
+        ):
+            result = self.main.admin_consumers("Bearer s3cret")
+            with self.assertRaises(self.main.HTTPException) as ctx:
+                self.main.admin_consumers("Bearer wrong")
+        self.assertEqual("user:alice", result["consumers"][0]["key"])
+        self.assertEqual(401, ctx.exception.status_code)
+
+
+if __name__ == "__main__":
+    unittest.main()